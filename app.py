@@ -1,25 +1,121 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g, abort, send_file
+import gc
 import json
 import os
+import threading
+import hmac
 from functools import wraps
-from werkzeug.security import generate_password_hash, check_password_hash
+from urllib.parse import urlencode
+from werkzeug.security import generate_password_hash
+from werkzeug.local import LocalProxy
 from datetime import datetime, timedelta
 import jdatetime
+import click
+from catalog import CatalogStore, stock_only
+from storage import create_storage, import_json, apply_entries, JsonStorage, SqliteStorage, OutOfStock, Duplicate
+from discounts import DiscountCache, DiscountSchedule, jalali_today
+from listing import SortOrders, listing_args, list_products
+from facets import FacetIndex
+from search import SearchIndex
+from page_cache import ResponseCache, conditional_response
+from cart_store import create_cart_store, new_cart_id
+from pricing import price_cart
+from asgi import AsgiAdapter
+from orders import OrderLog, Checkout, ReservationSweeper
+from scheduler import DayScheduler
+from users import UserRepository, user_keys, normalize_email
+from passwords import PasswordHasher, PasswordPoolBusy, LoginThrottle
+from metrics import Metrics
+from images import ImageStore, ImageUnavailable, InvalidImage, image_source, source_version, MAX_IMAGE_BYTES
+from images import SIZES as IMAGE_SIZES
+from bulk import (export_products, guess_format, import_products, read_rows, InvalidField, select, is_filter,
+                  discount_change, price_change, parse_delta, updated_entries, stock_entries, deleted_entries)
 
 app = Flask(__name__)
 app.secret_key = 'kokad_ziba_secret_key_2024_alireza'
 
 # Data directory
-DATA_DIR = 'data'
-PRODUCTS_FILE = os.path.join(DATA_DIR, 'products.json')
-USERS_FILE = os.path.join(DATA_DIR, 'users.json')
+DATA_DIR = os.environ.get('KOODAK_DATA_DIR', 'data')
 
-# Ensure data directory exists
-os.makedirs(DATA_DIR, exist_ok=True)
+# Page sizes for the storefront and admin product lists
+PRODUCTS_PER_PAGE = 24
+ADMIN_PRODUCTS_PER_PAGE = 50
+SEARCH_RESULTS_LIMIT = 48
+
+# Cart store: 'sqlite' (data/carts.db, shared by all workers) or 'memory'
+# (single process only)
+CART_STORE_BACKEND = os.environ.get('KOODAK_CART_STORE', 'sqlite')
+
+# Memory budget for rendered anonymous pages and for cached API responses
+PAGE_CACHE_MAX_BYTES = int(os.environ.get('KOODAK_PAGE_CACHE_BYTES', 32 * 1024 * 1024))
+API_CACHE_MAX_BYTES = int(os.environ.get('KOODAK_API_CACHE_BYTES', 16 * 1024 * 1024))
+
+# Storage backend: 'json' (data/*.json files) or 'sqlite' (data/koodak_ziba.db)
+STORAGE_BACKEND = os.environ.get('KOODAK_STORAGE', 'json')
+
+# Write JSON snapshots without indentation (smaller files, faster parsing)
+JSON_COMPACT = os.environ.get('KOODAK_JSON_COMPACT') == '1'
+
+# Seconds a pending order holds its stock, and how often expired
+# reservations are given back
+RESERVATION_TTL = int(os.environ.get('KOODAK_RESERVATION_TTL', 15 * 60))
+RESERVATION_SWEEP_INTERVAL = int(os.environ.get('KOODAK_RESERVATION_SWEEP', 60))
+
+# Threads running requests when served over ASGI (uvicorn app:asgi_app);
+# connections beyond that wait on the event loop, not in a thread
+ASGI_THREADS = int(os.environ.get('KOODAK_ASGI_THREADS', 16))
+
+# Redo the day's discount work and render the busiest pages right after
+# local midnight (server time zone should be Asia/Tehran), instead of on the
+# first requests of the day; '0' turns the background thread off
+DAY_SCHEDULER = os.environ.get('KOODAK_DAY_SCHEDULER', '1') == '1'
+
+# Password hashing: werkzeug method string (sets the cost), threads in the
+# dedicated hashing pool ('thread' or 'process' pool) and how many hashes
+# may wait for it before requests are turned away
+PASSWORD_METHOD = os.environ.get('KOODAK_PASSWORD_METHOD', 'scrypt')
+PASSWORD_WORKERS = int(os.environ.get('KOODAK_PASSWORD_WORKERS', 2))
+PASSWORD_POOL = os.environ.get('KOODAK_PASSWORD_POOL', 'thread')
+PASSWORD_MAX_PENDING = int(os.environ.get('KOODAK_PASSWORD_MAX_PENDING', 32))
+
+# Login throttle: attempts per IP and failed logins per email in a window
+# (seconds). Behind a reverse proxy the IP is only the client's with
+# werkzeug's ProxyFix in place; otherwise raise the IP limit.
+LOGIN_IP_LIMIT = int(os.environ.get('KOODAK_LOGIN_IP_LIMIT', 60))
+LOGIN_EMAIL_LIMIT = int(os.environ.get('KOODAK_LOGIN_EMAIL_LIMIT', 5))
+LOGIN_WINDOW = int(os.environ.get('KOODAK_LOGIN_WINDOW', 300))
+
+# Valid rows of a bulk product import written per storage write
+IMPORT_BATCH_SIZE = int(os.environ.get('KOODAK_IMPORT_BATCH', 5000))
+
+# Product images served from /img/<id>/<size>: disk budget for fetched
+# originals and resized variants, conversion threads, and URL schemes the
+# proxy may fetch (add 'file' to serve images from local paths)
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('KOODAK_IMAGE_CACHE_BYTES', 512 * 1024 * 1024))
+IMAGE_WORKERS = int(os.environ.get('KOODAK_IMAGE_WORKERS', 2))
+IMAGE_URL_SCHEMES = tuple(os.environ.get('KOODAK_IMAGE_SCHEMES', 'http,https').split(','))
+
+# Request profiling (/admin/metrics), off unless KOODAK_METRICS=1: share of
+# requests sampled, and a token letting Prometheus scrape without a session
+METRICS_ENABLED = os.environ.get('KOODAK_METRICS') == '1'
+METRICS_SAMPLE_RATE = float(os.environ.get('KOODAK_METRICS_SAMPLE_RATE', 0.1))
+METRICS_TOKEN = os.environ.get('KOODAK_METRICS_TOKEN')
+
+# Storage, cart store, image store and checkout work in DATA_DIR and are
+# set up by open_data() (create_app() and the CLI commands call it), so
+# importing app.py creates no directories or databases
+storage = None
+cart_store = None
+image_store = None
+checkout_service = None
+reservation_sweeper = None
+password_hasher = PasswordHasher(PASSWORD_METHOD, PASSWORD_WORKERS, PASSWORD_MAX_PENDING, PASSWORD_POOL)
+login_throttle = LoginThrottle(LOGIN_IP_LIMIT, LOGIN_EMAIL_LIMIT, LOGIN_WINDOW)
 
 # Helper function for Persian date
 def get_jalali_date():
-    return jdatetime.datetime.now().strftime('%Y/%m/%d')
+    # Formatted once per day
+    return jalali_today.text()
 
 def get_jalali_datetime():
     return jdatetime.datetime.now().strftime('%Y/%m/%d - %H:%M')
@@ -41,7 +137,7 @@ def gregorian_to_jalali(greg_date):
 
 # Initialize data files
 def init_data_files():
-    if not os.path.exists(PRODUCTS_FILE):
+    if not storage.initialized('products'):
         default_products = [
             {
                 "id": 1,
@@ -148,13 +244,13 @@ def init_data_files():
         ]
         save_products(default_products)
     
-    if not os.path.exists(USERS_FILE):
+    if not storage.initialized('users'):
         default_users = [
             {
                 "id": 1,
                 "username": "ادمین",
                 "email": "KoodakZiba_Admin@gmail.com",
-                "password": generate_password_hash("Admin_Alireza"),
+                "password": generate_password_hash("Admin_Alireza", PASSWORD_METHOD),
                 "phone": "09123456789",
                 "is_admin": True,
                 "created_at": "1403/09/01 - 10:00"
@@ -163,64 +259,186 @@ def init_data_files():
         save_users(default_users)
 
 # Data functions
+# Discount results are memoized per product for the current Jalali day
+discount_cache = DiscountCache()
+
+# Parsed catalog shared by all request threads. Change products only through
+# add_product/update_product/delete_product/write_products so storage and
+# cache stay in step. Writes by other workers are read back from storage
+# as the records they changed; stock-only changes (checkouts, cancellations,
+# expiries) leave the page caches alone.
+catalog = CatalogStore(lambda: storage.load_tracked('products'), lambda: storage.signature('products'),
+                       indexes={'discounts': DiscountSchedule,
+                                'orders': lambda: SortOrders(discount_cache),
+                                'search': SearchIndex,
+                                'facets': FacetIndex},
+                       changes=lambda cursor: storage.changes('products', cursor), quiet=stock_only)
+
 def load_products():
-    try:
-        with open(PRODUCTS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except:
-        return []
+    return catalog.get()
 
 def save_products(products):
-    with open(PRODUCTS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(products, f, ensure_ascii=False, indent=4)
+    storage.save('products', products)
+    catalog.replace(products)
+
+def add_product(product):
+    # Storage assigns the id when product['id'] is None
+    transition = storage.insert('products', product)
+    catalog.commit(transition, lambda products: products.add(product))
+
+def update_product(product):
+    transition = storage.update('products', product)
+    catalog.commit(transition, lambda products: products.update(product))
+    discount_cache.invalidate(product['id'])
+
+def delete_product(product_id):
+    transition = storage.delete('products', product_id)
+    catalog.commit(transition, lambda products: products.delete(product_id))
+    discount_cache.invalidate(product_id)
+
+def write_products(entries):
+    # Many inserts/updates/deletes (storage batch entries) in one storage
+    # write and one catalog rebuild
+    transition = storage.batch('products', entries)
+    catalog.rebuild(transition, lambda products: apply_entries(products, entries))
+    discount_cache.invalidate()
+
+def modify_products(plan):
+    # Bulk edit: `plan(current products by id)` returns the batch entries,
+    # computed and written under the storage write lock (storage.modify)
+    transition, entries = storage.modify('products', plan)
+    if entries:
+        catalog.rebuild(transition, lambda products: apply_entries(products, entries))
+        discount_cache.invalidate()
+    return entries
+
+def import_product_file(stream, fmt):
+    return import_products(read_rows(stream, fmt), load_products().get, write_products,
+                           get_jalali_date(), IMPORT_BATCH_SIZE, image_store.has_upload)
+
+def stock_changed(transition, products):
+    def apply(repository):
+        for product in products:
+            repository.update(product)
+    catalog.commit(transition, apply)
+
+# Orders: data/orders.log, stock reserved at checkout until the order is
+# confirmed, cancelled or expires
+order_log = OrderLog(os.path.join(DATA_DIR, 'orders.log'))
+
+# Users, cached like the catalog and looked up by normalized email,
+# username or phone. Change them only through add_user/update_user/delete_user.
+users_store = CatalogStore(lambda: storage.load('users'), lambda: storage.signature('users'),
+                           repository=UserRepository)
+
+DUPLICATE_USER_MESSAGES = {
+    'email': 'این ایمیل قبلاً ثبت شده است.',
+    'username': 'این نام کاربری قبلاً انتخاب شده است.',
+    'phone': 'این شماره تلفن قبلاً ثبت شده است.'
+}
+
+THROTTLED_MESSAGE = 'تعداد تلاش‌ها بیش از حد مجاز است. لطفاً چند دقیقه دیگر دوباره تلاش کنید.'
+PASSWORD_BUSY_MESSAGE = 'سرور در حال حاضر شلوغ است. لطفاً چند لحظه دیگر دوباره تلاش کنید.'
 
 def load_users():
-    try:
-        with open(USERS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except:
-        return []
+    return users_store.get()
 
 def save_users(users):
-    with open(USERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(users, f, ensure_ascii=False, indent=4)
+    storage.save('users', users)
+    users_store.replace(users)
+
+def add_user(user):
+    # Raises Duplicate if the email, username or phone is taken, checked
+    # atomically with the write so concurrent registrations cannot both win
+    transition = storage.insert('users', user, unique=user_keys)
+    users_store.commit(transition, lambda users: users.add(user))
+
+def update_user(user):
+    transition = storage.update('users', user, unique=user_keys)
+    users_store.commit(transition, lambda users: users.update(user))
+
+def delete_user(user_id):
+    transition = storage.delete('users', user_id)
+    users_store.commit(transition, lambda users: users.delete(user_id))
 
 def get_discounted_price(product):
-    if product.get('has_discount') and product.get('discount_percent'):
-        try:
-            today = jdatetime.date.today()
-            start_parts = product['discount_start'].split('/')
-            end_parts = product['discount_end'].split('/')
-            
-            start_date = jdatetime.date(int(start_parts[0]), int(start_parts[1]), int(start_parts[2]))
-            end_date = jdatetime.date(int(end_parts[0]), int(end_parts[1]), int(end_parts[2]))
-            
-            if start_date <= today <= end_date:
-                discount = product['discount_percent']
-                original_price = product['price']
-                discounted_price = original_price - (original_price * discount / 100)
-                return int(discounted_price)
-        except:
-            pass
-    return None
+    return discount_cache.price(product)
 
 def is_discount_active(product):
-    if product.get('has_discount') and product.get('discount_percent'):
-        try:
-            today = jdatetime.date.today()
-            start_parts = product['discount_start'].split('/')
-            end_parts = product['discount_end'].split('/')
-            
-            start_date = jdatetime.date(int(start_parts[0]), int(start_parts[1]), int(start_parts[2]))
-            end_date = jdatetime.date(int(end_parts[0]), int(end_parts[1]), int(end_parts[2]))
-            
-            return start_date <= today <= end_date
-        except:
-            pass
-    return False
+    return discount_cache.is_active(product)
+
+# Profiling hooks: phases timed and functions counted in sampled requests
+metrics = Metrics(METRICS_SAMPLE_RATE) if METRICS_ENABLED else None
+if metrics:
+    metrics.init_app(app)
+    metrics.wrap(discount_cache, 'evaluate', 'discounts')
+    metrics.wrap(password_hasher, 'hash', 'password_hash')
+    metrics.wrap(password_hasher, 'verify', 'password_hash')
+    load_products = metrics.counted('load_products')(load_products)
+    save_products = metrics.counted('save_products')(save_products)
+    metrics.gauge('catalog_version', lambda: catalog.version)
+    metrics.gauge('password_pool_pending', lambda: password_hasher.stats()['pending'])
+
+# Startup. Importing app.py only defines things; create_app() opens the
+# data directory, seeds an empty store, builds the catalog and users caches
+# and starts the background threads. Servers that do not call it (flask
+# run, test clients) get it on their first request.
+_create_lock = threading.Lock()
+_open_lock = threading.Lock()
+_loaded = False
+_started_pid = None
+
+def open_data():
+    # Creates DATA_DIR and opens what lives there (the SQLite schemas are
+    # created here); does nothing if that already happened
+    global storage, cart_store, image_store, checkout_service, reservation_sweeper
+    with _open_lock:
+        if storage is not None:
+            return
+        os.makedirs(DATA_DIR, exist_ok=True)
+        opened = create_storage(STORAGE_BACKEND, DATA_DIR, compact=JSON_COMPACT)
+        if metrics:
+            for method in ('load', 'load_tracked', 'changes'):
+                metrics.wrap(opened, method, 'storage_load')
+            for method in ('save', 'insert', 'update', 'delete', 'batch', 'modify', 'adjust_stock'):
+                metrics.wrap(opened, method, 'storage_save')
+        cart_store = create_cart_store(CART_STORE_BACKEND, DATA_DIR)
+        image_store = ImageStore(os.path.join(DATA_DIR, 'image_cache'), os.path.join(DATA_DIR, 'images'),
+                                 IMAGE_CACHE_MAX_BYTES, IMAGE_WORKERS, schemes=IMAGE_URL_SCHEMES)
+        checkout_service = Checkout(opened, order_log, stock_changed, RESERVATION_TTL)
+        reservation_sweeper = ReservationSweeper(checkout_service, RESERVATION_SWEEP_INTERVAL)
+        storage = opened
+
+def create_app(preload=False):
+    # preload=True is for a server master that forks its workers afterwards
+    # (gunicorn.conf.py): no threads are started, since they would not
+    # survive the fork, and everything built so far is frozen out of the
+    # garbage collector, so the workers share the catalog's pages
+    # copy-on-write rather than copying them the first time gc walks them
+    global _loaded, _started_pid
+    with _create_lock:
+        if not _loaded:
+            open_data()
+            init_data_files()
+            load_products()
+            load_users()
+            _loaded = True
+        if not preload and _started_pid != os.getpid():
+            reservation_sweeper.start()
+            if DAY_SCHEDULER:
+                day_scheduler.start()
+            _started_pid = os.getpid()
+    if preload:
+        gc.collect()
+        gc.freeze()
+    return app
 
-# Initialize data
-init_data_files()
+@app.before_request
+def ensure_started():
+    # Also what starts the threads in a preloaded worker that was not
+    # started by its server (gunicorn.conf.py does it in post_worker_init)
+    if _started_pid != os.getpid():
+        create_app()
 
 # Decorators
 def login_required(f):
@@ -244,14 +462,115 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Carts live in cart_store; the session only holds the cart id
+def session_cart_id(create=False):
+    cart_id = session.get('cart_id')
+    if cart_id is None and (create or session.get('cart')):
+        cart_id = session['cart_id'] = new_cart_id()
+    # Move a cart from the old cookie session into the store once
+    legacy_cart = session.pop('cart', None)
+    for item in legacy_cart or ():
+        cart_store.add(cart_id, item['product_id'], item.get('size', ''), item.get('color', ''), item['quantity'])
+    return cart_id
+
+def session_cart_items():
+    cart_id = session_cart_id()
+    return cart_store.items(cart_id) if cart_id else []
+
+def session_cart_count():
+    cart_id = session_cart_id()
+    return cart_store.count(cart_id) if cart_id else 0
+
+# Rendered storefront pages for anonymous visitors, re-rendered when the
+# catalog changes or the Jalali day rolls over (discounts, current date)
+page_cache = ResponseCache(PAGE_CACHE_MAX_BYTES)
+
+def page_version():
+    load_products()  # notices other workers' writes
+    return (catalog.version, jalali_today())
+
+def page_cache_bypass():
+    # Pages showing a user menu, flash messages or a cart count are per visitor
+    return 'user_id' in session or bool(session.get('_flashes')) or session_cart_count() > 0
+
+cached_page = page_cache.cached(page_version, page_cache_bypass)
+
+# Catalog API responses do not depend on the session, so they are never bypassed
+api_cache = ResponseCache(API_CACHE_MAX_BYTES)
+cached_api = api_cache.cached(page_version, lambda: False)
+
+def day_rollover(now):
+    # Discounts start and end with the Jalali day, so at midnight: move to
+    # the day of `now` (the scheduler's clock), recompute what depends on
+    # it (discount memo, active prices, discounted order, on-sale facet)
+    # and render the hot pages again; their cache entries carry the day and
+    # are stale now
+    jalali_today.refresh(now)
+    products = load_products()
+    discount_cache.warm(products)
+    products.indexes['discounts'].active_prices()
+    products.indexes['orders'].keys('discounted')
+    products.indexes['facets'].counts({})
+    warm_pages(products)
+
+def warm_pages(products):
+    # Home, sale and every category page, as an anonymous visitor sees
+    # them, and the products shown on the home and sale pages
+    paths = ['/', '/sale', '/api/products']
+    paths += ['/?' + urlencode({'category': category})
+              for category in products.indexes['facets'].counts({})['category']]
+    first_page = list_products(products, products.indexes['orders'], limit=PRODUCTS_PER_PAGE).products
+    ids = [p['id'] for p in first_page] + products.indexes['discounts'].active_on()[:PRODUCTS_PER_PAGE]
+    paths += ['/product/%d' % i for i in dict.fromkeys(ids)]
+    with app.test_client() as client:
+        for path in paths:
+            client.get(path)
+
+day_scheduler = DayScheduler([day_rollover])
+
+def use_clock(clock):
+    # Deterministic time (scheduler.ManualClock) for offline tests: the day
+    # scheduler and the Jalali day behind discounts and dates both follow it
+    day_scheduler.set_clock(clock)
+    jalali_today.clock = clock.now
+    jalali_today.refresh()
+
+def product_image_url(product, size='card'):
+    # Local, resized copy of the product image; the version changes with
+    # the image, so browsers may keep it for good
+    source = image_source(product)
+    if source is None:
+        return ''
+    return url_for('product_image', product_id=product['id'], size=size, v=source_version(source))
+
+def uploaded_image():
+    # Digest of an image uploaded with the product form, None without one;
+    # raises InvalidImage for anything but a JPEG, PNG, GIF or WebP file
+    upload = request.files.get('image_file')
+    if not upload or not upload.filename:
+        return None
+    return image_store.save_upload(upload.read(MAX_IMAGE_BYTES + 1))
+
+INVALID_IMAGE_MESSAGE = 'فایل تصویر نامعتبر است (JPEG، PNG، GIF یا WebP تا ۱۰ مگابایت).'
+
 # Context processor
+def lazy(fn):
+    # Template value computed only if the template uses it, at most once
+    # per request
+    key = '_lazy_' + fn.__name__
+    def value():
+        if key not in g:
+            setattr(g, key, fn())
+        return getattr(g, key)
+    return LocalProxy(value)
+
 @app.context_processor
 def utility_processor():
-    cart = session.get('cart', [])
     return {
-        'cart_count': len(cart),
+        'cart_count': lazy(session_cart_count),
         'get_discounted_price': get_discounted_price,
         'is_discount_active': is_discount_active,
+        'product_image_url': product_image_url,
         'current_jalali_date': get_jalali_date()
     }
 
@@ -265,23 +584,88 @@ def format_price(value):
 
 # Routes
 @app.route('/')
+@cached_page
 def index():
     products = load_products()
     category = request.args.get('category', 'all')
-    if category != 'all':
-        products = [p for p in products if p['category'] == category]
-    return render_template('index.html', products=products, current_category=category)
+    listing = list_products(products, products.indexes['orders'], facets=products.indexes['facets'],
+                            **listing_args(request.args, PRODUCTS_PER_PAGE))
+    # Counts for the category tabs and the size/color/age filters
+    facet_counts = products.indexes['facets'].counts(listing.filters)
+    return render_template('index.html', products=listing.products, current_category=category, listing=listing,
+                           facet_counts=facet_counts)
+
+@app.route('/sale')
+@cached_page
+def sale():
+    # Products with a discount running today, ending soonest first
+    products = load_products()
+    on_sale = [products.get(i) for i in products.indexes['discounts'].active_on()]
+    return render_template('index.html', products=on_sale, current_category='sale')
+
+@app.route('/search')
+def search():
+    query = request.args.get('q', '').strip()
+    products = load_products()
+    results = [products.get(i) for i, score in products.indexes['search'].search(query, SEARCH_RESULTS_LIMIT)]
+    return render_template('index.html', products=results, current_category='search', query=query)
+
+@app.route('/api/search')
+@cached_api
+def api_search():
+    query = request.args.get('q', '').strip()
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+    except ValueError:
+        limit = 20
+    products = load_products()
+    results = []
+    for product_id, score in products.indexes['search'].search(query, limit):
+        product = products.get(product_id)
+        results.append({
+            'id': product['id'],
+            'name': product['name'],
+            'price': product['price'],
+            'final_price': get_discounted_price(product) or product['price'],
+            'image': product.get('image'),
+            'score': round(score, 3)
+        })
+    return json_response({'query': query, 'results': results})
 
 @app.route('/product/<int:product_id>')
+@cached_page
 def product_detail(product_id):
-    products = load_products()
-    product = next((p for p in products if p['id'] == product_id), None)
+    product = load_products().get(product_id)
     if not product:
         flash('محصول یافت نشد.', 'danger')
         return redirect(url_for('index'))
     return render_template('product_detail.html', product=product)
 
+@app.route('/img/<int:product_id>/<size>')
+def product_image(product_id, size):
+    product = load_products().get(product_id)
+    source = image_source(product) if product else None
+    if size not in IMAGE_SIZES or source is None:
+        abort(404)
+    try:
+        path, mimetype = image_store.variant(source, size, webp='image/webp' in request.headers.get('Accept', ''))
+    except ImageUnavailable:
+        if source[0] == 'url' and source[1].startswith(('http://', 'https://')):
+            # Not fetched or converted (yet): the original host beats a broken image
+            response = redirect(source[1])
+            response.headers['Cache-Control'] = 'public, max-age=300'
+            return response
+        abort(404)
+    response = send_file(path, mimetype=mimetype, conditional=True)
+    response.headers['Vary'] = 'Accept'
+    if request.args.get('v') == source_version(source):
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response
+
 @app.route('/about')
+@cached_page
 def about():
     return render_template('about.html')
 
@@ -295,90 +679,228 @@ def contact():
         return redirect(url_for('contact'))
     return render_template('contact.html')
 
+def cart_quote(cart_items):
+    # Prices the cart in one pass against today's active discount prices
+    products = load_products()
+    return price_cart(cart_items, products, products.indexes['discounts'].active_prices())
+
 @app.route('/cart')
 def cart():
-    cart_items = session.get('cart', [])
-    products = load_products()
-    cart_products = []
-    total = 0
-    
-    for item in cart_items:
-        product = next((p for p in products if p['id'] == item['product_id']), None)
-        if product:
-            # Calculate price with discount
-            price = get_discounted_price(product) or product['price']
-            cart_product = {
-                **product,
-                'quantity': item['quantity'],
-                'selected_size': item.get('size', ''),
-                'selected_color': item.get('color', ''),
-                'final_price': price,
-                'subtotal': price * item['quantity']
-            }
-            cart_products.append(cart_product)
-            total += cart_product['subtotal']
-    
-    return render_template('cart.html', cart_items=cart_products, total=total)
+    quote = cart_quote(session_cart_items())
+    return render_template('cart.html', cart_items=quote.lines, total=quote.total, cart_problems=quote.problems)
+
+INVALID_QUANTITY_MESSAGE = 'تعداد وارد شده معتبر نیست.'
+
+def form_quantity():
+    # The posted quantity, None if it is not a whole number
+    try:
+        return int(request.form.get('quantity', 1))
+    except (TypeError, ValueError):
+        return None
 
 @app.route('/add_to_cart/<int:product_id>', methods=['POST'])
 def add_to_cart(product_id):
-    quantity = int(request.form.get('quantity', 1))
+    quantity = form_quantity()
     size = request.form.get('size', '')
     color = request.form.get('color', '')
+    if quantity is None or quantity < 1:
+        flash(INVALID_QUANTITY_MESSAGE, 'danger')
+        return redirect(request.referrer or url_for('index'))
     
-    cart = session.get('cart', [])
-    
-    # Check if same product with same size and color exists
-    existing_item = next((item for item in cart 
-                         if item['product_id'] == product_id 
-                         and item.get('size') == size 
-                         and item.get('color') == color), None)
-    
-    if existing_item:
-        existing_item['quantity'] += quantity
-    else:
-        cart.append({
-            'product_id': product_id, 
-            'quantity': quantity,
-            'size': size,
-            'color': color
-        })
+    # Same product with same size and color adds to the existing line
+    cart_store.add(session_cart_id(create=True), product_id, size, color, quantity)
     
-    session['cart'] = cart
     flash('محصول به سبد خرید اضافه شد!', 'success')
     return redirect(request.referrer or url_for('index'))
 
 @app.route('/update_cart/<int:product_id>', methods=['POST'])
 def update_cart(product_id):
-    quantity = int(request.form.get('quantity', 1))
-    cart = session.get('cart', [])
+    quantity = form_quantity()
+    # Forms that send size and color update exactly that line
+    size = request.form.get('size')
+    color = request.form.get('color')
+    if quantity is None:
+        flash(INVALID_QUANTITY_MESSAGE, 'danger')
+        return redirect(url_for('cart'))
     
-    for item in cart:
-        if item['product_id'] == product_id:
-            if quantity > 0:
-                item['quantity'] = quantity
-            else:
-                cart.remove(item)
-            break
+    # A quantity of zero or less removes the line
+    cart_id = session_cart_id()
+    if cart_id:
+        cart_store.update(cart_id, product_id, quantity, size, color)
     
-    session['cart'] = cart
     flash('سبد خرید بروزرسانی شد!', 'success')
     return redirect(url_for('cart'))
 
 @app.route('/remove_from_cart/<int:product_id>')
 def remove_from_cart(product_id):
-    cart = session.get('cart', [])
-    cart = [item for item in cart if item['product_id'] != product_id]
-    session['cart'] = cart
+    cart_id = session_cart_id()
+    if cart_id:
+        cart_store.remove(cart_id, product_id)
     flash('محصول از سبد خرید حذف شد.', 'info')
     return redirect(url_for('cart'))
 
 @app.route('/clear_cart')
 def clear_cart():
-    session['cart'] = []
+    cart_id = session_cart_id()
+    if cart_id:
+        cart_store.clear(cart_id)
     flash('سبد خرید خالی شد.', 'info')
     return redirect(url_for('cart'))
 
+@app.route('/checkout', methods=['GET', 'POST'])
+@login_required
+def checkout():
+    quote = cart_quote(session_cart_items())
+    if not quote.lines:
+        flash('سبد خرید شما خالی است.', 'warning')
+        return redirect(url_for('cart'))
+    if not quote.ok:
+        flash('برخی از محصولات سبد خرید موجود نیستند یا موجودی کافی ندارند.', 'danger')
+        return redirect(url_for('cart'))
+    
+    if request.method == 'POST':
+        details = {
+            'name': request.form.get('name'),
+            'phone': request.form.get('phone'),
+            'address': request.form.get('address')
+        }
+        
+        if not details['phone'] or not details['address']:
+            flash('لطفاً شماره تماس و آدرس را وارد کنید.', 'danger')
+            return render_template('checkout.html', cart_items=quote.lines, total=quote.total)
+        
+        try:
+            order = checkout_service.place(quote, details, session['user_id'], get_jalali_datetime())
+        except OutOfStock:
+            flash('متأسفانه موجودی برخی از محصولات در همین فاصله تمام شد.', 'danger')
+            return redirect(url_for('cart'))
+        
+        # The order holds the items now; left in the cart, a second
+        # checkout would reserve the same stock again
+        cart_id = session.get('cart_id')
+        if cart_id:
+            cart_store.clear(cart_id)
+        flash('موجودی سفارش شما تا %d دقیقه برایتان نگه داشته می‌شود.' % (RESERVATION_TTL // 60), 'info')
+        return redirect(url_for('order_detail', order_id=order['id']))
+    
+    return render_template('checkout.html', cart_items=quote.lines, total=quote.total)
+
+def user_order(order_id):
+    # The order, if the logged-in user may see it
+    order = order_log.get(order_id)
+    if order is None or (order['user_id'] != session.get('user_id') and not session.get('is_admin')):
+        return None
+    return order
+
+@app.route('/orders')
+@login_required
+def orders():
+    return render_template('orders.html', orders=order_log.for_user(session['user_id']))
+
+@app.route('/orders/<int:order_id>')
+@login_required
+def order_detail(order_id):
+    order = user_order(order_id)
+    if not order:
+        flash('سفارش یافت نشد.', 'danger')
+        return redirect(url_for('orders'))
+    return render_template('order.html', order=order)
+
+@app.route('/orders/<int:order_id>/confirm', methods=['POST'])
+@login_required
+def confirm_order(order_id):
+    if not user_order(order_id):
+        flash('سفارش یافت نشد.', 'danger')
+        return redirect(url_for('orders'))
+    
+    if checkout_service.confirm(order_id):
+        flash('سفارش شما با موفقیت ثبت شد!', 'success')
+    else:
+        flash('مهلت این سفارش به پایان رسیده است. لطفاً دوباره اقدام کنید.', 'danger')
+    return redirect(url_for('order_detail', order_id=order_id))
+
+@app.route('/orders/<int:order_id>/cancel', methods=['POST'])
+@login_required
+def cancel_order(order_id):
+    if user_order(order_id) and checkout_service.cancel(order_id):
+        flash('سفارش لغو شد.', 'info')
+    else:
+        flash('این سفارش قابل لغو نیست.', 'danger')
+    return redirect(url_for('orders'))
+
+# JSON API
+# Computed fields an API client may select besides the stored product fields
+API_COMPUTED_FIELDS = ('final_price', 'discount_active')
+
+def json_body(payload):
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def json_response(payload, status=200):
+    return app.response_class(json_body(payload), status=status, mimetype='application/json')
+
+def api_fields():
+    # ?fields=id,name,price -> ['id', 'name', 'price']; None means all fields
+    fields = request.args.get('fields', '')
+    return [f.strip() for f in fields.split(',') if f.strip()] or None
+
+def api_product(product, fields=None):
+    price = get_discounted_price(product)
+    data = dict(product)
+    data['final_price'] = price or product['price']
+    data['discount_active'] = price is not None
+    if fields:
+        data = {field: data[field] for field in fields if field in data}
+    return data
+
+@app.route('/api/products')
+@cached_api
+def api_products():
+    products = load_products()
+    listing = list_products(products, products.indexes['orders'], facets=products.indexes['facets'],
+                            **listing_args(request.args, PRODUCTS_PER_PAGE))
+    fields = api_fields()
+    response = {
+        'products': [api_product(p, fields) for p in listing.products],
+        'page': listing.page,
+        'limit': listing.limit,
+        'next_cursor': listing.next_cursor,
+        'total': listing.total
+    }
+    if request.args.get('facets') == '1':
+        response['facets'] = products.indexes['facets'].counts(listing.filters)
+    return json_response(response)
+
+@app.route('/api/products/<int:product_id>')
+@cached_api
+def api_product_detail(product_id):
+    product = load_products().get(product_id)
+    if not product:
+        return json_response({'error': 'محصول یافت نشد.'}, 404)
+    return json_response(api_product(product, api_fields()))
+
+@app.route('/api/cart')
+def api_cart():
+    quote = cart_quote(session_cart_items())
+    products = load_products()
+    fields = api_fields()
+    items = []
+    for line in quote.lines:
+        # The catalog product, not the priced line, which repeats the
+        # quantity, size, color and subtotal given next to it
+        product = products.get(line['id'])
+        if product is None:
+            continue  # deleted since the cart was priced
+        items.append({
+            'product': api_product(product, fields),
+            'quantity': line['quantity'],
+            'size': line['selected_size'],
+            'color': line['selected_color'],
+            'final_price': line['final_price'],
+            'subtotal': line['subtotal'],
+            'problems': line['problems']
+        })
+    return conditional_response(json_body({'items': items, 'total': quote.total, 'ok': quote.ok}), 'application/json')
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if 'user_id' in session:
@@ -387,11 +909,30 @@ def login():
     if request.method == 'POST':
         email = request.form.get('email')
         password = request.form.get('password')
+        throttle_key = normalize_email(email)
         
-        users = load_users()
-        user = next((u for u in users if u['email'] == email), None)
+        # Bursts are turned away before they cost a password hash
+        if not login_throttle.attempt(request.remote_addr, throttle_key):
+            flash(THROTTLED_MESSAGE, 'danger')
+            return render_template('login.html'), 429
+        
+        user = load_users().by_email(email)
+        
+        try:
+            valid = user is not None and password_hasher.verify(user['password'], password)
+        except PasswordPoolBusy:
+            flash(PASSWORD_BUSY_MESSAGE, 'warning')
+            return render_template('login.html'), 503
         
-        if user and check_password_hash(user['password'], password):
+        if valid:
+            login_throttle.succeeded(throttle_key)
+            # Upgrade hashes made with an older method or cost while we
+            # have the password; if that fails it is retried next login
+            if password_hasher.needs_rehash(user['password']):
+                try:
+                    update_user(dict(user, password=password_hasher.hash(password)))
+                except (PasswordPoolBusy, Duplicate):
+                    pass
             session['user_id'] = user['id']
             session['username'] = user['username']
             session['is_admin'] = user.get('is_admin', False)
@@ -401,6 +942,7 @@ def login():
                 return redirect(url_for('admin_dashboard'))
             return redirect(url_for('index'))
         else:
+            login_throttle.failed(throttle_key)
             flash('ایمیل یا رمز عبور اشتباه است.', 'danger')
     
     return render_template('login.html')
@@ -421,28 +963,43 @@ def register():
             flash('رمز عبور و تکرار آن مطابقت ندارند.', 'danger')
             return render_template('register.html')
         
+        if not login_throttle.attempt(request.remote_addr):
+            flash(THROTTLED_MESSAGE, 'danger')
+            return render_template('register.html'), 429
+        
+        # Quick checks before paying for the password hash; add_user
+        # enforces them for real
         users = load_users()
         
-        if any(u['email'] == email for u in users):
-            flash('این ایمیل قبلاً ثبت شده است.', 'danger')
+        if users.by_email(email):
+            flash(DUPLICATE_USER_MESSAGES['email'], 'danger')
             return render_template('register.html')
         
-        if any(u['username'] == username for u in users):
-            flash('این نام کاربری قبلاً انتخاب شده است.', 'danger')
+        if users.by_username(username):
+            flash(DUPLICATE_USER_MESSAGES['username'], 'danger')
             return render_template('register.html')
         
+        try:
+            password_hash = password_hasher.hash(password)
+        except PasswordPoolBusy:
+            flash(PASSWORD_BUSY_MESSAGE, 'warning')
+            return render_template('register.html'), 503
+        
         new_user = {
-            'id': max([u['id'] for u in users], default=0) + 1,
+            'id': None,
             'username': username,
             'email': email,
             'phone': phone,
-            'password': generate_password_hash(password),
+            'password': password_hash,
             'is_admin': False,
             'created_at': get_jalali_datetime()
         }
         
-        users.append(new_user)
-        save_users(users)
+        try:
+            add_user(new_user)
+        except Duplicate as e:
+            flash(DUPLICATE_USER_MESSAGES[e.fields[0]], 'danger')
+            return render_template('register.html')
         
         flash('ثبت نام با موفقیت انجام شد! لطفاً وارد شوید.', 'success')
         return redirect(url_for('login'))
@@ -451,6 +1008,9 @@ def register():
 
 @app.route('/logout')
 def logout():
+    cart_id = session.get('cart_id')
+    if cart_id:
+        cart_store.clear(cart_id)
     session.clear()
     flash('با موفقیت خارج شدید.', 'info')
     return redirect(url_for('index'))
@@ -465,27 +1025,35 @@ def admin_dashboard():
     # Count statistics
     total_products = len(products)
     total_users = len([u for u in users if not u.get('is_admin')])
-    discounted_products = len([p for p in products if is_discount_active(p)])
+    schedule = products.indexes['discounts']
+    discounted_products = len(schedule.active_on())
+    starting_soon = [products.get(i) for i in schedule.starting_within(7)]
+    expiring_today = [products.get(i) for i in schedule.expiring_on()]
     
     return render_template('admin_dashboard.html', 
                          products=products, 
                          users=users,
                          total_products=total_products,
                          total_users=total_users,
-                         discounted_products=discounted_products)
+                         discounted_products=discounted_products,
+                         starting_soon=starting_soon,
+                         expiring_today=expiring_today,
+                         catalog_stats=catalog.stats(),
+                         password_pool_stats=password_hasher.stats(),
+                         page_cache_stats=page_cache.stats())
 
 @app.route('/admin/products')
 @admin_required
 def admin_products():
     products = load_products()
-    return render_template('admin_products.html', products=products)
+    listing = list_products(products, products.indexes['orders'], facets=products.indexes['facets'],
+                            **listing_args(request.args, ADMIN_PRODUCTS_PER_PAGE))
+    return render_template('admin_products.html', products=listing.products, listing=listing)
 
 @app.route('/admin/add_product', methods=['GET', 'POST'])
 @admin_required
 def admin_add_product():
     if request.method == 'POST':
-        products = load_products()
-        
         # Get sizes and colors as lists
         sizes = request.form.getlist('sizes[]')
         colors = request.form.getlist('colors[]')
@@ -501,8 +1069,14 @@ def admin_add_product():
             discount_start = request.form.get('discount_start', '')
             discount_end = request.form.get('discount_end', '')
         
+        try:
+            image_file = uploaded_image()
+        except InvalidImage:
+            flash(INVALID_IMAGE_MESSAGE, 'danger')
+            return render_template('admin_add_product.html', today=get_jalali_date())
+        
         new_product = {
-            'id': max([p['id'] for p in products], default=0) + 1,
+            'id': None,
             'name': request.form.get('name'),
             'price': int(request.form.get('price')),
             'category': request.form.get('category'),
@@ -518,9 +1092,10 @@ def admin_add_product():
             'discount_end': discount_end,
             'created_at': get_jalali_date()
         }
+        if image_file:
+            new_product['image_file'] = image_file
         
-        products.append(new_product)
-        save_products(products)
+        add_product(new_product)
         
         flash('محصول با موفقیت اضافه شد!', 'success')
         return redirect(url_for('admin_products'))
@@ -530,8 +1105,7 @@ def admin_add_product():
 @app.route('/admin/edit_product/<int:product_id>', methods=['GET', 'POST'])
 @admin_required
 def admin_edit_product(product_id):
-    products = load_products()
-    product = next((p for p in products if p['id'] == product_id), None)
+    product = load_products().get(product_id)
     
     if not product:
         flash('محصول یافت نشد.', 'danger')
@@ -553,6 +1127,14 @@ def admin_edit_product(product_id):
             discount_start = request.form.get('discount_start', '')
             discount_end = request.form.get('discount_end', '')
         
+        try:
+            image_file = uploaded_image()
+        except InvalidImage:
+            flash(INVALID_IMAGE_MESSAGE, 'danger')
+            return render_template('admin_add_product.html', product=product, editing=True, today=get_jalali_date())
+        
+        # Edit a copy so the cached catalog is never half-updated
+        product = dict(product)
         product['name'] = request.form.get('name')
         product['price'] = int(request.form.get('price'))
         product['category'] = request.form.get('category')
@@ -566,8 +1148,12 @@ def admin_edit_product(product_id):
         product['discount_percent'] = discount_percent
         product['discount_start'] = discount_start
         product['discount_end'] = discount_end
+        if image_file:
+            product['image_file'] = image_file
+        elif request.form.get('remove_image_file') == 'on':
+            product.pop('image_file', None)
         
-        save_products(products)
+        update_product(product)
         flash('محصول با موفقیت ویرایش شد!', 'success')
         return redirect(url_for('admin_products'))
     
@@ -576,12 +1162,116 @@ def admin_edit_product(product_id):
 @app.route('/admin/delete_product/<int:product_id>')
 @admin_required
 def admin_delete_product(product_id):
-    products = load_products()
-    products = [p for p in products if p['id'] != product_id]
-    save_products(products)
+    delete_product(product_id)
     flash('محصول با موفقیت حذف شد!', 'success')
     return redirect(url_for('admin_products'))
 
+@app.route('/admin/products/bulk', methods=['POST'])
+@admin_required
+def admin_bulk_products():
+    # One change applied to the checked products (ids[]) or to a whole
+    # category and/or age group, as a single storage write
+    action = request.form.get('action')
+    ids = [int(i) for i in request.form.getlist('ids[]') if i.isdigit()]
+    category = request.form.get('category')
+    age_group = request.form.get('age_group')
+    if not ids and not is_filter(category) and not is_filter(age_group):
+        flash('هیچ محصولی انتخاب نشده است.', 'warning')
+        return redirect(url_for('admin_products'))
+    if action == 'delete' and not ids and request.form.get('confirm_delete') != '1':
+        # Deleting a whole category or age group takes an explicit yes
+        flash('برای حذف گروهی محصولات، حذف را تأیید کنید.', 'warning')
+        return redirect(url_for('admin_products'))
+    pick = lambda products: select(products, ids, category, age_group)
+    try:
+        if action == 'discount':
+            change = discount_change(request.form.get('discount_percent', 0),
+                                     request.form.get('discount_start', ''), request.form.get('discount_end', ''))
+            entries = modify_products(lambda products: updated_entries(products, pick(products), change))
+        elif action == 'price':
+            change = price_change(request.form.get('price_percent', 0))
+            entries = modify_products(lambda products: updated_entries(products, pick(products), change))
+        elif action == 'stock':
+            delta = parse_delta(request.form.get('stock_delta', 0))
+            entries = modify_products(lambda products: stock_entries(products, pick(products), delta))
+        elif action == 'delete':
+            entries = modify_products(lambda products: deleted_entries(products, pick(products)))
+        else:
+            flash('عملیات نامعتبر است.', 'danger')
+            return redirect(url_for('admin_products'))
+    except InvalidField as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('admin_products'))
+    except OutOfStock as e:
+        flash('موجودی این محصولات کمتر از صفر می‌شود: %s' % ', '.join(map(str, e.product_ids)), 'danger')
+        return redirect(url_for('admin_products'))
+    if action == 'delete':
+        flash('%d محصول حذف شد.' % len(entries), 'success')
+    else:
+        flash('%d محصول به‌روزرسانی شد.' % len(entries), 'success')
+    return redirect(url_for('admin_products'))
+
+@app.route('/admin/products/import', methods=['POST'])
+@admin_required
+def admin_import_products():
+    # CSV, JSONL or JSON array upload; werkzeug spools large files to disk
+    # and CSV and JSONL rows are read from there one at a time
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        flash('فایلی انتخاب نشده است.', 'warning')
+        return redirect(url_for('admin_products'))
+    try:
+        report = import_product_file(upload.stream, request.form.get('format') or guess_format(upload.filename))
+    except InvalidField as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('admin_products'))
+    flash('%d محصول اضافه و %d محصول به‌روزرسانی شد.' % (report.inserted, report.updated), 'success')
+    if report.failed:
+        details = '؛ '.join('سطر %d: %s' % error for error in report.errors[:5])
+        flash('%d ردیف نامعتبر بود و وارد نشد. %s' % (report.failed, details), 'warning')
+    return redirect(url_for('admin_products'))
+
+@app.route('/admin/products/export')
+@admin_required
+def admin_export_products():
+    # Streamed from the cached catalog, a chunk of rows at a time
+    fmt = 'jsonl' if request.args.get('format') == 'jsonl' else 'csv'
+    filename = 'products-%s.%s' % (get_jalali_date().replace('/', '-'), fmt)
+    mimetype = 'application/x-ndjson' if fmt == 'jsonl' else 'text/csv'
+    return app.response_class(export_products(load_products(), fmt), mimetype=mimetype,
+                              headers={'Content-Disposition': 'attachment; filename=%s' % filename})
+
+@app.route('/admin/orders')
+@admin_required
+def admin_orders():
+    return render_template('admin_orders.html', orders=order_log.all())
+
+def metrics_text():
+    if metrics is None:
+        return app.response_class('metrics are disabled (KOODAK_METRICS=1)\n', 404, content_type='text/plain')
+    return app.response_class(metrics.prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@admin_required
+def admin_metrics_page():
+    if request.args.get('format') == 'prometheus':
+        return metrics_text()
+    return render_template('admin_metrics.html', metrics=metrics.snapshot() if metrics else None,
+                           page_cache_stats=page_cache.stats(),
+                           catalog_stats=catalog.stats(),
+                           image_stats=image_store.stats(),
+                           scheduler_stats=day_scheduler.stats(),
+                           password_pool_stats=password_hasher.stats())
+
+@app.route('/admin/metrics')
+def admin_metrics():
+    # Prometheus sends "Authorization: Bearer <KOODAK_METRICS_TOKEN>"; compared
+    # as bytes, compare_digest rejects non-ASCII str
+    authorization = request.headers.get('Authorization', '')
+    if METRICS_TOKEN and hmac.compare_digest(authorization.encode('utf-8'),
+                                               ('Bearer ' + METRICS_TOKEN).encode('utf-8')):
+        return metrics_text()
+    return admin_metrics_page()
+
 # User management routes
 @app.route('/admin/users')
 @admin_required
@@ -594,8 +1284,7 @@ def admin_users():
 @app.route('/admin/edit_user/<int:user_id>', methods=['GET', 'POST'])
 @admin_required
 def admin_edit_user(user_id):
-    users = load_users()
-    user = next((u for u in users if u['id'] == user_id), None)
+    user = load_users().get(user_id)
     
     if not user:
         flash('کاربر یافت نشد.', 'danger')
@@ -607,19 +1296,25 @@ def admin_edit_user(user_id):
         new_phone = request.form.get('phone')
         new_password = request.form.get('password')
         
-        # Check for duplicate email (excluding current user)
-        if any(u['email'] == new_email and u['id'] != user_id for u in users):
-            flash('این ایمیل قبلاً ثبت شده است.', 'danger')
-            return render_template('admin_edit_user.html', user=user)
-        
-        user['username'] = new_username
-        user['email'] = new_email
-        user['phone'] = new_phone
+        # Edit a copy so the cached users are never half-updated
+        edited = dict(user)
+        edited['username'] = new_username
+        edited['email'] = new_email
+        edited['phone'] = new_phone
         
         if new_password:
-            user['password'] = generate_password_hash(new_password)
+            try:
+                edited['password'] = password_hasher.hash(new_password)
+            except PasswordPoolBusy:
+                flash(PASSWORD_BUSY_MESSAGE, 'warning')
+                return render_template('admin_edit_user.html', user=user), 503
         
-        save_users(users)
+        # Email, username and phone must stay unique (excluding this user)
+        try:
+            update_user(edited)
+        except Duplicate as e:
+            flash(DUPLICATE_USER_MESSAGES[e.fields[0]], 'danger')
+            return render_template('admin_edit_user.html', user=user)
         flash('اطلاعات کاربر با موفقیت ویرایش شد!', 'success')
         return redirect(url_for('admin_users'))
     
@@ -628,17 +1323,58 @@ def admin_edit_user(user_id):
 @app.route('/admin/delete_user/<int:user_id>')
 @admin_required
 def admin_delete_user(user_id):
-    users = load_users()
-    user = next((u for u in users if u['id'] == user_id), None)
+    user = load_users().get(user_id)
     
     if user and user.get('is_admin'):
         flash('امکان حذف حساب ادمین وجود ندارد.', 'danger')
         return redirect(url_for('admin_users'))
     
-    users = [u for u in users if u['id'] != user_id]
-    save_users(users)
+    delete_user(user_id)
     flash('کاربر با موفقیت حذف شد!', 'success')
     return redirect(url_for('admin_users'))
 
+# CLI: flask --app app import-json [--source data]
+@app.cli.command('import-json')
+@click.option('--source', default=None, help='Directory holding products.json and users.json')
+def import_json_command(source):
+    """Import data/*.json into the SQLite database."""
+    open_data()
+    target = storage if isinstance(storage, SqliteStorage) else create_storage('sqlite', DATA_DIR)
+    counts = import_json(JsonStorage(source or DATA_DIR), target)
+    for kind, count in counts.items():
+        click.echo('%s: %d records imported into %s' % (kind, count, target.path))
+    catalog.invalidate()
+    users_store.invalidate()
+
+# CLI: flask --app app import-products products.csv
+@app.cli.command('import-products')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl', 'json']), default=None, help='Default: from the extension')
+def import_products_command(path, fmt):
+    """Import products from a CSV, JSONL or JSON file."""
+    open_data()
+    with open(path, 'rb') as f:
+        try:
+            report = import_product_file(f, fmt or guess_format(path))
+        except InvalidField as e:
+            raise click.ClickException(str(e))
+    for line, message in report.errors:
+        click.echo('line %d: %s' % (line, message), err=True)
+    click.echo('%d inserted, %d updated, %d rejected' % (report.inserted, report.updated, report.failed))
+
+# CLI: flask --app app export-products products.csv
+@app.cli.command('export-products')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl', 'json']), default=None, help='Default: from the extension')
+def export_products_command(path, fmt):
+    """Export products to a CSV, JSONL or JSON file."""
+    open_data()
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        for chunk in export_products(load_products(), fmt or guess_format(path)):
+            f.write(chunk)
+
+# ASGI entry point: uvicorn app:asgi_app --workers 4
+asgi_app = AsgiAdapter(app, ASGI_THREADS, startup=create_app)
+
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
@@ -0,0 +1,183 @@
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Request bodies up to this size stay in memory; larger ones (product
+# imports, image uploads) are spooled to a temporary file
+SPOOL_BYTES = 1024 * 1024
+
+
+class AsgiAdapter:
+    # ASGI application running a WSGI app (the Flask app) for an ASGI
+    # server such as uvicorn. The server's event loop owns the connections,
+    # so an idle keep-alive connection costs a socket rather than a thread;
+    # only requests being handled take one of the `threads` pool threads,
+    # and the rest wait on the loop for a free one. Views keep blocking
+    # freely there: catalog and users are served from memory, and password
+    # hashing waits on its own pool (passwords.PasswordHasher).
+    #
+    # Response bodies are passed on as the WSGI app yields them, so
+    # streamed exports are not held in memory; a slow client holds the
+    # thread that is streaming to it. `startup`, if given, runs on the pool
+    # when the server starts (ASGI lifespan), before requests are accepted.
+
+    def __init__(self, wsgi_app, threads=16, startup=None):
+        self.wsgi_app = wsgi_app
+        self.threads = threads
+        self.startup = startup
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.active = 0
+        self.peak_active = 0
+        self.requests = 0
+        self.errors = 0
+
+    def _pool(self):
+        # Created on first use and again after a fork (see PasswordHasher)
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='asgi')
+            self._pid = os.getpid()
+        return self._executor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if self.startup is not None:
+                    try:
+                        await asyncio.get_running_loop().run_in_executor(self._pool(), self.startup)
+                    except Exception as e:
+                        await send({'type': 'lifespan.startup.failed', 'message': repr(e)})
+                        return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                    self._executor = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        body = tempfile.SpooledTemporaryFile(SPOOL_BYTES)
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body.write(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            length = body.tell()
+            body.seek(0)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._pool(), self._run, environ(scope, body, length), send, loop)
+        finally:
+            body.close()
+
+    def _run(self, environ, send, loop):
+        # Pool thread: calls the WSGI app and hands each message to the
+        # event loop, waiting until it was sent (backpressure)
+        def emit(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        with self._lock:
+            self.active += 1
+            self.requests += 1
+            self.peak_active = max(self.peak_active, self.active)
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+            return lambda data: send_body(data, True)
+
+        def send_body(data, more):
+            if not response.get('sent'):
+                emit({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+                response['sent'] = True
+            if data or not more:
+                emit({'type': 'http.response.body', 'body': bytes(data), 'more_body': more})
+
+        try:
+            result = self.wsgi_app(environ, start_response)
+            try:
+                for data in result:
+                    if data:
+                        send_body(data, True)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+            send_body(b'', False)
+        except:
+            with self._lock:
+                self.errors += 1
+            if response.get('sent'):
+                # Headers are out; all we can do is drop the connection
+                raise
+            response.update(status=500, headers=[(b'content-type', b'text/plain; charset=utf-8')])
+            send_body(b'Internal Server Error', False)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'threads': self.threads,
+                'active': self.active,
+                'peak_active': self.peak_active,
+                'requests': self.requests,
+                'errors': self.errors
+            }
+
+
+def environ(scope, body, length):
+    # WSGI environ (PEP 3333) for an ASGI http scope; `body` is a file
+    # positioned at the start of the `length` byte request body
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]) if server[1] is not None else '80',
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(length),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'asgi.scope': scope
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1')
+        value = value.decode('latin-1')
+        if name == 'content-length':
+            continue
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        if key in environ:
+            value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+        environ[key] = value
+    return environ
@@ -0,0 +1,293 @@
+# Storefront and admin load test.
+#
+# For each catalog size, generates a synthetic shop (products with Persian
+# names and descriptions, discount windows around today, a user base) in a
+# throwaway data directory, imports the app against it in a fresh process
+# and drives it through Flask's test client: the home page with a category
+# filter (as a logged-in visitor, so the page cache does not answer, and
+# anonymously), product pages, a large cart, login, registration and adding
+# products in the admin. Reports throughput and p50/p99 latency per flow
+# and writes everything to a JSON file; --compare checks a run against an
+# earlier file and exits 1 on regressions.
+#
+#   python benchmarks/bench_app.py --sizes 1000,10000,100000 --out results.json
+#   python benchmarks/bench_app.py --sizes 10000 --compare results.json
+#
+# Templates are the app's own; --templates points at another folder.
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CATEGORIES = ('girls', 'boys', 'baby')
+AGE_GROUPS = ('0-12 ماه', '1-3 سال', '3-5 سال', '5-8 سال', '8-12 سال')
+SIZES = ('2-3 سال', '3-4 سال', '4-5 سال', '5-6 سال', '6-7 سال')
+COLORS = ('صورتی', 'سفید', 'آبی', 'قرمز', 'زرد', 'سبز', 'مشکی', 'بنفش')
+NOUNS = ('پیراهن', 'شلوار', 'کاپشن', 'تی‌شرت', 'سارافون', 'سرهمی', 'جوراب', 'کلاه', 'دامن', 'هودی')
+ADJECTIVES = ('گلدار', 'راه‌راه', 'نخی', 'پشمی', 'جین', 'مخمل', 'ساده', 'طرح‌دار', 'زمستانی', 'تابستانی')
+WORDS = ('نرم', 'راحت', 'باکیفیت', 'شاد', 'رنگارنگ', 'مناسب', 'مهمانی', 'روزمره', 'بازی', 'مدرسه', 'پنبه', 'دوخت')
+
+PASSWORD = 'Bench_Password_1'
+
+FLOWS = ('index_category', 'index_category_cached', 'product_detail', 'cart', 'login', 'register', 'admin_add_product')
+
+
+def synthetic_products(count, rng):
+    import jdatetime
+    today = jdatetime.date.today()
+    products = []
+    for i in range(1, count + 1):
+        has_discount = rng.random() < 0.3
+        start = today + jdatetime.timedelta(days=rng.randint(-20, 5))
+        end = start + jdatetime.timedelta(days=rng.randint(0, 30))
+        products.append({
+            'id': i,
+            'name': '%s %s %s' % (rng.choice(NOUNS), rng.choice(ADJECTIVES), rng.choice(COLORS)),
+            'price': rng.randint(10, 500) * 10000,
+            'category': rng.choice(CATEGORIES),
+            'age_group': rng.choice(AGE_GROUPS),
+            'sizes': rng.sample(SIZES, rng.randint(1, 4)),
+            'colors': rng.sample(COLORS, rng.randint(1, 3)),
+            'description': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(8, 20))),
+            'image': 'https://images.unsplash.com/photo-1518831959646-742c3a14ebf7?w=400',
+            'stock': rng.randint(0, 50),
+            'has_discount': has_discount,
+            'discount_percent': rng.choice((10, 15, 20, 30, 50)) if has_discount else 0,
+            'discount_start': start.strftime('%Y/%m/%d') if has_discount else '',
+            'discount_end': end.strftime('%Y/%m/%d') if has_discount else '',
+            'created_at': (today - jdatetime.timedelta(days=rng.randint(0, 700))).strftime('%Y/%m/%d')
+        })
+    return products
+
+
+def synthetic_users(count, password_hash):
+    users = [{
+        'id': 1,
+        'username': 'ادمین',
+        'email': 'admin@bench.example',
+        'password': password_hash,
+        'phone': '09120000000',
+        'is_admin': True,
+        'created_at': '1403/09/01 - 10:00'
+    }]
+    for i in range(2, count + 1):
+        users.append({
+            'id': i,
+            'username': 'کاربر%d' % i,
+            'email': 'user%d@bench.example' % i,
+            'password': password_hash,
+            'phone': '0912%07d' % i,
+            'is_admin': False,
+            'created_at': '1403/09/01 - 10:00'
+        })
+    return users
+
+
+def summarize(latencies, elapsed, errors):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    }
+
+
+def run_size(size, args):
+    # Runs in its own process: the app reads its configuration at import
+    rng = random.Random(args.seed)
+    data_dir = tempfile.mkdtemp(prefix='koodak-bench-')
+    try:
+        os.environ['KOODAK_DATA_DIR'] = data_dir
+        os.environ['KOODAK_STORAGE'] = args.backend
+        os.environ.setdefault('KOODAK_LOGIN_IP_LIMIT', str(10 ** 9))
+        os.environ.setdefault('KOODAK_LOGIN_EMAIL_LIMIT', str(10 ** 9))
+        if args.password_method:
+            os.environ['KOODAK_PASSWORD_METHOD'] = args.password_method
+
+        from werkzeug.security import generate_password_hash
+        from storage import create_storage
+        method = args.password_method or os.environ.get('KOODAK_PASSWORD_METHOD', 'scrypt')
+        storage = create_storage(args.backend, data_dir)
+        storage.save('products', synthetic_products(size, rng))
+        storage.save('users', synthetic_users(args.users, generate_password_hash(PASSWORD, method)))
+
+        started = time.perf_counter()
+        import app as shop
+        if args.templates:
+            shop.app.template_folder = os.path.abspath(args.templates)
+        shop.app.testing = True
+        shop.create_app()
+        startup = time.perf_counter() - started
+
+        def client(user_id=None, is_admin=False):
+            c = shop.app.test_client()
+            if user_id is not None:
+                with c.session_transaction() as session:
+                    session['user_id'] = user_id
+                    session['username'] = 'bench'
+                    session['is_admin'] = is_admin
+            return c
+
+        visitor = client(2)
+        anonymous = client()
+        admin = client(1, is_admin=True)
+        big_cart = client(3)
+        with big_cart.session_transaction() as session:
+            session['cart_id'] = 'bench-cart'
+        for product_id in rng.sample(range(1, size + 1), min(args.cart_lines, size)):
+            shop.cart_store.add('bench-cart', product_id, '', '', rng.randint(1, 3))
+        registrations = iter(range(args.users + 1, args.users + 10 ** 7))
+
+        def request(name, i):
+            if name == 'index_category':
+                return visitor.get('/?category=%s&page=%d' % (CATEGORIES[i % 3], 1 + i % 5))
+            if name == 'index_category_cached':
+                return anonymous.get('/?category=%s&page=%d' % (CATEGORIES[i % 3], 1 + i % 5))
+            if name == 'product_detail':
+                return anonymous.get('/product/%d' % rng.randint(1, size))
+            if name == 'cart':
+                return big_cart.get('/cart')
+            if name == 'login':
+                user_id = rng.randint(2, args.users)
+                return client().post('/login', data={'email': 'user%d@bench.example' % user_id, 'password': PASSWORD},
+                                     environ_base={'REMOTE_ADDR': '10.0.%d.%d' % (i // 250 % 250, i % 250)})
+            if name == 'register':
+                n = next(registrations)
+                return client().post('/register', data={
+                    'username': 'new%d' % n, 'email': 'new%d@bench.example' % n, 'phone': '0935%07d' % n,
+                    'password': PASSWORD, 'confirm_password': PASSWORD},
+                    environ_base={'REMOTE_ADDR': '10.1.%d.%d' % (i // 250 % 250, i % 250)})
+            if name == 'admin_add_product':
+                return admin.post('/admin/add_product', data={
+                    'name': 'محصول جدید %d' % i, 'price': '250000', 'category': CATEGORIES[i % 3],
+                    'age_group': AGE_GROUPS[0], 'sizes[]': list(SIZES[:2]), 'colors[]': list(COLORS[:2]),
+                    'description': 'توضیحات', 'image': '', 'stock': '10'})
+            raise ValueError(name)
+
+        results = {}
+        for name in args.flows:
+            requests = args.requests
+            if name in ('login', 'register'):
+                requests = min(requests, args.auth_requests)
+            for i in range(min(args.warmup, requests)):
+                request(name, i)
+            latencies = []
+            errors = 0
+            flow_started = time.perf_counter()
+            for i in range(requests):
+                t = time.perf_counter()
+                response = request(name, i)
+                latencies.append(time.perf_counter() - t)
+                if response.status_code >= 400:
+                    errors += 1
+            results[name] = summarize(latencies, time.perf_counter() - flow_started, errors)
+        return {'startup_s': startup, 'flows': results}
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, baseline, threshold):
+    # Flows whose p50 or throughput got worse by more than `threshold`
+    regressions = []
+    for size, result in current['results'].items():
+        old = baseline.get('results', {}).get(size)
+        if old is None:
+            continue
+        for name, flow in result['flows'].items():
+            before = old['flows'].get(name)
+            if before is None:
+                continue
+            p50 = flow['p50_ms'] / before['p50_ms'] if before['p50_ms'] else 1.0
+            throughput = before['throughput'] / flow['throughput'] if flow['throughput'] else float('inf')
+            marker = ''
+            if p50 > 1 + threshold or throughput > 1 + threshold:
+                regressions.append((size, name))
+                marker = '  REGRESSION'
+            print('%8s %-22s p50 %8.2f -> %8.2f ms   %8.0f -> %8.0f req/s%s' % (
+                size, name, before['p50_ms'], flow['p50_ms'], before['throughput'], flow['throughput'], marker))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,10000,100000', help='catalog sizes, comma separated')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--backend', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--flows', default=','.join(FLOWS))
+    parser.add_argument('--requests', type=int, default=500, help='requests per flow')
+    parser.add_argument('--auth-requests', type=int, default=50, help='requests for login and register (password hashing)')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--cart-lines', type=int, default=100)
+    parser.add_argument('--password-method', default=None, help='KOODAK_PASSWORD_METHOD for the run')
+    parser.add_argument('--templates', default=None, help='template folder to render with')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', default=None, help='write results to this JSON file')
+    parser.add_argument('--compare', default=None, help='earlier results JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown before --compare fails')
+    parser.add_argument('--single', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.flows = [f for f in args.flows.split(',') if f]
+
+    if args.single is not None:
+        json.dump(run_size(args.single, args), sys.stdout)
+        return
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {k: v for k, v in vars(args).items() if k not in ('out', 'compare', 'single')},
+        'results': {}
+    }
+    for size in [int(s) for s in args.sizes.split(',') if s]:
+        # A fresh interpreter per size, since the app configures itself at import
+        command = [sys.executable, os.path.abspath(__file__), '--single', str(size), '--users', str(args.users),
+                   '--backend', args.backend, '--flows', ','.join(args.flows), '--requests', str(args.requests),
+                   '--auth-requests', str(args.auth_requests), '--warmup', str(args.warmup),
+                   '--cart-lines', str(args.cart_lines), '--seed', str(args.seed)]
+        if args.password_method:
+            command += ['--password-method', args.password_method]
+        if args.templates:
+            command += ['--templates', args.templates]
+        output = subprocess.check_output(command, text=True)
+        result = report['results'][str(size)] = json.loads(output)
+        print('%d products (startup %.2fs)' % (size, result['startup_s']))
+        for name, flow in result['flows'].items():
+            print('  %-22s %8.0f req/s  p50 %8.2f ms  p99 %8.2f ms%s' % (
+                name, flow['throughput'], flow['p50_ms'], flow['p99_ms'],
+                '  errors=%d' % flow['errors'] if flow['errors'] else ''))
+
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print('compared with %s (commit %s)' % (args.compare, baseline.get('commit')))
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
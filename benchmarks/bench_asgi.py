@@ -0,0 +1,264 @@
+# WSGI threads against ASGI, one server process each.
+#
+# Generates a synthetic catalog, starts the app once under Werkzeug's
+# threaded WSGI server (what app.run does: a thread per connection) and
+# once under uvicorn through app.asgi_app (connections on the event loop,
+# KOODAK_ASGI_THREADS threads for the requests themselves), and drives each
+# with keep-alive HTTP/1.1 connections: storefront pages, product pages and
+# the products API, as anonymous visitors. Every connection sends its next
+# request as soon as the last one is answered, over a new connection if
+# the server closed it (Werkzeug closes every connection after one
+# response). --idle keeps that many more
+# connections open without traffic, as browsers do between page views.
+# Reports throughput, p50/p99 latency, connections opened and failed, idle
+# connections the server kept open, and the server's peak thread count and
+# peak RSS.
+#
+#   python benchmarks/bench_asgi.py --products 10000 --connections 10,100,1000 --idle 1000
+#
+# The ASGI run needs uvicorn (pip install uvicorn).
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_app import CATEGORIES, summarize, synthetic_products
+
+SERVERS = ('wsgi', 'asgi')
+
+
+def serve(args):
+    # Runs in the server process; the data directory is set up already
+    import app as shop
+    if args.templates:
+        shop.app.template_folder = os.path.abspath(args.templates)
+    shop.create_app()
+    if args.serve == 'wsgi':
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args):
+                pass
+        make_server('127.0.0.1', args.port, shop.app, threaded=True, request_handler=QuietHandler).serve_forever()
+    else:
+        import uvicorn
+        uvicorn.run(shop.asgi_app, host='127.0.0.1', port=args.port, log_level='warning', backlog=4096)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def process_stats(pid):
+    stats = {}
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key == 'Threads':
+                    stats['threads'] = int(value)
+                elif key in ('VmRSS', 'VmHWM'):
+                    stats[key.lower() + '_mb'] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return stats
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1])
+    headers = {}
+    for line in head.split(b'\r\n')[1:]:
+        if line:
+            name, _, value = line.partition(b':')
+            headers[name.strip().lower()] = value.strip()
+    if b'content-length' in headers:
+        await reader.readexactly(int(headers[b'content-length']))
+    elif headers.get(b'transfer-encoding') == b'chunked':
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if not size:
+                break
+    return status, headers.get(b'connection', b'').lower() == b'close'
+
+
+def request_bytes(path):
+    return ('GET %s HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: keep-alive\r\n\r\n' % path).encode('ascii')
+
+
+async def drive(port, pid, connections, idle, duration, paths, seed):
+    failed = 0
+    opened = 0
+    latencies = []
+    errors = 0
+
+    async def connect():
+        nonlocal failed, opened
+        opened += 1
+        try:
+            return await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), 10)
+        except (OSError, asyncio.TimeoutError):
+            failed += 1
+            return None
+
+    # Idle connections make one request and then stay open
+    parked = []
+    for _ in range(idle):
+        connection = await connect()
+        if connection is None:
+            continue
+        try:
+            connection[1].write(request_bytes('/about'))
+            status, closed = await asyncio.wait_for(read_response(connection[0]), 10)
+            if not closed:
+                parked.append(connection)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            failed += 1
+            connection[1].close()
+
+    deadline = time.perf_counter() + duration
+
+    async def client(i):
+        nonlocal errors, failed
+        rng = random.Random(seed + i)
+        connection = await connect()
+        if connection is None:
+            return
+        reader, writer = connection
+        try:
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                writer.write(request_bytes(rng.choice(paths)))
+                status, closed = await asyncio.wait_for(read_response(reader), 30)
+                if closed:
+                    writer.close()
+                    connection = await connect()
+                    if connection is None:
+                        return
+                    reader, writer = connection
+                latencies.append(time.perf_counter() - started)
+                if status >= 400:
+                    errors += 1
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            failed += 1
+        finally:
+            writer.close()
+
+    peak_threads = 0
+
+    async def sample():
+        nonlocal peak_threads
+        while True:
+            peak_threads = max(peak_threads, process_stats(pid).get('threads', 0))
+            await asyncio.sleep(0.2)
+
+    sampler = asyncio.ensure_future(sample())
+    started = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(connections)))
+    elapsed = time.perf_counter() - started
+    sampler.cancel()
+    for reader, writer in parked:
+        writer.close()
+    result = summarize(latencies, elapsed, errors) if latencies else {'requests': 0, 'errors': errors}
+    result['opened_connections'] = opened
+    result['failed_connections'] = failed
+    result['idle_connections'] = len(parked)
+    result['peak_threads'] = peak_threads
+    result['peak_rss_mb'] = process_stats(pid).get('vmhwm_mb', 0)
+    return result
+
+
+def wait_ready(port, process, timeout=600):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit('server exited with %d' % process.returncode)
+        try:
+            with socket.create_connection(('127.0.0.1', port), 1) as s:
+                s.sendall(request_bytes('/'))
+                if s.recv(12).startswith(b'HTTP/1.1'):
+                    return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit('server did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--servers', default=','.join(SERVERS))
+    parser.add_argument('--connections', default='10,100,1000', help='busy connections per run, comma separated')
+    parser.add_argument('--idle', type=int, default=0, help='extra connections kept open without traffic')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per run')
+    parser.add_argument('--asgi-threads', type=int, default=None, help='KOODAK_ASGI_THREADS for the ASGI server')
+    parser.add_argument('--templates', default=None, help='template folder to render with')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--serve', choices=SERVERS, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    servers = [s for s in args.servers.split(',') if s]
+    if 'asgi' in servers:
+        try:
+            import uvicorn  # noqa: F401
+        except ImportError:
+            print('uvicorn is not installed, skipping the ASGI server')
+            servers.remove('asgi')
+
+    rng = random.Random(args.seed)
+    data_dir = tempfile.mkdtemp(prefix='koodak-bench-')
+    try:
+        from storage import create_storage
+        create_storage('json', data_dir).save('products', synthetic_products(args.products, rng))
+        paths = ['/', '/sale', '/about'] + ['/?category=%s&page=%d' % (c, p) for c in CATEGORIES for p in (1, 2, 3)]
+        paths += ['/product/%d' % rng.randint(1, args.products) for _ in range(50)]
+        paths += ['/api/products?category=%s&limit=24' % c for c in CATEGORIES]
+
+        env = dict(os.environ, KOODAK_DATA_DIR=data_dir, KOODAK_DAY_SCHEDULER='0')
+        if args.asgi_threads:
+            env['KOODAK_ASGI_THREADS'] = str(args.asgi_threads)
+        print('%d products, %s paths, %d idle connections, %.0fs per run'
+              % (args.products, len(paths), args.idle, args.duration))
+        for server in servers:
+            for connections in [int(c) for c in args.connections.split(',') if c]:
+                # A fresh server per run, so threads left from the last one do not count
+                port = free_port()
+                command = [sys.executable, os.path.abspath(__file__), '--serve', server, '--port', str(port)]
+                if args.templates:
+                    command += ['--templates', args.templates]
+                process = subprocess.Popen(command, env=env, cwd=data_dir)
+                try:
+                    wait_ready(port, process)
+                    result = asyncio.run(drive(port, process.pid, connections, args.idle, args.duration, paths,
+                                               args.seed))
+                finally:
+                    process.terminate()
+                    process.wait()
+                print('  %-4s %5d conn  %8.0f req/s  p50 %8.2f ms  p99 %8.2f ms  opened %6d  failed %4d  '
+                      'idle kept %5d  threads %5d  rss %6.0f MB'
+                      % (server, connections, result.get('throughput', 0), result.get('p50_ms', 0),
+                         result.get('p99_ms', 0), result['opened_connections'], result['failed_connections'],
+                         result['idle_connections'], result['peak_threads'], result['peak_rss_mb']))
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# Cart pricing benchmark.
+#
+# Prices a large cart against a large synthetic catalog two ways: the way
+# the cart page used to (a linear scan of the product list per line plus
+# parsing the discount dates for every line) and with pricing.price_cart
+# (ids resolved once, prices from DiscountSchedule.active_prices). Checks
+# both give the same lines and total.
+#
+#   python benchmarks/bench_cart_pricing.py --products 20000 --lines 100
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jdatetime
+
+from catalog import ProductRepository
+from discounts import DiscountSchedule
+from pricing import price_cart
+
+
+def sample_product(i, today):
+    has_discount = i % 4 == 0
+    start = today - jdatetime.timedelta(days=i % 10)
+    end = today + jdatetime.timedelta(days=(i % 7) - 2)
+    return {
+        'id': i,
+        'name': 'محصول آزمایشی %d' % i,
+        'price': 100000 + (i * 37) % 400000,
+        'category': ('girls', 'boys', 'baby')[i % 3],
+        'age_group': '3-5 سال',
+        'sizes': ['2-3 سال', '3-4 سال'],
+        'colors': ['صورتی', 'سفید'],
+        'description': 'توضیحات محصول',
+        'image': '',
+        'stock': i % 5,
+        'has_discount': has_discount,
+        'discount_percent': (10 + i % 40) if has_discount else 0,
+        'discount_start': start.strftime('%Y/%m/%d') if has_discount else '',
+        'discount_end': end.strftime('%Y/%m/%d') if has_discount else '',
+        'created_at': '1403/09/15'
+    }
+
+
+# The cart page before price_cart, kept here for comparison
+def legacy_discounted_price(product):
+    if not product.get('has_discount') or not product.get('discount_percent'):
+        return None
+    try:
+        today = jdatetime.date.today()
+        start_parts = product['discount_start'].split('/')
+        end_parts = product['discount_end'].split('/')
+        start = jdatetime.date(int(start_parts[0]), int(start_parts[1]), int(start_parts[2]))
+        end = jdatetime.date(int(end_parts[0]), int(end_parts[1]), int(end_parts[2]))
+        if start <= today <= end:
+            return int(product['price'] - (product['price'] * product['discount_percent'] / 100))
+    except:
+        pass
+    return None
+
+
+def legacy_price_cart(items, products):
+    lines = []
+    total = 0
+    for item in items:
+        product = next((p for p in products if p['id'] == item['product_id']), None)
+        if product:
+            price = legacy_discounted_price(product) or product['price']
+            lines.append((product['id'], item['quantity'], price))
+            total += price * item['quantity']
+    return lines, total
+
+
+def timed(fn, rounds):
+    times = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - started)
+    times.sort()
+    return result, times[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=20000)
+    parser.add_argument('--lines', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    today = jdatetime.date.today()
+    product_list = [sample_product(i, today) for i in range(1, args.products + 1)]
+    products = ProductRepository(product_list, {'discounts': DiscountSchedule})
+    schedule = products.indexes['discounts']
+    rng = random.Random(1)
+    items = [{'product_id': rng.randint(1, args.products), 'quantity': rng.randint(1, 3),
+              'size': '2-3 سال', 'color': 'سفید'} for _ in range(args.lines)]
+    # Plus one product that was deleted since it went into the cart
+    items.append({'product_id': args.products + 1, 'quantity': 1, 'size': '', 'color': ''})
+
+    (legacy_lines, legacy_total), legacy_time = timed(lambda: legacy_price_cart(items, product_list), args.rounds)
+    schedule.active_prices()
+    quote, quote_time = timed(lambda: price_cart(items, products, schedule.active_prices()), args.rounds)
+
+    lines = [(line['id'], line['quantity'], line['final_price']) for line in quote.lines]
+    assert lines == legacy_lines, 'lines differ'
+    assert quote.total == legacy_total, 'totals differ'
+    assert quote.missing == [args.products + 1]
+
+    print('%d lines against %d products (median of %d rounds)' % (len(items), args.products, args.rounds))
+    print('  linear scan:  %8.2f ms' % (legacy_time * 1000))
+    print('  price_cart:   %8.2f ms  (%.0fx)' % (quote_time * 1000, legacy_time / quote_time))
+    print('  lines with stock/variant problems: %d' % len({i for i, problem in quote.problems}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+# Concurrent checkout load test.
+#
+# Starts N worker processes that all check out the same hot product (plus a
+# second product on every other order) far more often than there is stock
+# for, confirming some orders and cancelling others, then lets every worker
+# run the reservation sweeper at once. Checks that stock was never
+# oversold and that every cancelled or expired reservation was given back
+# exactly once.
+#
+# With --app the workers are app processes instead, each importing app.py
+# against the same data directory the way gunicorn workers would, and
+# driving it through Flask's test client: a visitor adding the hot product
+# to the cart and checking out, and anonymous catalog listings
+# (/api/products) in between. Reports checkout and listing latency and, per
+# worker, how often its catalog was fully reloaded or caught up with the
+# other workers' writes and how often the API cache answered. Other
+# workers' checkouts should cost a catch-up, not a reload, and leave the
+# cache warm.
+#
+#   python benchmarks/bench_checkout.py --workers 8 --attempts 200 --stock 500
+#   python benchmarks/bench_checkout.py --backend sqlite
+#   python benchmarks/bench_checkout.py --app --workers 4 --seed 10000
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from orders import CONFIRMED, CANCELLED, EXPIRED, Checkout, OrderLog
+from pricing import price_cart
+from storage import OutOfStock, create_storage
+
+HOT_ID = 1
+SIDE_ID = 2
+
+
+def sample_product(product_id, stock):
+    return {
+        'id': product_id,
+        'name': 'محصول آزمایشی %d' % product_id,
+        'price': 100000 + product_id,
+        'category': ('girls', 'boys', 'baby')[product_id % 3],
+        'age_group': '3-5 سال',
+        'sizes': ['2-3 سال'],
+        'colors': ['سفید'],
+        'description': 'توضیحات محصول برای بنچمارک',
+        'image': '',
+        'stock': stock,
+        'has_discount': False,
+        'discount_percent': 0,
+        'discount_start': '',
+        'discount_end': '',
+        'created_at': '1403/09/15'
+    }
+
+
+def open_checkout(backend, data_dir):
+    storage = create_storage(backend, data_dir)
+    return storage, Checkout(storage, OrderLog(os.path.join(data_dir, 'orders.log')))
+
+
+def worker(args):
+    backend, data_dir, index, attempts = args
+    storage, checkout = open_checkout(backend, data_dir)
+    products = {p['id']: p for p in storage.load('products')}
+    placed = rejected = 0
+    latencies = []
+    for i in range(attempts):
+        items = [{'product_id': HOT_ID, 'quantity': 1, 'size': '2-3 سال', 'color': 'سفید'}]
+        if i % 2:
+            items.append({'product_id': SIDE_ID, 'quantity': 2, 'size': '2-3 سال', 'color': 'سفید'})
+        quote = price_cart(items, products, {})
+        started = time.perf_counter()
+        try:
+            order = checkout.place(quote, {'phone': '0912', 'address': 'worker %d' % index}, user_id=index)
+        except OutOfStock:
+            rejected += 1
+            latencies.append(time.perf_counter() - started)
+            continue
+        placed += 1
+        if i % 4 == 0:
+            checkout.confirm(order['id'])
+        elif i % 7 == 0:
+            checkout.cancel(order['id'])
+        latencies.append(time.perf_counter() - started)
+    return placed, rejected, latencies
+
+
+def app_worker(backend, data_dir, index, attempts, listings, barrier, results):
+    # A separate process with its own copy of app.py, as under gunicorn
+    os.environ.update(KOODAK_DATA_DIR=data_dir, KOODAK_STORAGE=backend, KOODAK_DAY_SCHEDULER='0')
+    import app as shop
+    shop.create_app()
+    visitor = shop.app.test_client()
+    with visitor.session_transaction() as session:
+        session['user_id'] = index + 1
+        session['username'] = 'bench'
+    anonymous = shop.app.test_client()
+    categories = ('girls', 'boys', 'baby')
+    checkouts = []
+    listing = []
+    placed = 0
+    barrier.wait()
+    for i in range(attempts):
+        started = time.perf_counter()
+        visitor.post('/add_to_cart/%d' % HOT_ID, data={'quantity': 1, 'size': '2-3 سال', 'color': 'سفید'})
+        response = visitor.post('/checkout', data={'name': 'bench', 'phone': '0912', 'address': 'worker %d' % index})
+        checkouts.append(time.perf_counter() - started)
+        placed += '/orders/' in response.headers.get('Location', '')
+        for j in range(listings):
+            started = time.perf_counter()
+            anonymous.get('/api/products?category=%s&limit=24' % categories[(i + j) % 3])
+            listing.append(time.perf_counter() - started)
+    catalog = shop.catalog.stats()
+    results.put({'placed': placed, 'checkouts': checkouts, 'listing': listing, 'reloads': catalog['reloads'],
+                 'updates': catalog['updates'], 'api_cache_hit_ratio': shop.api_cache.stats()['hit_ratio']})
+
+
+def run_app(backend, workers, attempts, listings, stock, size):
+    data_dir = tempfile.mkdtemp(prefix='koodak-bench-')
+    try:
+        storage = create_storage(backend, data_dir)
+        storage.save('users', [])
+        storage.save('products', [sample_product(HOT_ID, stock), sample_product(SIDE_ID, stock)] +
+                     [sample_product(i, 10) for i in range(3, size + 1)])
+        barrier = multiprocessing.Barrier(workers)
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=app_worker,
+                                             args=(backend, data_dir, w, attempts, listings, barrier, results))
+                     for w in range(workers)]
+        for process in processes:
+            process.start()
+        runs = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        problems = []
+        placed = sum(r['placed'] for r in runs)
+        remaining = {p['id']: p for p in storage.load('products')}[HOT_ID]['stock']
+        if remaining != stock - placed:
+            problems.append('hot product stock %d, expected %d' % (remaining, stock - placed))
+
+        def percentile(values, q):
+            values = sorted(values)
+            return values[min(len(values) - 1, int(len(values) * q))] * 1000
+        checkouts = [t for r in runs for t in r['checkouts']]
+        listing = [t for r in runs for t in r['listing']]
+        return {
+            'backend': backend,
+            'placed': placed,
+            'checkout_p50_ms': percentile(checkouts, 0.5),
+            'checkout_p99_ms': percentile(checkouts, 0.99),
+            'listing_p50_ms': percentile(listing, 0.5),
+            'listing_p99_ms': percentile(listing, 0.99),
+            'reloads': [r['reloads'] for r in runs],
+            'updates': [r['updates'] for r in runs],
+            'api_cache_hit_ratio': [r['api_cache_hit_ratio'] for r in runs],
+            'problems': problems
+        }
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def sweep(args):
+    backend, data_dir = args
+    storage, checkout = open_checkout(backend, data_dir)
+    return checkout.release_expired(now=time.time() + 10 ** 9)
+
+
+def reserved(orders, statuses, product_id):
+    return sum(item['quantity'] for o in orders if o['status'] in statuses
+               for item in o['items'] if item['product_id'] == product_id)
+
+
+def run(backend, workers, attempts, stock, seed):
+    data_dir = tempfile.mkdtemp(prefix='koodak-bench-')
+    try:
+        storage = create_storage(backend, data_dir)
+        storage.save('users', [])
+        storage.save('products', [sample_product(HOT_ID, stock), sample_product(SIDE_ID, stock * 4)] +
+                     [sample_product(i, 10) for i in range(3, seed + 1)])
+
+        started = time.perf_counter()
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(worker, [(backend, data_dir, w, attempts) for w in range(workers)])
+        elapsed = time.perf_counter() - started
+        placed = sum(r[0] for r in results)
+        rejected = sum(r[1] for r in results)
+        latencies = sorted(t for r in results for t in r[2])
+
+        log = OrderLog(os.path.join(data_dir, 'orders.log'))
+        products = {p['id']: p for p in storage.load('products')}
+        orders = log.all()
+        problems = []
+        for product_id, initial in ((HOT_ID, stock), (SIDE_ID, stock * 4)):
+            held = reserved(orders, ('pending', CONFIRMED), product_id)
+            if products[product_id]['stock'] < 0 or held > initial:
+                problems.append('product %d oversold' % product_id)
+            if products[product_id]['stock'] != initial - held:
+                problems.append('product %d stock %d, expected %d' % (product_id, products[product_id]['stock'], initial - held))
+        if len(orders) != placed or len({o['id'] for o in orders}) != placed:
+            problems.append('%d orders logged for %d placed' % (len(orders), placed))
+
+        # Every worker sweeps at the same time; each reservation must come back once
+        with multiprocessing.Pool(workers) as pool:
+            released = sum(pool.map(sweep, [(backend, data_dir)] * workers))
+        products = {p['id']: p for p in storage.load('products')}
+        orders = OrderLog(os.path.join(data_dir, 'orders.log')).all()
+        for product_id, initial in ((HOT_ID, stock), (SIDE_ID, stock * 4)):
+            expected = initial - reserved(orders, (CONFIRMED,), product_id)
+            if products[product_id]['stock'] != expected:
+                problems.append('after sweep product %d stock %d, expected %d' % (product_id, products[product_id]['stock'], expected))
+        if released != sum(1 for o in orders if o['status'] == EXPIRED):
+            problems.append('released %d reservations' % released)
+
+        return {
+            'backend': backend,
+            'checkouts_per_sec': (placed + rejected) / elapsed,
+            'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+            'placed': placed,
+            'rejected': rejected,
+            'confirmed': sum(1 for o in orders if o['status'] == CONFIRMED),
+            'cancelled': sum(1 for o in orders if o['status'] == CANCELLED),
+            'released': released,
+            'problems': problems
+        }
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=['json', 'sqlite', 'all'], default='all')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--attempts', type=int, default=200, help='checkouts tried per worker')
+    parser.add_argument('--stock', type=int, default=500, help='stock of the hot product')
+    parser.add_argument('--seed', type=int, default=2000, help='products in the catalog')
+    parser.add_argument('--app', action='store_true', help='drive app processes instead of storage')
+    parser.add_argument('--listings', type=int, default=5, help='with --app: listings per checkout')
+    args = parser.parse_args()
+
+    backends = ['json', 'sqlite'] if args.backend == 'all' else [args.backend]
+    if args.app:
+        print('%d app workers x %d checkouts, %d listings each, %d products'
+              % (args.workers, args.attempts, args.listings, args.seed))
+        failed = False
+        for backend in backends:
+            result = run_app(backend, args.workers, args.attempts, args.listings, args.stock, args.seed)
+            print('%-8s placed=%d  checkout p50=%.2fms p99=%.2fms  listing p50=%.2fms p99=%.2fms'
+                  % (result['backend'], result['placed'], result['checkout_p50_ms'], result['checkout_p99_ms'],
+                     result['listing_p50_ms'], result['listing_p99_ms']))
+            print('         catalog reloads %s  catch-ups %s  api cache hit ratio %s'
+                  % (result['reloads'], result['updates'],
+                     ' '.join('%.2f' % ratio for ratio in result['api_cache_hit_ratio'])))
+            for problem in result['problems']:
+                print('  FAIL: ' + problem)
+            failed = failed or result['problems']
+        sys.exit(1 if failed else 0)
+    print('%d workers x %d checkouts of one product with stock %d, %d products'
+          % (args.workers, args.attempts, args.stock, args.seed))
+    failed = False
+    for backend in backends:
+        result = run(backend, args.workers, args.attempts, args.stock, args.seed)
+        print('%-8s %7.0f checkouts/s  p50=%.2fms p99=%.2fms  placed=%d rejected=%d confirmed=%d cancelled=%d released=%d'
+              % (result['backend'], result['checkouts_per_sec'], result['p50_ms'], result['p99_ms'], result['placed'],
+                 result['rejected'], result['confirmed'], result['cancelled'], result['released']))
+        for problem in result['problems']:
+            print('  FAIL: ' + problem)
+        failed = failed or result['problems']
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
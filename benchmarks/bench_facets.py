@@ -0,0 +1,120 @@
+# Filtered listing and facet counts.
+#
+# Builds a synthetic catalog and, for a mix of filter combinations, times
+# one page of the filtered listing and the per-facet counts the way they
+# would be done without an index (walking the sort order with a matcher,
+# and one pass over the catalog per facet) against FacetIndex.
+#
+#   python benchmarks/bench_facets.py --products 100000
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jdatetime
+
+from catalog import ProductRepository
+from discounts import DiscountCache, DiscountSchedule
+from facets import FacetIndex, VALUE_FACETS
+from listing import SortOrders, list_products, make_matcher
+
+CATEGORIES = ('girls', 'boys', 'baby')
+AGE_GROUPS = ('0-12 ماه', '1-3 سال', '3-5 سال', '5-8 سال', '8-12 سال')
+SIZES = ('1-2 سال', '2-3 سال', '3-4 سال', '4-5 سال', '5-6 سال', '6-7 سال', '7-8 سال')
+COLORS = ('صورتی', 'سفید', 'آبی', 'قرمز', 'زرد', 'سبز', 'مشکی', 'بنفش', 'طلایی', 'نارنجی')
+
+
+def sample_products(count, rng):
+    today = jdatetime.date.today()
+    products = []
+    for i in range(1, count + 1):
+        start = today + jdatetime.timedelta(days=rng.randint(-20, 5))
+        products.append({
+            'id': i,
+            'name': 'محصول %d' % i,
+            'price': rng.randint(10, 500) * 10000,
+            'category': rng.choice(CATEGORIES),
+            'age_group': rng.choice(AGE_GROUPS),
+            'sizes': rng.sample(SIZES, rng.randint(1, 4)),
+            'colors': rng.sample(COLORS, rng.randint(1, 3)),
+            'stock': rng.choice((0, 5, 20)),
+            'has_discount': rng.random() < 0.3,
+            'discount_percent': 20,
+            'discount_start': start.strftime('%Y/%m/%d'),
+            'discount_end': (start + jdatetime.timedelta(days=rng.randint(0, 30))).strftime('%Y/%m/%d'),
+            'created_at': '1403/%02d/01' % rng.randint(1, 12)
+        })
+    return products
+
+
+def scan_counts(products, filters, discounts):
+    # One pass over the catalog per facet, the other filters applied
+    counts = {}
+    for name, values_of in VALUE_FACETS.items():
+        matches = make_matcher({k: v for k, v in filters.items() if k != name}, discounts)
+        facet = counts[name] = {}
+        for product in products:
+            if matches is None or matches(product):
+                for value in values_of(product):
+                    facet[value] = facet.get(value, 0) + 1
+    for name in ('in_stock', 'on_sale'):
+        matches = make_matcher(dict(filters, **{name: True}), discounts)
+        counts[name] = sum(1 for product in products if matches(product))
+    return counts
+
+
+def per_call_ms(fn, combos):
+    started = time.perf_counter()
+    for filters in combos:
+        fn(filters)
+    return (time.perf_counter() - started) / len(combos) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=100000)
+    parser.add_argument('--combos', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    discounts = DiscountCache()
+    catalog = sample_products(args.products, rng)
+    started = time.perf_counter()
+    products = ProductRepository(catalog, {'discounts': DiscountSchedule, 'orders': lambda: SortOrders(discounts),
+                                           'facets': FacetIndex})
+    build = (time.perf_counter() - started) * 1000
+    orders, facets = products.indexes['orders'], products.indexes['facets']
+
+    combos = []
+    for _ in range(args.combos):
+        filters = {'category': rng.choice(CATEGORIES)}
+        if rng.random() < 0.7:
+            filters['size'] = rng.choice(SIZES)
+        if rng.random() < 0.5:
+            filters['color'] = rng.choice(COLORS)
+        if rng.random() < 0.3:
+            filters['age_group'] = rng.choice(AGE_GROUPS)
+        if rng.random() < 0.3:
+            filters['on_sale'] = True
+        combos.append(filters)
+    discounts.warm(products)
+
+    rows = [
+        ('page 1, walk', lambda f: list_products(products, orders, 'price', f, 24, 1)),
+        ('page 1, facets', lambda f: list_products(products, orders, 'price', f, 24, 1, facets=facets)),
+        ('page 20, walk', lambda f: list_products(products, orders, 'price', f, 24, 20)),
+        ('page 20, facets', lambda f: list_products(products, orders, 'price', f, 24, 20, facets=facets)),
+        ('counts, one pass per facet', lambda f: scan_counts(products, f, discounts)),
+        ('counts, bitsets', lambda f: facets.counts(f)),
+    ]
+    print('%d products (repository with facets built in %.0f ms), %d filter combinations'
+          % (args.products, build, len(combos)))
+    for label, fn in rows:
+        print('  %-28s %9.3f ms' % (label, per_call_ms(fn, combos)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+# Product search benchmark.
+#
+# Runs a set of queries (single words, several words, a prefix typed so
+# far, Arabic keyboard spellings, Persian digits, ZWNJ and spaced forms)
+# against the synthetic catalog from bench_app two ways: a scan that
+# tokenizes every product per query, the way search works without an
+# index, and SearchIndex. Checks both find the same products, and times
+# building the index and keeping it current on an edit.
+#
+#   python benchmarks/bench_search.py --products 20000
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_app import synthetic_products
+from catalog import ProductRepository
+from search import FIELDS, SearchIndex, query_tokens, tokenize
+
+QUERIES = (
+    'پیراهن',
+    'پیراهن صورتی',
+    'کاپ',
+    'هودی نخی آب',
+    'كلاه',              # Arabic kaf
+    'تي‌شرت',            # Arabic yeh and a ZWNJ
+    'تی شرت',
+    'راه راه',
+    '۳-۴ سال',
+    'مهمانی مدرسه ب',
+)
+
+
+def scan(products, text):
+    # Ids of the products matching every query token, the last one as a
+    # prefix, tokenizing each product as it goes
+    tokens = query_tokens(text)
+    if not tokens:
+        return set()
+    *words, last = tokens
+    found = set()
+    for product in products:
+        product_tokens = set()
+        for field in FIELDS:
+            value = product.get(field)
+            for item in (value if isinstance(value, (list, tuple)) else [value]) if value else ():
+                product_tokens.update(tokenize(item))
+        if all(w in product_tokens for w in words) and any(t.startswith(last) for t in product_tokens):
+            found.add(product['id'])
+    return found
+
+
+def timed(fn, rounds):
+    times = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - started)
+    times.sort()
+    return result, times[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=20000)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    product_list = synthetic_products(args.products, rng)
+    started = time.perf_counter()
+    products = ProductRepository(product_list, {'search': SearchIndex})
+    build_time = time.perf_counter() - started
+    index = products.indexes['search']
+
+    print('%d products, index built in %.0f ms (median of %d rounds per query)'
+          % (args.products, build_time * 1000, args.rounds))
+    print('  %-20s %8s %12s %12s' % ('query', 'matches', 'scan ms', 'index ms'))
+    for query in QUERIES:
+        expected, scan_time = timed(lambda: scan(product_list, query), max(1, args.rounds // 2))
+        results, index_time = timed(lambda: index.search(query, args.products), args.rounds)
+        assert {i for i, score in results} == expected, 'results differ for %r' % query
+        print('  %-20s %8d %12.2f %12.3f' % (query, len(expected), scan_time * 1000, index_time * 1000))
+
+    # Keeping the index current on an admin edit
+    edits = [dict(rng.choice(product_list), name='پیراهن ویرایش‌شده %d' % i) for i in range(200)]
+    started = time.perf_counter()
+    for product in edits:
+        products.update(product)
+    update_time = (time.perf_counter() - started) / len(edits)
+    print('  product update with the index: %.3f ms' % (update_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+# Startup time and per-worker memory, with and without preloading.
+#
+# For each catalog size, generates a synthetic shop and measures:
+#   - in one process, how long importing app.py and create_app() take and
+#     the RSS afterwards;
+#   - under gunicorn (gunicorn.conf.py, wsgi:app) with preload_app on and
+#     off: seconds until the first response, CPU seconds the master and
+#     workers spent getting there, and per worker RSS, PSS (shared pages
+#     divided among the processes sharing them) and USS (pages only that
+#     worker has) after some catalog traffic. With preload the catalog is
+#     built once and shared, so PSS and USS are the numbers to watch; RSS
+#     counts shared pages in full for every worker.
+#
+#   python benchmarks/bench_startup.py --sizes 10000,100000 --workers 4
+#
+# The gunicorn runs need gunicorn (pip install gunicorn) and Linux (/proc).
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_app import CATEGORIES, synthetic_products, synthetic_users
+
+
+def single(args):
+    # Runs in a fresh interpreter inside the data directory
+    started = time.perf_counter()
+    import app
+    imported = time.perf_counter()
+    app.create_app(preload=True)
+    created = time.perf_counter()
+    json.dump({'import_s': imported - started, 'create_app_s': created - imported,
+               'rss_mb': memory(os.getpid()).get('rss_mb', 0)}, sys.stdout)
+
+
+def memory(pid):
+    # RSS, PSS and USS in MB from /proc/<pid>/smaps_rollup
+    fields = {'Rss': 'rss_mb', 'Pss': 'pss_mb', 'Private_Clean': 'uss_mb', 'Private_Dirty': 'uss_mb'}
+    stats = {}
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in fields:
+                    name = fields[key]
+                    stats[name] = stats.get(name, 0) + int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return stats
+
+
+def cpu_seconds(pid):
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return 0.0
+    # utime and stime, fields 14 and 15 of proc(5)
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def children(pid):
+    try:
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def get(url, timeout=30):
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return response.read()
+
+
+def run_gunicorn(data_dir, preload, args, rng):
+    port = free_port()
+    pid_file = os.path.join(data_dir, 'gunicorn.pid')
+    env = dict(os.environ, KOODAK_DATA_DIR=data_dir, KOODAK_DAY_SCHEDULER='0', KOODAK_PRELOAD='1' if preload else '0',
+               KOODAK_WORKERS=str(args.workers), KOODAK_BIND='127.0.0.1:%d' % port)
+    command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'), '--pid', pid_file,
+               '--chdir', ROOT, '--log-level', 'warning', 'wsgi:app']
+    started = time.perf_counter()
+    process = subprocess.Popen(command, env=env, cwd=data_dir)
+    try:
+        url = 'http://127.0.0.1:%d' % port
+        while True:
+            if process.poll() is not None:
+                raise SystemExit('gunicorn exited with %d' % process.returncode)
+            try:
+                get(url + '/api/products?limit=1', timeout=5)
+                break
+            except OSError:
+                time.sleep(0.05)
+        first_response = time.perf_counter() - started
+        # Catalog traffic, enough to reach every worker
+        for i in range(args.requests):
+            get(url + '/api/products?category=%s&page=%d&limit=24' % (CATEGORIES[i % 3], 1 + i % 20))
+            get(url + '/api/products/%d' % rng.randint(1, args.size))
+        # Workers still booting would be missing from the numbers
+        while len(children(process.pid)) < args.workers:
+            time.sleep(0.1)
+        time.sleep(0.5)
+        workers = [memory(pid) for pid in children(process.pid)]
+        cpu = cpu_seconds(process.pid) + sum(cpu_seconds(pid) for pid in children(process.pid))
+        master = memory(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+
+    def mean(name):
+        return sum(w.get(name, 0) for w in workers) / len(workers)
+    return {
+        'first_response_s': first_response,
+        'cpu_s': cpu,
+        'master_rss_mb': master.get('rss_mb', 0),
+        'worker_rss_mb': mean('rss_mb'),
+        'worker_pss_mb': mean('pss_mb'),
+        'worker_uss_mb': mean('uss_mb'),
+        'total_pss_mb': master.get('pss_mb', 0) + sum(w.get('pss_mb', 0) for w in workers)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10000,100000', help='catalog sizes, comma separated')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=200, help='catalog requests after startup')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', default=None, help='write results to this JSON file')
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        single(args)
+        return
+
+    try:
+        import gunicorn  # noqa: F401
+        modes = (('preload', True), ('per-worker', False))
+    except ImportError:
+        print('gunicorn is not installed, measuring a single process only')
+        modes = ()
+
+    from werkzeug.security import generate_password_hash
+    from storage import create_storage
+    results = {}
+    for size in [int(s) for s in args.sizes.split(',') if s]:
+        args.size = size
+        rng = random.Random(args.seed)
+        data_dir = tempfile.mkdtemp(prefix='koodak-bench-')
+        try:
+            storage = create_storage('json', data_dir)
+            storage.save('products', synthetic_products(size, rng))
+            storage.save('users', synthetic_users(args.users, generate_password_hash('bench', 'pbkdf2:sha256:1000')))
+            env = dict(os.environ, KOODAK_DATA_DIR=data_dir)
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--single'], env=env,
+                                             cwd=data_dir, text=True)
+            result = results[size] = {'single': json.loads(output)}
+            print('%d products: import %.2fs, create_app %.2fs, rss %.0f MB' % (
+                size, result['single']['import_s'], result['single']['create_app_s'], result['single']['rss_mb']))
+            for label, preload in modes:
+                run = result[label] = run_gunicorn(data_dir, preload, args, rng)
+                print('  %-10s %d workers: first response %5.2fs  cpu %5.2fs  master rss %5.0f MB  '
+                      'worker rss %5.0f / pss %5.0f / uss %5.0f MB  total pss %6.0f MB' % (
+                          label, args.workers, run['first_response_s'], run['cpu_s'], run['master_rss_mb'],
+                          run['worker_rss_mb'], run['worker_pss_mb'], run['worker_uss_mb'], run['total_pss_mb']))
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump({'workers': args.workers, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
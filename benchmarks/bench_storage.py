@@ -0,0 +1,117 @@
+# Concurrent write benchmark for the storage backends.
+#
+# Starts N worker processes that each register users and add products the
+# way the register/admin_add_product routes do (storage.insert), then checks
+# that every write survived: no lost updates, no duplicate ids.
+#
+#   python benchmarks/bench_storage.py --workers 4 --writes 250
+#   python benchmarks/bench_storage.py --backend sqlite --compact
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import create_storage
+
+
+def sample_user(worker, i):
+    return {
+        'id': None,
+        'username': 'user-%d-%d' % (worker, i),
+        'email': 'user-%d-%d@example.com' % (worker, i),
+        'phone': '0912%07d' % i,
+        'password': 'scrypt:32768:8:1$benchmark$' + '0' * 128,
+        'is_admin': False,
+        'created_at': '1403/09/01 - 10:00'
+    }
+
+
+def sample_product(worker, i):
+    return {
+        'id': None,
+        'name': 'محصول آزمایشی %d-%d' % (worker, i),
+        'price': 100000 + i,
+        'category': ('girls', 'boys', 'baby')[i % 3],
+        'age_group': '3-5 سال',
+        'sizes': ['2-3 سال', '3-4 سال'],
+        'colors': ['صورتی', 'سفید'],
+        'description': 'توضیحات محصول برای بنچمارک ' * 4,
+        'image': 'https://images.unsplash.com/photo-1518831959646-742c3a14ebf7?w=400',
+        'stock': 10,
+        'has_discount': False,
+        'discount_percent': 0,
+        'discount_start': '',
+        'discount_end': '',
+        'created_at': '1403/09/15'
+    }
+
+
+def worker(args):
+    backend, data_dir, compact, index, writes = args
+    storage = create_storage(backend, data_dir, compact=compact)
+    for i in range(writes):
+        storage.insert('users', sample_user(index, i))
+        storage.insert('products', sample_product(index, i))
+
+
+def run(backend, compact, workers, writes, seed):
+    data_dir = tempfile.mkdtemp(prefix='koodak-bench-')
+    try:
+        storage = create_storage(backend, data_dir, compact=compact)
+        storage.save('users', [])
+        storage.save('products', [sample_product(0, i) | {'id': i + 1} for i in range(seed)])
+
+        started = time.perf_counter()
+        with multiprocessing.Pool(workers) as pool:
+            pool.map(worker, [(backend, data_dir, compact, w, writes) for w in range(workers)])
+        elapsed = time.perf_counter() - started
+
+        users = storage.load('users')
+        products = storage.load('products')
+        expected = workers * writes
+        lost = (expected - len(users)) + (expected + seed - len(products))
+        duplicates = (len(users) - len({u['id'] for u in users})) + (len(products) - len({p['id'] for p in products}))
+        return {
+            'backend': backend + (' (compact)' if compact else ''),
+            'writes_per_sec': 2 * expected / elapsed,
+            'elapsed': elapsed,
+            'lost': lost,
+            'duplicates': duplicates
+        }
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=['json', 'sqlite', 'all'], default='all')
+    parser.add_argument('--compact', action='store_true', help='only run compact JSON snapshots')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--writes', type=int, default=250, help='users and products added per worker')
+    parser.add_argument('--seed', type=int, default=2000, help='products already in the catalog')
+    args = parser.parse_args()
+
+    configs = []
+    if args.backend in ('json', 'all'):
+        configs += [('json', True)] if args.compact else [('json', False), ('json', True)]
+    if args.backend in ('sqlite', 'all'):
+        configs.append(('sqlite', False))
+
+    print('%d workers x %d registrations + %d product adds, %d seeded products'
+          % (args.workers, args.writes, args.writes, args.seed))
+    failed = False
+    for backend, compact in configs:
+        result = run(backend, compact, args.workers, args.writes, args.seed)
+        print('%-16s %8.0f writes/s  %6.2fs  lost=%d duplicate_ids=%d' % (
+            result['backend'], result['writes_per_sec'], result['elapsed'], result['lost'], result['duplicates']))
+        failed = failed or result['lost'] or result['duplicates']
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
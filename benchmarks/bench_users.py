@@ -0,0 +1,110 @@
+# Login and registration lookup benchmark.
+#
+# Seeds a large user base, then times the login lookup (email -> user) and
+# a registration (duplicate checks plus the insert) the way the routes used
+# to do them, scanning the loaded user list, against UserRepository and
+# storage.insert(unique=user_keys).
+#
+#   python benchmarks/bench_users.py --users 100000
+#   python benchmarks/bench_users.py --backend sqlite
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import CatalogStore
+from storage import Duplicate, create_storage
+from users import UserRepository, user_keys
+
+
+def sample_user(i):
+    return {
+        'id': i,
+        'username': 'user%d' % i,
+        'email': 'user%d@example.com' % i,
+        'phone': '0912%07d' % i,
+        'password': 'scrypt:32768:8:1$benchmark$' + '0' * 128,
+        'is_admin': False,
+        'created_at': '1403/09/01 - 10:00'
+    }
+
+
+def median_ms(fn, rounds):
+    times = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    times.sort()
+    return times[len(times) // 2] * 1000
+
+
+def run(backend, count, rounds):
+    data_dir = tempfile.mkdtemp(prefix='koodak-bench-')
+    try:
+        storage = create_storage(backend, data_dir)
+        storage.save('users', [sample_user(i) for i in range(1, count + 1)])
+        users = CatalogStore(lambda: storage.load('users'), lambda: storage.signature('users'),
+                             repository=UserRepository)
+        rng = random.Random(1)
+        emails = ['user%d@example.com' % rng.randint(1, count) for _ in range(rounds)]
+
+        started = time.perf_counter()
+        users.get()
+        build = (time.perf_counter() - started) * 1000
+
+        # Before: every request loaded the users and scanned them
+        listed = storage.load('users')
+        old_login = median_ms(lambda: next((u for u in listed if u['email'] == emails[0]), None), rounds)
+        new_login = median_ms(lambda: users.get().by_email(emails[0].upper()), rounds)
+
+        names = iter(range(count + 1, count + 2 + 2 * rounds))
+
+        def old_register():
+            n = next(names)
+            username, email = 'new%d' % n, 'new%d@example.com' % n
+            if any(u['email'] == email for u in listed):
+                return
+            if any(u['username'] == username for u in listed):
+                return
+            storage.insert('users', {'id': None, 'username': username, 'email': email})
+
+        def new_register():
+            n = next(names)
+            try:
+                storage.insert('users', {'id': None, 'username': 'new%d' % n, 'email': 'new%d@example.com' % n},
+                               unique=user_keys)
+            except Duplicate:
+                pass
+
+        # The first unique insert builds the key index; time the ones after
+        new_register()
+        old_reg = median_ms(old_register, rounds)
+        new_reg = median_ms(new_register, rounds)
+        return build, old_login, new_login, old_reg, new_reg
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=['json', 'sqlite', 'all'], default='all')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--rounds', type=int, default=50)
+    args = parser.parse_args()
+
+    backends = ['json', 'sqlite'] if args.backend == 'all' else [args.backend]
+    print('%d users, median of %d rounds' % (args.users, args.rounds))
+    for backend in backends:
+        build, old_login, new_login, old_reg, new_reg = run(backend, args.users, args.rounds)
+        print('%-8s index build %7.1f ms | login scan %7.3f ms, lookup %7.3f ms | register scan %7.2f ms, unique insert %7.2f ms'
+              % (backend, build, old_login, new_login, old_reg, new_reg))
+
+
+if __name__ == '__main__':
+    main()
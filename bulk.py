@@ -0,0 +1,314 @@
+import csv
+import io
+import json
+
+from discounts import parse_jalali_date
+from images import is_digest
+from storage import adjusted_stock
+
+# Product fields in export order; sizes and colors are joined with '|' in CSV
+FIELDS = ('id', 'name', 'price', 'category', 'age_group', 'sizes', 'colors', 'description', 'image',
+          'image_file', 'stock', 'has_discount', 'discount_percent', 'discount_start', 'discount_end', 'created_at')
+LIST_SEPARATOR = '|'
+
+# Prices changed by a percentage are rounded to whole thousands of rials
+PRICE_ROUNDING = 1000
+
+# Errors kept in an ImportReport (the count covers all of them)
+MAX_REPORTED_ERRORS = 50
+
+# Persian and Arabic-Indic digits, and thousands separators typed in prices
+_DIGITS = str.maketrans({**{chr(0x06f0 + d): str(d) for d in range(10)},
+                         **{chr(0x0660 + d): str(d) for d in range(10)},
+                         ',': '', '\u066c': '', '\u060c': ''})
+_TRUE = ('1', 'true', 'yes', 'on', 'بله')
+
+
+class InvalidField(ValueError):
+    pass
+
+
+class ImportReport:
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, line, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+
+def guess_format(filename):
+    filename = filename.lower()
+    if filename.endswith('.json'):
+        return 'json'
+    return 'jsonl' if filename.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def read_rows(stream, fmt):
+    # (line number, row) for each row of a binary stream, read lazily. CSV
+    # rows are dicts keyed by the header; JSONL rows are left as text and
+    # decoded by product_from_row, so a bad line is reported like any
+    # other invalid row. A JSON file must hold one array of products; it
+    # is parsed whole and its rows are numbered by position in the array.
+    # Raises InvalidField on the first read when it does not.
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'json':
+        try:
+            rows = json.load(text)
+        except ValueError:
+            rows = None
+        if not isinstance(rows, list):
+            raise InvalidField('فایل JSON باید آرایه‌ای از محصولات باشد')
+        for line, row in enumerate(rows, 1):
+            yield line, row
+    elif fmt == 'jsonl':
+        for line, raw in enumerate(text, 1):
+            if raw.strip():
+                yield line, raw
+    else:
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+
+
+def _text(value):
+    return '' if value is None else str(value).strip()
+
+
+def _int(row, field, minimum=0, maximum=None):
+    # minimum=None allows any negative number
+    value = row.get(field)
+    if not isinstance(value, int) or isinstance(value, bool):
+        try:
+            value = int(_text(value).translate(_DIGITS))
+        except ValueError:
+            raise InvalidField('%s باید عدد باشد' % field)
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        raise InvalidField('%s خارج از محدوده مجاز است' % field)
+    return value
+
+
+def _list(value):
+    if isinstance(value, list):
+        return [_text(v) for v in value if _text(v)]
+    return [v.strip() for v in _text(value).split(LIST_SEPARATOR) if v.strip()]
+
+
+def _date(row, field):
+    value = _text(row.get(field)).translate(_DIGITS).replace('-', '/')
+    date = parse_jalali_date(value)
+    if date is None:
+        raise InvalidField('%s تاریخ شمسی معتبر نیست (مثال: 1403/10/01)' % field)
+    return date
+
+
+def product_from_row(row, get, today, has_upload=None):
+    # Validated product for an imported row. A row whose id names an
+    # existing product (get(id)) updates it, keeping the fields the row
+    # leaves out; any other row is a new product and gets its id on write.
+    # image_file must name an image uploaded already (has_upload(digest));
+    # without has_upload the column is rejected.
+    if isinstance(row, str):
+        try:
+            row = json.loads(row)
+        except ValueError:
+            raise InvalidField('JSON نامعتبر')
+    if not isinstance(row, dict):
+        raise InvalidField('هر سطر باید یک شیء JSON باشد')
+    row = {k.strip(): v for k, v in row.items() if k is not None and v is not None and _text(v) != ''}
+
+    existing = None
+    if 'id' in row:
+        existing = get(_int(row, 'id', minimum=1))
+    if existing is not None:
+        product = dict(existing)
+    else:
+        for field in ('name', 'price', 'category'):
+            if field not in row:
+                raise InvalidField('%s الزامی است' % field)
+        product = {'id': None, 'name': '', 'price': 0, 'category': '', 'age_group': '', 'sizes': [], 'colors': [],
+                   'description': '', 'image': '', 'stock': 0, 'has_discount': False, 'discount_percent': 0,
+                   'discount_start': '', 'discount_end': '', 'created_at': today}
+
+    for field in ('name', 'category', 'age_group', 'description', 'image', 'created_at'):
+        if field in row:
+            product[field] = _text(row[field])
+    if 'image_file' in row:
+        digest = _text(row['image_file']).lower()
+        if not is_digest(digest) or has_upload is None or not has_upload(digest):
+            raise InvalidField('image_file باید شناسه یک تصویر آپلودشده باشد')
+        product['image_file'] = digest
+    for field in ('sizes', 'colors'):
+        if field in row:
+            product[field] = _list(row[field])
+    if 'price' in row:
+        product['price'] = _int(row, 'price', minimum=1)
+    if 'stock' in row:
+        product['stock'] = _int(row, 'stock')
+    if 'discount_percent' in row:
+        product['discount_percent'] = _int(row, 'discount_percent', maximum=100)
+    for field in ('discount_start', 'discount_end'):
+        if field in row:
+            product[field] = _text(row[field])
+
+    if 'has_discount' in row:
+        value = row['has_discount']
+        product['has_discount'] = value if isinstance(value, bool) else _text(value).lower() in _TRUE
+    elif 'discount_percent' in row:
+        product['has_discount'] = product['discount_percent'] > 0
+    if product['has_discount']:
+        if not product['discount_percent']:
+            raise InvalidField('discount_percent برای تخفیف الزامی است')
+        start = _date(product, 'discount_start')
+        end = _date(product, 'discount_end')
+        if start > end:
+            raise InvalidField('discount_start بعد از discount_end است')
+        product['discount_start'] = start.strftime('%Y/%m/%d')
+        product['discount_end'] = end.strftime('%Y/%m/%d')
+    else:
+        # What the edit form stores for a product without a discount
+        product['discount_percent'] = 0
+        product['discount_start'] = ''
+        product['discount_end'] = ''
+    return product
+
+
+def import_products(rows, get, write, today, batch_size=5000, has_upload=None):
+    # Validates (line, row) pairs as they are read and hands the valid ones
+    # to `write` as storage batch entries, `batch_size` at a time, so a
+    # large file costs a few writes and never sits in memory whole. Invalid
+    # rows are skipped and reported; batches already written stay written.
+    report = ImportReport()
+    entries = []
+    for line, row in rows:
+        try:
+            product = product_from_row(row, get, today, has_upload)
+        except InvalidField as e:
+            report.error(line, str(e))
+            continue
+        if product['id'] is None:
+            entries.append({'op': 'insert', 'record': product})
+            report.inserted += 1
+        else:
+            entries.append({'op': 'update', 'record': product})
+            report.updated += 1
+        if len(entries) >= batch_size:
+            write(entries)
+            entries = []
+    if entries:
+        write(entries)
+    return report
+
+
+def export_products(products, fmt, chunk_rows=500):
+    # The products as CSV (with a BOM, so spreadsheet programs read the
+    # Persian text as UTF-8), JSONL or a JSON array, yielded in chunks of
+    # `chunk_rows` rows for a streaming response
+    buffer = io.StringIO()
+    if fmt == 'jsonl':
+        def write(product):
+            buffer.write(json.dumps({f: product.get(f) for f in FIELDS}, ensure_ascii=False) + '\n')
+    elif fmt == 'json':
+        buffer.write('[')
+
+        def write(product):
+            buffer.write((',\n' if rows else '\n') + json.dumps({f: product.get(f) for f in FIELDS}, ensure_ascii=False))
+    else:
+        writer = csv.writer(buffer)
+        buffer.write('\ufeff')
+        writer.writerow(FIELDS)
+
+        def write(product):
+            row = []
+            for field in FIELDS:
+                value = product.get(field)
+                if isinstance(value, list):
+                    value = LIST_SEPARATOR.join(value)
+                elif isinstance(value, bool):
+                    value = int(value)
+                row.append('' if value is None else value)
+            writer.writerow(row)
+    rows = 0
+    for product in products:
+        write(product)
+        rows += 1
+        if rows % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if fmt == 'json':
+        buffer.write('\n]\n')
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+# Bulk edits from the admin products page. Each returns storage batch
+# entries built from the current records ({id: record}), meant to run as
+# the plan of storage.modify so the whole edit is one write.
+
+def is_filter(value):
+    # 'all' and empty category / age group values match any product
+    return value not in (None, '', 'all')
+
+
+def select(records, ids=None, category=None, age_group=None):
+    # The given ids that exist, or without ids every record matching the
+    # category and age group
+    if ids:
+        return [i for i in ids if i in records]
+    return [i for i, record in records.items()
+            if (not is_filter(category) or record.get('category') == category)
+            and (not is_filter(age_group) or record.get('age_group') == age_group)]
+
+
+def discount_change(percent, start, end):
+    # Function setting the discount on a product copy; percent 0 removes it
+    fields = {'discount_percent': percent, 'discount_start': start, 'discount_end': end}
+    percent = _int(fields, 'discount_percent', maximum=100)
+    if not percent:
+        fields = {'has_discount': False, 'discount_percent': 0, 'discount_start': '', 'discount_end': ''}
+    else:
+        start = _date(fields, 'discount_start')
+        end = _date(fields, 'discount_end')
+        if start > end:
+            raise InvalidField('discount_start بعد از discount_end است')
+        fields = {'has_discount': True, 'discount_percent': percent,
+                  'discount_start': start.strftime('%Y/%m/%d'), 'discount_end': end.strftime('%Y/%m/%d')}
+
+    def change(product):
+        product.update(fields)
+        return product
+    return change
+
+
+def price_change(percent):
+    # Function raising (or with a negative percent lowering) a product
+    # copy's price by `percent`
+    percent = _int({'price_percent': percent}, 'price_percent', minimum=-99, maximum=1000)
+
+    def change(product):
+        price = (product.get('price') or 0) * (100 + percent) / 100
+        product['price'] = max(int(round(price / PRICE_ROUNDING)) * PRICE_ROUNDING, PRICE_ROUNDING)
+        return product
+    return change
+
+
+def parse_delta(value):
+    return _int({'stock_delta': value}, 'stock_delta', minimum=None)
+
+
+def updated_entries(records, ids, change):
+    return [{'op': 'update', 'record': change(dict(records[i]))} for i in ids]
+
+
+def stock_entries(records, ids, delta):
+    # All or nothing: raises storage.OutOfStock if a product would go below zero
+    return [{'op': 'update', 'record': record} for record in adjusted_stock(records.get, {i: delta for i in ids})]
+
+
+def deleted_entries(records, ids):
+    return [{'op': 'delete', 'id': i} for i in ids]
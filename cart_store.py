@@ -0,0 +1,185 @@
+import os
+import secrets
+import threading
+import time
+
+from storage import thread_connection
+
+# Carts nobody touched for this long are dropped
+DEFAULT_TTL = 7 * 24 * 3600
+
+
+def new_cart_id():
+    return secrets.token_urlsafe(16)
+
+
+def _line(key, quantity):
+    product_id, size, color = key
+    return {'product_id': product_id, 'quantity': quantity, 'size': size, 'color': color}
+
+
+class MemoryCartStore:
+    # Carts in a dict: cart id -> {(product_id, size, color): quantity}, so
+    # every line update is a single dict operation. Only valid while the
+    # app runs in one process. Expired carts are swept at most once a minute.
+
+    def __init__(self, ttl=DEFAULT_TTL, sweep_interval=60):
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._carts = {}
+        self._expires = {}
+        self._next_sweep = time.time() + sweep_interval
+
+    def _touch(self, cart_id, create=False):
+        now = time.time()
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.sweep_interval
+            for expired in [c for c, expires in self._expires.items() if expires < now]:
+                self._carts.pop(expired, None)
+                del self._expires[expired]
+        lines = self._carts.get(cart_id)
+        if lines is None:
+            if not create:
+                return None
+            lines = self._carts[cart_id] = {}
+        self._expires[cart_id] = now + self.ttl
+        return lines
+
+    def items(self, cart_id):
+        with self._lock:
+            lines = self._touch(cart_id)
+            return [_line(key, quantity) for key, quantity in (lines or {}).items()]
+
+    def count(self, cart_id):
+        lines = self._carts.get(cart_id)
+        return len(lines) if lines else 0
+
+    def add(self, cart_id, product_id, size, color, quantity):
+        with self._lock:
+            lines = self._touch(cart_id, create=True)
+            key = (product_id, size, color)
+            lines[key] = lines.get(key, 0) + quantity
+
+    def update(self, cart_id, product_id, quantity, size=None, color=None):
+        # Sets the quantity of the product's line with that size and color;
+        # without them, of its first line. A quantity <= 0 removes the line.
+        with self._lock:
+            lines = self._touch(cart_id)
+            if not lines:
+                return
+            if size is not None and color is not None:
+                key = (product_id, size, color)
+            else:
+                key = next((k for k in lines if k[0] == product_id), None)
+            if key not in lines:
+                return
+            if quantity > 0:
+                lines[key] = quantity
+            else:
+                del lines[key]
+
+    def remove(self, cart_id, product_id):
+        with self._lock:
+            lines = self._touch(cart_id)
+            for key in [k for k in (lines or ()) if k[0] == product_id]:
+                del lines[key]
+
+    def clear(self, cart_id):
+        with self._lock:
+            self._carts.pop(cart_id, None)
+            self._expires.pop(cart_id, None)
+
+
+class SqliteCartStore:
+    # Carts in a SQLite database shared by all workers. Lines are keyed by
+    # (cart_id, product_id, size, color); additions are a single upsert.
+    # Carts expire `ttl` seconds after their last change.
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS carts (
+            cart_id TEXT PRIMARY KEY,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS carts_expires_at ON carts (expires_at);
+        CREATE TABLE IF NOT EXISTS cart_items (
+            cart_id TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            size TEXT NOT NULL,
+            color TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            PRIMARY KEY (cart_id, product_id, size, color)
+        );
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL, sweep_interval=60):
+        self.path = path
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._next_sweep = 0
+        self.connection().executescript(self.SCHEMA)
+
+    def connection(self):
+        return thread_connection(self._local, self.path)
+
+    def _write(self, cart_id, *statements):
+        now = time.time()
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if now >= self._next_sweep:
+                self._next_sweep = now + self.sweep_interval
+                conn.execute('DELETE FROM cart_items WHERE cart_id IN (SELECT cart_id FROM carts WHERE expires_at < ?)', (now,))
+                conn.execute('DELETE FROM carts WHERE expires_at < ?', (now,))
+            conn.execute('INSERT OR REPLACE INTO carts (cart_id, expires_at) VALUES (?, ?)', (cart_id, now + self.ttl))
+            for sql, params in statements:
+                conn.execute(sql, params)
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+    def items(self, cart_id):
+        rows = self.connection().execute(
+            'SELECT i.product_id, i.size, i.color, i.quantity FROM cart_items i JOIN carts c USING (cart_id) '
+            'WHERE i.cart_id = ? AND c.expires_at >= ? ORDER BY i.rowid', (cart_id, time.time()))
+        return [_line((product_id, size, color), quantity) for product_id, size, color, quantity in rows]
+
+    def count(self, cart_id):
+        return self.connection().execute(
+            'SELECT COUNT(*) FROM cart_items i JOIN carts c USING (cart_id) WHERE i.cart_id = ? AND c.expires_at >= ?',
+            (cart_id, time.time())).fetchone()[0]
+
+    def add(self, cart_id, product_id, size, color, quantity):
+        self._write(cart_id, (
+            'INSERT INTO cart_items (cart_id, product_id, size, color, quantity) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (cart_id, product_id, size, color) DO UPDATE SET quantity = quantity + excluded.quantity',
+            (cart_id, product_id, size, color, quantity)))
+
+    def update(self, cart_id, product_id, quantity, size=None, color=None):
+        if size is not None and color is not None:
+            where, params = 'cart_id = ? AND product_id = ? AND size = ? AND color = ?', (cart_id, product_id, size, color)
+        else:
+            where = 'rowid = (SELECT MIN(rowid) FROM cart_items WHERE cart_id = ? AND product_id = ?)'
+            params = (cart_id, product_id)
+        if quantity > 0:
+            self._write(cart_id, ('UPDATE cart_items SET quantity = ? WHERE ' + where, (quantity,) + params))
+        else:
+            self._write(cart_id, ('DELETE FROM cart_items WHERE ' + where, params))
+
+    def remove(self, cart_id, product_id):
+        self._write(cart_id, ('DELETE FROM cart_items WHERE cart_id = ? AND product_id = ?', (cart_id, product_id)))
+
+    def clear(self, cart_id):
+        # Through _write for its rollback; the cart row it refreshes goes too
+        self._write(cart_id, ('DELETE FROM cart_items WHERE cart_id = ?', (cart_id,)),
+                    ('DELETE FROM carts WHERE cart_id = ?', (cart_id,)))
+
+
+def create_cart_store(backend, data_dir, ttl=DEFAULT_TTL):
+    if backend == 'memory':
+        return MemoryCartStore(ttl)
+    if backend == 'sqlite':
+        return SqliteCartStore(os.path.join(data_dir, 'carts.db'), ttl)
+    raise ValueError('Unknown cart store: %s' % backend)
@@ -0,0 +1,359 @@
+import bisect
+import threading
+
+
+# Applying more changed records than this (or a tenth of the catalog) one
+# by one costs more than building the repository again
+REBUILD_AFTER = 200
+
+
+def _created_key(product):
+    return (product.get('created_at') or '', product['id'])
+
+
+def stock_only(old, new):
+    # True if `new` differs from `old` in its stock count only, without
+    # going in or out of stock, so cached pages stay valid apart from the
+    # count they may show
+    if old is None or new is None or old.keys() != new.keys():
+        return False
+    if ((old.get('stock') or 0) > 0) != ((new.get('stock') or 0) > 0):
+        return False
+    return all(old[key] == new[key] for key in old if key != 'stock')
+
+
+class ProductRepository:
+    # What load_products() hands out: the products in file order plus an
+    # id -> product dict, per-category lists and a created_at-sorted view.
+    # Writers update the lookups incrementally under a lock and swap in new
+    # containers (copy-on-write), so request threads can iterate without
+    # locking and never see a container change size under them.
+    #
+    # Extra lookups plug in through `indexes`, a name -> factory mapping.
+    # Each index is built by feeding it every product through add(product),
+    # or through load(products) in one go if it has one, and is kept current
+    # with add/remove calls on every change; it is available as
+    # repository.indexes[name]. An index that reads another one has a
+    # bind(indexes) method, called once all of them are built.
+
+    def __init__(self, products=(), indexes=None):
+        self._lock = threading.Lock()
+        self._by_id = {}
+        self._by_category = {}
+        for product in products:
+            self._by_id[product['id']] = product
+        # File position of each id, so category lists keep file order
+        self._seq = {product_id: i for i, product_id in enumerate(self._by_id)}
+        self._next_seq = len(self._seq)
+        for product in self._by_id.values():
+            self._by_category.setdefault(product.get('category'), []).append(product)
+        self._created = sorted(self._by_id.values(), key=_created_key)
+        self._created_keys = [_created_key(p) for p in self._created]
+        self._max_id = max(self._by_id, default=0)
+        self.indexes = {}
+        for name, factory in (indexes or {}).items():
+            index = factory()
+            if hasattr(index, 'load'):
+                index.load(self._by_id.values())
+            else:
+                for product in self._by_id.values():
+                    index.add(product)
+            self.indexes[name] = index
+        for index in self.indexes.values():
+            if hasattr(index, 'bind'):
+                index.bind(self.indexes)
+
+    def __iter__(self):
+        return iter(self._by_id.values())
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, product_id):
+        return product_id in self._by_id
+
+    def get(self, product_id):
+        return self._by_id.get(product_id)
+
+    def by_category(self, category):
+        return self._by_category.get(category, [])
+
+    def categories(self):
+        return list(self._by_category)
+
+    def by_created(self):
+        return self._created
+
+    def newest(self, limit=None):
+        products = self._created[::-1]
+        return products if limit is None else products[:limit]
+
+    def next_id(self):
+        return self._max_id + 1
+
+    def to_list(self):
+        return list(self._by_id.values())
+
+    def add(self, product):
+        with self._lock:
+            if product['id'] in self._by_id:
+                raise KeyError(product['id'])
+            by_id = dict(self._by_id)
+            by_id[product['id']] = product
+            self._by_id = by_id
+            self._seq[product['id']] = self._next_seq
+            self._next_seq += 1
+            self._bucket_add(product)
+            self._created_add(product)
+            self._max_id = max(self._max_id, product['id'])
+            for index in self.indexes.values():
+                index.add(product)
+
+    def update(self, product):
+        with self._lock:
+            old = self._by_id[product['id']]
+            # Same key set, so replacing in place never resizes the dict
+            self._by_id[product['id']] = product
+            if old.get('category') == product.get('category'):
+                category = product.get('category')
+                self._by_category[category] = [product if p is old else p for p in self._by_category[category]]
+            else:
+                self._bucket_remove(old)
+                self._bucket_add(product)
+            self._created_remove(old)
+            self._created_add(product)
+            for index in self.indexes.values():
+                index.remove(old)
+                index.add(product)
+        return old
+
+    def delete(self, product_id):
+        with self._lock:
+            old = self._by_id.get(product_id)
+            if old is None:
+                return None
+            by_id = dict(self._by_id)
+            del by_id[product_id]
+            self._by_id = by_id
+            self._bucket_remove(old)
+            self._created_remove(old)
+            del self._seq[product_id]
+            for index in self.indexes.values():
+                index.remove(old)
+        return old
+
+    def _bucket_add(self, product):
+        category = product.get('category')
+        bucket = self._by_category.get(category, [])
+        seq = self._seq[product['id']]
+        i = bisect.bisect_left([self._seq[p['id']] for p in bucket], seq)
+        self._by_category = dict(self._by_category)
+        self._by_category[category] = bucket[:i] + [product] + bucket[i:]
+
+    def _bucket_remove(self, product):
+        category = product.get('category')
+        bucket = [p for p in self._by_category.get(category, []) if p is not product]
+        self._by_category = dict(self._by_category)
+        if bucket:
+            self._by_category[category] = bucket
+        else:
+            del self._by_category[category]
+
+    def _created_add(self, product):
+        key = _created_key(product)
+        i = bisect.bisect_left(self._created_keys, key)
+        self._created_keys = self._created_keys[:i] + [key] + self._created_keys[i:]
+        self._created = self._created[:i] + [product] + self._created[i:]
+
+    def _created_remove(self, product):
+        i = bisect.bisect_left(self._created_keys, _created_key(product))
+        self._created_keys = self._created_keys[:i] + self._created_keys[i + 1:]
+        self._created = self._created[:i] + self._created[i + 1:]
+
+
+class CatalogStore:
+    # Keeps the parsed catalog in memory as a ProductRepository and only
+    # reloads it from storage when the storage signature (file stat or
+    # revision counter) no longer matches, i.e. another worker wrote it.
+    # Writes made by this process are applied to the repository in place.
+    # `repository` is the class holding the records; any class taking
+    # (records, indexes) works, e.g. users.UserRepository.
+    #
+    # With `changes`, loader() returns (records, cursor) (storage's
+    # load_tracked) and changes(cursor) returns the batch entries written
+    # since (storage's changes), so another worker's write costs applying the
+    # records it changed rather than a reload. `quiet(old, new)` tells
+    # changes cached pages can ignore (stock_only); those do not bump
+    # `version`, which the page caches are keyed on.
+
+    def __init__(self, loader, signature, indexes=None, repository=ProductRepository, changes=None, quiet=None):
+        self.loader = loader
+        self.repository = repository
+        self.signature = signature
+        self.indexes = indexes or {}
+        self.changes = changes
+        self.quiet = quiet
+        self._lock = threading.Lock()
+        self._products = None
+        self._signature = None
+        self._cursor = None
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.updates = 0
+        self.errors = 0
+
+    def get(self):
+        # Read the signature before loading: if storage changes while we
+        # parse it, the stored signature is the older one and the next call
+        # reloads again.
+        signature = self.signature()
+        with self._lock:
+            if self._products is not None and signature == self._signature:
+                self.hits += 1
+                return self._products
+            self.misses += 1
+            if self._catch_up():
+                self._signature = signature
+                return self._products
+            try:
+                if self.changes is not None:
+                    records, cursor = self.loader()
+                else:
+                    records, cursor = self.loader(), None
+                products = self.repository(records, self.indexes)
+            except Exception:
+                # Keep serving the last good catalog rather than an empty
+                # one; without one there is nothing sensible to return
+                if self._products is None:
+                    raise
+                self.errors += 1
+                return self._products
+            if self._products is not None:
+                self.reloads += 1
+            self._products = products
+            self._signature = signature
+            self._cursor = cursor
+            self.version += 1
+            return self._products
+
+    def _catch_up(self):
+        # With the lock held: applies what storage says changed since
+        # _cursor to the cached repository. False if there is nothing to
+        # apply it to or storage can no longer tell; then only a full load
+        # will do.
+        if self._products is None or self._cursor is None:
+            return False
+        try:
+            delta = self.changes(self._cursor)
+        except Exception:
+            delta = None
+        if delta is None:
+            self._cursor = None
+            return False
+        entries, self._cursor = delta
+        products = self._products
+        # Net effect per record, as apply_entries would have it: an update
+        # of a record that is gone changes nothing
+        records = {}
+        for change in entries:
+            if change['op'] == 'delete':
+                records[change['id']] = None
+                continue
+            record = change['record']
+            current = records[record['id']] if record['id'] in records else products.get(record['id'])
+            if change['op'] == 'insert' or current is not None:
+                records[record['id']] = record
+        changed = [(products.get(record_id), record) for record_id, record in records.items()
+                   if products.get(record_id) != record]
+        if len(changed) > max(REBUILD_AFTER, len(products) // 10):
+            by_id = {record['id']: record for record in products}
+            for old, record in changed:
+                if record is None:
+                    del by_id[old['id']]
+                else:
+                    by_id[record['id']] = record
+            self._products = self.repository(by_id.values(), self.indexes)
+        else:
+            for old, record in changed:
+                if record is None:
+                    products.delete(old['id'])
+                elif old is None:
+                    products.add(record)
+                else:
+                    products.update(record)
+        if changed:
+            self.updates += 1
+            if not (self.quiet and all(self.quiet(old, record) for old, record in changed)):
+                self.version += 1
+        return True
+
+    def replace(self, products):
+        # Called right after the whole catalog was written, so our own save
+        # does not cost a re-parse on the next request.
+        if not isinstance(products, self.repository):
+            products = self.repository(products, self.indexes)
+        with self._lock:
+            self._products = products
+            self._signature = self.signature()
+            # Where storage stands now is unknown, so the next change
+            # elsewhere means a full load
+            self._cursor = None
+            self.version += 1
+
+    def commit(self, transition, apply):
+        # `transition` is the (before, after) signature pair a storage write
+        # returned. If nobody else wrote since we loaded, apply the same
+        # change to the cached repository; otherwise drop it and reload.
+        # With `changes` the write is read back from storage instead,
+        # together with anything other workers wrote meanwhile.
+        before, after = transition
+        with self._lock:
+            if self._catch_up():
+                self._signature = after
+                return
+            if self._products is not None and before == self._signature:
+                apply(self._products)
+                self._signature = after
+            else:
+                self._products = None
+                self._signature = None
+            self.version += 1
+
+    def rebuild(self, transition, change):
+        # Like commit() for writes touching many records: `change(by_id)`
+        # edits a copy of the cached records ({id: record}) and the
+        # repository and its indexes are built once from the result, rather
+        # than updated one record at a time
+        before, after = transition
+        with self._lock:
+            if self._catch_up():
+                self._signature = after
+                return
+            if self._products is not None and before == self._signature:
+                by_id = {record['id']: record for record in self._products}
+                change(by_id)
+                self._products = self.repository(by_id.values(), self.indexes)
+                self._signature = after
+            else:
+                self._products = None
+                self._signature = None
+            self.version += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._products = None
+            self._signature = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'reloads': self.reloads,
+                'updates': self.updates,
+                'errors': self.errors,
+                'version': self.version,
+                'cached_products': len(self._products) if self._products is not None else 0
+            }
@@ -0,0 +1,247 @@
+import bisect
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+import jdatetime
+
+
+@lru_cache(maxsize=4096)
+def parse_jalali_date(value):
+    # '1403/10/01' -> jdatetime.date; None for empty or malformed values.
+    # Discount windows repeat across products, so each string is parsed once.
+    try:
+        parts = value.split('/')
+        return jdatetime.date(int(parts[0]), int(parts[1]), int(parts[2]))
+    except:
+        return None
+
+
+def next_midnight(timestamp):
+    # Timestamp of the first local midnight after `timestamp`
+    day = datetime.fromtimestamp(timestamp).date() + timedelta(days=1)
+    return datetime.combine(day, datetime.min.time()).timestamp()
+
+
+class JalaliToday:
+    # jdatetime.date.today(), recomputed only after local midnight passes
+    # (the Jalali and Gregorian days roll over together). text() is the
+    # same day formatted as '1403/10/01'. `clock` returns the current
+    # timestamp; tests can pass their own to move the day.
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._today = None
+        self._text = None
+        self._expires = 0
+
+    def __call__(self):
+        if self.clock() >= self._expires:
+            self.refresh()
+        return self._today
+
+    def refresh(self, now=None):
+        # Moves to the day of `now` (default the clock's current time)
+        with self._lock:
+            now = self.clock() if now is None else now
+            today = jdatetime.date.fromgregorian(date=datetime.fromtimestamp(now).date())
+            self._text = today.strftime('%Y/%m/%d')
+            self._today = today
+            self._expires = next_midnight(now)
+        return today
+
+    def text(self):
+        if self.clock() >= self._expires:
+            self.refresh()
+        return self._text
+
+
+jalali_today = JalaliToday()
+
+
+def _evaluate(key, today):
+    has_discount, percent, start, end, price = key
+    if not (has_discount and percent):
+        return (False, None)
+    start_date = parse_jalali_date(start)
+    end_date = parse_jalali_date(end)
+    if start_date is None or end_date is None or not start_date <= today <= end_date:
+        return (False, None)
+    try:
+        return (True, int(price - (price * percent / 100)))
+    except:
+        return (True, None)
+
+
+class DiscountCache:
+    # Per-product (is active, discounted price) for the current Jalali day.
+    # Entries remember the discount fields they were computed from, so an
+    # edited product is re-evaluated even if nobody called invalidate(), and
+    # the whole table is dropped when the day changes.
+
+    def __init__(self, today=jalali_today):
+        self.today = today
+        self._day = None
+        self._memo = {}
+
+    def evaluate(self, product):
+        today = self.today()
+        if today != self._day:
+            self._memo = {}
+            self._day = today
+        key = (product.get('has_discount'), product.get('discount_percent'),
+               product.get('discount_start'), product.get('discount_end'), product.get('price'))
+        entry = self._memo.get(product.get('id'))
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        result = _evaluate(key, today)
+        self._memo[product.get('id')] = (key, result)
+        return result
+
+    def price(self, product):
+        return self.evaluate(product)[1]
+
+    def is_active(self, product):
+        return self.evaluate(product)[0]
+
+    def warm(self, products):
+        for product in products:
+            self.evaluate(product)
+
+    def invalidate(self, product_id=None):
+        if product_id is None:
+            self._memo = {}
+        else:
+            self._memo.pop(product_id, None)
+
+
+def _day_number(jdate):
+    return jdate.togregorian().toordinal()
+
+
+class DiscountSchedule:
+    # Interval index over the products' discount windows, kept as a catalog
+    # index (see ProductRepository). Windows are stored as day numbers in two
+    # sorted lists, by start and by end, so "active on D", "starting within
+    # N days" and "expiring on D" are bisect range scans instead of a pass
+    # over the whole catalog. Lists are replaced, not mutated, on change.
+
+    def __init__(self, today=jalali_today):
+        self.today = today
+        self._windows = {}
+        self._starts = []
+        self._ends = []
+        self._active = None
+        self._prices = None
+
+    def _window(self, product):
+        if not (product.get('has_discount') and product.get('discount_percent')):
+            return None
+        start = parse_jalali_date(product.get('discount_start'))
+        end = parse_jalali_date(product.get('discount_end'))
+        if start is None or end is None or start > end:
+            return None
+        return (_day_number(start), _day_number(end))
+
+    def add(self, product):
+        window = self._window(product)
+        if window is None:
+            return
+        product_id = product['id']
+        windows = dict(self._windows)
+        windows[product_id] = window + (product,)
+        self._windows = windows
+        self._starts = self._inserted(self._starts, (window[0], product_id))
+        self._ends = self._inserted(self._ends, (window[1], product_id))
+        self._active = None
+        self._prices = None
+
+    def load(self, products):
+        # Initial build: the windows sorted once instead of inserted one by one
+        windows = {}
+        for product in products:
+            window = self._window(product)
+            if window is not None:
+                windows[product['id']] = window + (product,)
+        self._windows = windows
+        self._starts = sorted((w[0], i) for i, w in windows.items())
+        self._ends = sorted((w[1], i) for i, w in windows.items())
+        self._active = None
+        self._prices = None
+
+    def remove(self, product):
+        window = self._windows.get(product['id'])
+        if window is None:
+            return
+        windows = dict(self._windows)
+        del windows[product['id']]
+        self._windows = windows
+        self._starts = self._removed(self._starts, (window[0], product['id']))
+        self._ends = self._removed(self._ends, (window[1], product['id']))
+        self._active = None
+        self._prices = None
+
+    def _inserted(self, entries, entry):
+        i = bisect.bisect_left(entries, entry)
+        return entries[:i] + [entry] + entries[i:]
+
+    def _removed(self, entries, entry):
+        i = bisect.bisect_left(entries, entry)
+        return entries[:i] + entries[i + 1:]
+
+    def _day(self, day):
+        return _day_number(day or self.today())
+
+    def active_on(self, day=None):
+        # Ids whose window contains `day` (default today), ending soonest first
+        d = self._day(day)
+        cached = self._active
+        if cached is not None and cached[0] == d:
+            return cached[1]
+        windows = self._windows
+        started = bisect.bisect_right(self._starts, (d, float('inf')))
+        not_ended = len(self._ends) - bisect.bisect_left(self._ends, (d,))
+        # Walk whichever side of the window is the shorter list
+        if not_ended <= started:
+            ids = [i for e, i in self._ends[len(self._ends) - not_ended:] if windows[i][0] <= d]
+        else:
+            ids = [i for s, i in self._starts[:started] if windows[i][1] >= d]
+            ids.sort(key=lambda i: (windows[i][1], i))
+        self._active = (d, ids)
+        return ids
+
+    def active_prices(self, day=None):
+        # {product id: discounted price} for discounts running on `day`;
+        # products missing from it sell at their list price
+        d = self._day(day)
+        cached = self._prices
+        if cached is not None and cached[0] == d:
+            return cached[1]
+        prices = {}
+        for i in self.active_on(day):
+            product = self._windows[i][2]
+            try:
+                prices[i] = int(product['price'] - (product['price'] * product['discount_percent'] / 100))
+            except:
+                pass
+        self._prices = (d, prices)
+        return prices
+
+    def starting_within(self, days, day=None):
+        # Ids whose window starts in the next `days` days (not today)
+        d = self._day(day)
+        lo = bisect.bisect_right(self._starts, (d, float('inf')))
+        hi = bisect.bisect_right(self._starts, (d + days, float('inf')))
+        return [i for s, i in self._starts[lo:hi]]
+
+    def expiring_on(self, day=None):
+        # Ids whose window ends on `day`
+        d = self._day(day)
+        lo = bisect.bisect_left(self._ends, (d,))
+        hi = bisect.bisect_right(self._ends, (d, float('inf')))
+        return [i for e, i in self._ends[lo:hi] if self._windows[i][0] <= d]
+
+    def __len__(self):
+        return len(self._windows)
@@ -0,0 +1,145 @@
+# Facet name (as in listing.FILTERS) -> values a product has for it
+VALUE_FACETS = {
+    'category': lambda p: (p.get('category'),) if p.get('category') else (),
+    'age_group': lambda p: (p.get('age_group'),) if p.get('age_group') else (),
+    'size': lambda p: p.get('sizes') or (),
+    'color': lambda p: p.get('colors') or (),
+}
+FLAG_FACETS = ('in_stock', 'on_sale')
+
+
+def bits_of(ids):
+    # Bitset (an int with bit i set for id i) of many ids at once; OR-ing
+    # them in one by one would copy the whole int every time
+    ids = list(ids)
+    if not ids:
+        return 0
+    buffer = bytearray(max(ids) // 8 + 1)
+    for i in ids:
+        buffer[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+def ids_of(bits):
+    # Ids in a bitset, ascending
+    digits = bin(bits)[:1:-1]
+    ids = []
+    i = digits.find('1')
+    while i != -1:
+        ids.append(i)
+        i = digits.find('1', i + 1)
+    return ids
+
+
+class FacetIndex:
+    # Catalog index (see ProductRepository) keeping a bitset of product ids
+    # per value of category, age_group, each size and each color, plus the
+    # products in stock and those on sale today. A filter combination is the
+    # AND of its bitsets, and a facet's counts are its value bitsets ANDed
+    # with the other active filters, so filters selected elsewhere narrow a
+    # facet's counts but its own selection does not hide the alternatives.
+    # On-sale ids come from the repository's 'discounts' index (a
+    # DiscountSchedule), which bind() looks up once every index is built.
+
+    def __init__(self):
+        self._bits = {name: {} for name in VALUE_FACETS}
+        self._in_stock = 0
+        self._all = 0
+        self._schedule = None
+        self._on_sale = None
+
+    def bind(self, indexes):
+        self._schedule = indexes['discounts']
+
+    def load(self, products):
+        ids = {name: {} for name in VALUE_FACETS}
+        in_stock = []
+        all_ids = []
+        for product in products:
+            product_id = product['id']
+            all_ids.append(product_id)
+            for name, values_of in VALUE_FACETS.items():
+                for value in values_of(product):
+                    ids[name].setdefault(value, []).append(product_id)
+            if (product.get('stock') or 0) > 0:
+                in_stock.append(product_id)
+        self._bits = {name: {value: bits_of(v) for value, v in values.items()} for name, values in ids.items()}
+        self._in_stock = bits_of(in_stock)
+        self._all = bits_of(all_ids)
+        self._on_sale = None
+
+    def _change(self, product, add):
+        mask = 1 << product['id']
+        bits = dict(self._bits)
+        for name, values_of in VALUE_FACETS.items():
+            values = bits[name] = dict(bits[name])
+            for value in values_of(product):
+                if add:
+                    values[value] = values.get(value, 0) | mask
+                elif value in values:
+                    values[value] &= ~mask
+                    if not values[value]:
+                        del values[value]
+        self._bits = bits
+        if add:
+            self._all |= mask
+            if (product.get('stock') or 0) > 0:
+                self._in_stock |= mask
+        else:
+            self._all &= ~mask
+            self._in_stock &= ~mask
+        self._on_sale = None
+
+    def add(self, product):
+        self._change(product, True)
+
+    def remove(self, product):
+        self._change(product, False)
+
+    def _flag(self, name):
+        if name == 'in_stock':
+            return self._in_stock
+        # Rebuilt when the day or the discounts change
+        active = self._schedule.active_on()
+        cached = self._on_sale
+        if cached is None or cached[0] is not active:
+            cached = self._on_sale = (active, bits_of(active))
+        return cached[1]
+
+    def _filter_bits(self, filters, skip=None):
+        bits = self._all
+        for name, value in filters.items():
+            if name == skip:
+                continue
+            if name in VALUE_FACETS:
+                bits &= self._bits[name].get(value, 0)
+            elif name in FLAG_FACETS and value:
+                bits &= self._flag(name)
+        return bits
+
+    def bits(self, filters):
+        # Bitset of the products matching every filter (listing_args format)
+        return self._filter_bits(filters)
+
+    def match(self, filters):
+        # The same as ids, ascending
+        return ids_of(self._filter_bits(filters))
+
+    def count(self, filters):
+        return self._filter_bits(filters).bit_count()
+
+    def counts(self, filters):
+        # {facet: {value: matching products}} for the value facets and
+        # {flag: matching products} for in_stock/on_sale, each counted with
+        # the filters on the other facets applied
+        counts = {}
+        for name in VALUE_FACETS:
+            base = self._filter_bits(filters, skip=name)
+            counts[name] = {value: n for value, n in
+                            ((value, (base & bits).bit_count()) for value, bits in self._bits[name].items()) if n}
+        for name in FLAG_FACETS:
+            counts[name] = (self._filter_bits(filters, skip=name) & self._flag(name)).bit_count()
+        return counts
+
+    def __len__(self):
+        return self._all.bit_count()
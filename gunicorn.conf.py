@@ -0,0 +1,30 @@
+# gunicorn -c gunicorn.conf.py wsgi:app
+#
+# Settings come from the environment, so deployments change them without
+# editing this file (GUNICORN_CMD_ARGS works too).
+import multiprocessing
+import os
+
+bind = os.environ.get('KOODAK_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('KOODAK_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('KOODAK_THREADS', 4))
+keepalive = 5
+
+# Load the app (wsgi.py) in the master before forking: the catalog and its
+# indexes are built once and shared copy-on-write by the workers, instead
+# of each worker parsing the store again. KOODAK_PRELOAD=0 loads the app in
+# every worker.
+preload_app = os.environ.get('KOODAK_PRELOAD', '1') == '1'
+
+# A worker restarted by max_requests is forked from the master again and
+# shares its pages like the first ones
+max_requests = int(os.environ.get('KOODAK_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+
+def post_worker_init(worker):
+    # Background threads (reservation sweeper, day scheduler) do not survive
+    # the fork; start this worker's own
+    import app
+    app.create_app()
@@ -0,0 +1,322 @@
+import hashlib
+import io
+import os
+import re
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+try:
+    from PIL import Image
+except ImportError:
+    # Without Pillow every size is served as the original image
+    Image = None
+
+# Variant name -> longest side in pixels
+SIZES = {'thumb': 160, 'card': 400, 'large': 800}
+JPEG_QUALITY = 82
+WEBP_QUALITY = 80
+
+# Largest original accepted from a URL or an upload
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+
+# Seconds a failed fetch or conversion is remembered, so a dead URL is not
+# retried on every page view
+FETCH_RETRY_AFTER = 300
+
+# Leading bytes -> mimetype of the image formats accepted as originals
+_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+_EXTENSIONS = {'image/jpeg': 'jpg', 'image/png': 'png', 'image/gif': 'gif', 'image/webp': 'webp'}
+
+# What save_upload returns and image_file may hold: a SHA-256 hex digest
+_DIGEST = re.compile(r'[0-9a-f]{64}')
+
+
+class InvalidImage(Exception):
+    pass
+
+
+class ImageUnavailable(Exception):
+    # The original could not be fetched or converted (in time)
+    pass
+
+
+def sniff(data):
+    # Mimetype of image bytes, None if they are not a supported image
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, mimetype in _SIGNATURES:
+        if data.startswith(signature):
+            return mimetype
+    return None
+
+
+def is_digest(value):
+    return isinstance(value, str) and _DIGEST.fullmatch(value) is not None
+
+
+def image_source(product):
+    # ('upload', digest) for an uploaded image, ('url', url) for a remote
+    # one, None without an image. An image_file that is not a digest is
+    # ignored: it must never be used as a path.
+    if is_digest(product.get('image_file')):
+        return ('upload', product['image_file'])
+    if product.get('image'):
+        return ('url', product['image'])
+    return None
+
+
+def source_version(source):
+    # Changes whenever the product's image does; part of the image URL so
+    # responses can be cached for good
+    return hashlib.sha256(('%s:%s' % source).encode('utf-8')).hexdigest()[:12]
+
+
+class ImageStore:
+    # Product images served from our own origin. Originals live on disk
+    # under their SHA-256 digest: uploads in `upload_dir` (kept for good),
+    # fetched URLs in `cache_dir/originals` (fetched once, shared by all
+    # workers through `cache_dir/sources`). Resized JPEG and WebP variants
+    # of every size are made together on a small thread pool the first time
+    # one is asked for, and written to `cache_dir/variants` as
+    # <digest>-<size>.<ext>.
+    #
+    # The cache (fetched originals and variants) is kept under `max_bytes`:
+    # once this process's running total passes it, the directory is scanned
+    # and the least recently served files are removed down to 90%. Files
+    # served are touched at most once an hour to record the use.
+
+    def __init__(self, cache_dir, upload_dir, max_bytes=512 * 1024 * 1024, workers=2, timeout=10,
+                 schemes=('http', 'https'), fetch=None):
+        self.cache_dir = cache_dir
+        self.upload_dir = upload_dir
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.timeout = timeout
+        self.schemes = schemes
+        self.fetch = fetch or self._fetch_url
+        for path in (upload_dir, os.path.join(cache_dir, 'originals'), os.path.join(cache_dir, 'sources'),
+                     os.path.join(cache_dir, 'variants')):
+            os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._pending = {}
+        self._failed = {}
+        self._bytes = None
+        self.fetches = 0
+        self.conversions = 0
+        self.evictions = 0
+
+    def _pool(self):
+        # Created on first use and again after a fork (see PasswordHasher)
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='images')
+            self._pending = {}
+            self._pid = os.getpid()
+        return self._executor
+
+    def _write(self, path, data, cached=True):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if cached:
+            self._grew(len(data))
+
+    def save_upload(self, data):
+        # Stores uploaded image bytes; returns the digest for image_file
+        if len(data) > MAX_IMAGE_BYTES or sniff(data) is None:
+            raise InvalidImage()
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.upload_dir, digest)
+        if not os.path.exists(path):
+            self._write(path, data, cached=False)
+        return digest
+
+    def _fetch_url(self, url):
+        if url.split(':', 1)[0].lower() not in self.schemes:
+            raise ImageUnavailable(url)
+        with urllib.request.urlopen(url, timeout=self.timeout) as response:
+            return response.read(MAX_IMAGE_BYTES + 1)
+
+    def _upload_path(self, digest):
+        # Path of an uploaded original, None for anything that is not a
+        # digest or would resolve outside upload_dir
+        if not is_digest(digest):
+            return None
+        root = os.path.realpath(self.upload_dir)
+        path = os.path.realpath(os.path.join(root, digest))
+        if os.path.dirname(path) != root:
+            return None
+        return path
+
+    def has_upload(self, digest):
+        path = self._upload_path(digest)
+        return path is not None and os.path.isfile(path)
+
+    def _stored(self, source):
+        # Path of the source's original if it is on disk already
+        kind, value = source
+        if kind == 'upload':
+            return self._upload_path(value) if self.has_upload(value) else None
+        try:
+            with open(self._source_key(value)) as f:
+                path = os.path.join(self.cache_dir, 'originals', f.read().strip())
+        except FileNotFoundError:
+            return None
+        return path if os.path.exists(path) else None
+
+    def _source_key(self, url):
+        return os.path.join(self.cache_dir, 'sources', hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def _fetch(self, source):
+        kind, value = source
+        if kind == 'upload':
+            raise ImageUnavailable(value)
+        data = self.fetch(value)
+        if len(data) > MAX_IMAGE_BYTES or sniff(data) is None:
+            raise ImageUnavailable(value)
+        with self._lock:
+            self.fetches += 1
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.cache_dir, 'originals', digest)
+        if not os.path.exists(path):
+            self._write(path, data)
+        self._write(self._source_key(value), digest.encode('ascii'), cached=False)
+        return path
+
+    def _prepare(self, source):
+        # Pool task: the original on disk and, with Pillow, all its variants
+        path = self._stored(source) or self._fetch(source)
+        if Image is not None and self._find_variant(os.path.basename(path), 'thumb', True) is None:
+            self._convert(path, os.path.basename(path))
+        return path
+
+    def _variant_path(self, digest, size, mimetype):
+        return os.path.join(self.cache_dir, 'variants', '%s-%s.%s' % (digest, size, _EXTENSIONS[mimetype]))
+
+    def _convert(self, path, digest):
+        # Every size in JPEG (PNG when the image has transparency) and WebP
+        with open(path, 'rb') as f:
+            data = f.read()
+        with Image.open(io.BytesIO(data)) as image:
+            image.load()
+            alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+            image = image.convert('RGBA' if alpha else 'RGB')
+            if alpha:
+                plain = ('PNG', 'image/png', {'optimize': True})
+            else:
+                plain = ('JPEG', 'image/jpeg', {'quality': JPEG_QUALITY, 'optimize': True, 'progressive': True})
+            for size, pixels in SIZES.items():
+                resized = image.copy()
+                resized.thumbnail((pixels, pixels), Image.LANCZOS)
+                for fmt, mimetype, options in (plain, ('WEBP', 'image/webp', {'quality': WEBP_QUALITY, 'method': 4})):
+                    out = io.BytesIO()
+                    resized.save(out, fmt, **options)
+                    self._write(self._variant_path(digest, size, mimetype), out.getvalue())
+        with self._lock:
+            self.conversions += 1
+
+    def _find_variant(self, digest, size, webp):
+        for mimetype in ('image/webp',) if webp else ('image/jpeg', 'image/png'):
+            path = self._variant_path(digest, size, mimetype)
+            if os.path.exists(path):
+                return path, mimetype
+        return None
+
+    def _ready(self, path, size, webp):
+        if Image is None:
+            with open(path, 'rb') as f:
+                return path, sniff(f.read(16))
+        return self._find_variant(os.path.basename(path), size, webp)
+
+    def variant(self, source, size, webp=False):
+        # (path, mimetype) of the source at `size`, WebP if `webp`. The first
+        # request for a source fetches and converts it on the pool (once,
+        # however many requests ask meanwhile) and waits up to `timeout`.
+        path = self._stored(source)
+        found = self._ready(path, size, webp) if path else None
+        if found is None:
+            failed = self._failed.get(source)
+            if failed is not None and failed + FETCH_RETRY_AFTER > time.time():
+                raise ImageUnavailable(source)
+            with self._lock:
+                future = self._pending.get(source)
+                if future is None:
+                    future = self._pending[source] = self._pool().submit(self._prepare, source)
+                    future.add_done_callback(lambda f: self._pending.pop(source, None))
+            try:
+                path = future.result(self.timeout)
+            except FutureTimeout:
+                raise ImageUnavailable(source)
+            except Exception:
+                # Unreachable URL or not an image Pillow can read
+                self._failed[source] = time.time()
+                raise ImageUnavailable(source)
+            found = self._ready(path, size, webp)
+            if found is None:
+                raise ImageUnavailable(source)
+        self._touch(found[0])
+        return found
+
+    def _touch(self, path):
+        try:
+            if os.stat(path).st_mtime < time.time() - 3600:
+                os.utime(path)
+        except OSError:
+            pass
+
+    def _cache_files(self):
+        for name in ('originals', 'variants'):
+            with os.scandir(os.path.join(self.cache_dir, name)) as entries:
+                for entry in entries:
+                    if entry.is_file() and not entry.name.endswith('.tmp'):
+                        yield entry.path, entry.stat()
+
+    def _grew(self, added):
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = sum(st.st_size for path, st in self._cache_files())
+            else:
+                self._bytes += added
+            if self._bytes <= self.max_bytes:
+                return
+            # Other workers write here too, so count from the disk
+            files = sorted(self._cache_files(), key=lambda f: f[1].st_mtime)
+            total = sum(st.st_size for path, st in files)
+            for path, st in files:
+                if total <= self.max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= st.st_size
+                self.evictions += 1
+            self._bytes = total
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pillow': Image is not None,
+                'cached_bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'pending': len(self._pending),
+                'fetches': self.fetches,
+                'conversions': self.conversions,
+                'evictions': self.evictions
+            }
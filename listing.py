@@ -0,0 +1,230 @@
+import base64
+import bisect
+import json
+
+from facets import ids_of
+
+# sort name -> (order kept by SortOrders, walk it descending)
+SORTS = {
+    'default': ('id', False),
+    'newest': ('created', True),
+    'price': ('price', False),
+    'price_desc': ('price', True),
+    'discounted': ('discounted', False),
+    'discounted_desc': ('discounted', True),
+}
+
+FILTERS = ('category', 'age_group', 'size', 'color', 'in_stock', 'on_sale')
+
+# With facet bitsets a filtered page is found either by walking the sort
+# order past non-matching entries or by sorting just the matches, whichever
+# is cheaper; sorting a match costs about as much as walking SORT_COST entries
+SORT_COST = 4
+
+
+class SortOrders:
+    # Catalog index (see ProductRepository) holding every sort order as an
+    # ascending list of (sort value, id) keys, so a page is a bisect to the
+    # cursor plus a walk of page-size entries. The discounted-price order
+    # depends on the day, so it is built on first use each day and dropped
+    # whenever a product changes.
+
+    def __init__(self, discounts):
+        self.discounts = discounts
+        self._products = {}
+        self._orders = {'id': [], 'created': [], 'price': []}
+        self._discounted = None
+
+    def _keys(self, product):
+        return {name: self.key_of(name, product) for name in ('id', 'created', 'price')}
+
+    def add(self, product):
+        products = dict(self._products)
+        products[product['id']] = product
+        self._products = products
+        orders = {}
+        for name, key in self._keys(product).items():
+            keys = self._orders[name]
+            i = bisect.bisect_left(keys, key)
+            orders[name] = keys[:i] + [key] + keys[i:]
+        self._orders = orders
+        self._discounted = None
+
+    def load(self, products):
+        # Initial build: one sort per order instead of an insert per product
+        self._products = {p['id']: p for p in products}
+        keys = [self._keys(p) for p in self._products.values()]
+        self._orders = {name: sorted(k[name] for k in keys) for name in self._orders}
+        self._discounted = None
+
+    def remove(self, product):
+        products = dict(self._products)
+        products.pop(product['id'], None)
+        self._products = products
+        orders = {}
+        for name, key in self._keys(product).items():
+            keys = self._orders[name]
+            i = bisect.bisect_left(keys, key)
+            orders[name] = keys[:i] + keys[i + 1:]
+        self._orders = orders
+        self._discounted = None
+
+    def final_price(self, product):
+        price = self.discounts.price(product)
+        return (product.get('price') or 0) if price is None else price
+
+    def keys(self, order):
+        if order != 'discounted':
+            return self._orders[order]
+        today = self.discounts.today()
+        cached = self._discounted
+        if cached is None or cached[0] != today:
+            products = self._products
+            keys = sorted((self.final_price(p), p['id']) for p in products.values())
+            cached = (today, keys)
+            self._discounted = cached
+        return cached[1]
+
+    def key_of(self, order, product):
+        if order == 'price':
+            return (product.get('price') or 0, product['id'])
+        if order == 'created':
+            return (product.get('created_at') or '', product['id'])
+        if order == 'discounted':
+            return (self.final_price(product), product['id'])
+        return (product['id'], product['id'])
+
+
+class Listing:
+    # One page of products plus what the template needs to link the next one
+
+    def __init__(self, products, sort, filters, limit, page, next_cursor, total):
+        self.products = products
+        self.sort = sort
+        self.filters = filters
+        self.limit = limit
+        self.page = page
+        self.next_cursor = next_cursor
+        self.has_next = next_cursor is not None
+        self.total = total
+
+
+def encode_cursor(key):
+    raw = json.dumps(list(key), ensure_ascii=False, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, product_id = json.loads(raw.decode('utf-8'))
+        return (value, int(product_id))
+    except:
+        return None
+
+
+def listing_args(args, default_limit, max_limit=100):
+    # Reads sort/filter/paging query parameters, ignoring invalid values
+    sort = args.get('sort', 'default')
+    if sort not in SORTS:
+        sort = 'default'
+    filters = {}
+    for name in FILTERS:
+        value = args.get(name)
+        if name in ('in_stock', 'on_sale'):
+            if value in ('1', 'true', 'on'):
+                filters[name] = True
+        elif value and value != 'all':
+            filters[name] = value
+    try:
+        limit = min(max(int(args.get('limit', default_limit)), 1), max_limit)
+    except ValueError:
+        limit = default_limit
+    try:
+        page = max(int(args.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    return {'sort': sort, 'filters': filters, 'limit': limit, 'page': page, 'cursor': args.get('cursor')}
+
+
+def make_matcher(filters, discounts):
+    checks = []
+    if 'category' in filters:
+        checks.append(lambda p: p.get('category') == filters['category'])
+    if 'age_group' in filters:
+        checks.append(lambda p: p.get('age_group') == filters['age_group'])
+    if 'size' in filters:
+        checks.append(lambda p: filters['size'] in (p.get('sizes') or ()))
+    if 'color' in filters:
+        checks.append(lambda p: filters['color'] in (p.get('colors') or ()))
+    if filters.get('in_stock'):
+        checks.append(lambda p: (p.get('stock') or 0) > 0)
+    if filters.get('on_sale'):
+        checks.append(discounts.is_active)
+    if not checks:
+        return None
+    return lambda p: all(check(p) for check in checks)
+
+
+def list_products(products, orders, sort='default', filters=None, limit=24, page=1, cursor=None, facets=None):
+    # `products` is the ProductRepository, `orders` its SortOrders index.
+    # With a cursor the page starts right after the cursor's key; otherwise
+    # at (page - 1) * limit matching products. Cost is the entries walked:
+    # the page itself plus whatever the filters skip on the way. With a
+    # FacetIndex the matches are known up front, so the total is exact and a
+    # page deep in a sparse filter is taken from the sorted matches alone.
+    filters = filters or {}
+    order, descending = SORTS[sort]
+    keys = orders.keys(order)
+    matches = make_matcher(filters, orders.discounts)
+    total = len(keys) if matches is None else None
+    if matches is not None and facets is not None:
+        bits = facets.bits(filters)
+        total = bits.bit_count()
+        walk = (limit if cursor else page * limit) * len(keys) / max(total, 1)
+        if walk > total * SORT_COST:
+            keys = sorted(orders.key_of(order, product) for product in map(products.get, ids_of(bits)) if product)
+            matches = None
+        else:
+            # Bit i of the bitset is digits[i]
+            digits = bin(bits)[:1:-1]
+            matches = lambda p: p['id'] < len(digits) and digits[p['id']] == '1'
+
+    start = decode_cursor(cursor) if cursor else None
+    if start is not None:
+        skip = 0
+        try:
+            if descending:
+                position = bisect.bisect_left(keys, start) - 1
+            else:
+                position = bisect.bisect_right(keys, start)
+        except TypeError:
+            # A cursor from a different sort order; start over
+            start = None
+    if start is None:
+        skip = (page - 1) * limit
+        position = len(keys) - 1 if descending else 0
+        if matches is None:
+            position = position - skip if descending else position + skip
+            skip = 0
+
+    step = -1 if descending else 1
+    page_products = []
+    last_key = None
+    has_more = False
+    while 0 <= position < len(keys):
+        product = products.get(keys[position][1])
+        position += step
+        if product is None or (matches is not None and not matches(product)):
+            continue
+        if skip:
+            skip -= 1
+            continue
+        if len(page_products) == limit:
+            has_more = True
+            break
+        page_products.append(product)
+        last_key = orders.key_of(order, product)
+
+    next_cursor = encode_cursor(last_key) if has_more else None
+    return Listing(page_products, sort, filters, limit, page, next_cursor, total)
@@ -0,0 +1,238 @@
+import bisect
+import itertools
+import random
+import threading
+import time
+from functools import wraps
+
+from flask import before_render_template, request, template_rendered
+
+# Latency histogram bucket bounds in seconds (the Prometheus defaults)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestTimer:
+    # What one sampled request spent, per phase, and how often it called
+    # the counted functions
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.endpoint = None
+        self.phases = {}
+        self.calls = {}
+        self.renders = []
+
+    def add(self, phase, seconds):
+        total, count = self.phases.get(phase, (0.0, 0))
+        self.phases[phase] = (total + seconds, count + 1)
+
+
+class EndpointStats:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.phases = {}
+        self.calls = {}
+
+    def record(self, seconds, timer):
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        for phase, (total, count) in timer.phases.items():
+            old_total, old_count = self.phases.get(phase, (0.0, 0))
+            self.phases[phase] = (old_total + total, old_count + count)
+        for name, count in timer.calls.items():
+            self.calls[name] = self.calls.get(name, 0) + count
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th request
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return bound
+        return 0.0
+
+
+class Metrics:
+    # Opt-in request profiling. Wraps app.wsgi_app and, for a random
+    # `sample_rate` share of requests, records the latency per endpoint in
+    # a histogram plus the time spent in named phases (storage, templates,
+    # sessions, password hashing, ...) and how often counted functions ran.
+    # Requests that are not sampled cost a counter increment and one
+    # random() call, without taking the lock, and wrapped functions one
+    # thread-local lookup, so the overhead stays well under a percent at
+    # the default rate.
+    #
+    # Phases come from wrap(obj, method, phase) and timed(phase); counts
+    # from counted(name). Gauges registered with gauge(name, fn) are read
+    # when the metrics are exported.
+
+    def __init__(self, sample_rate=0.1):
+        self.sample_rate = sample_rate
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._gauges = {}
+        self.started = time.time()
+        # next() on an itertools.count is atomic, so every request is
+        # counted without the lock; _reads is advanced by each read of the
+        # count (under the lock) and subtracted again, see _request_count()
+        self._requests = itertools.count()
+        self._reads = itertools.count()
+        self.sampled = 0
+
+    def init_app(self, app):
+        wsgi_app = app.wsgi_app
+
+        def middleware(environ, start_response):
+            next(self._requests)
+            if random.random() >= self.sample_rate:
+                return wsgi_app(environ, start_response)
+            timer = self._local.timer = RequestTimer()
+            try:
+                return wsgi_app(environ, start_response)
+            finally:
+                self._local.timer = None
+                self._record(timer, time.perf_counter() - timer.started)
+
+        app.wsgi_app = middleware
+
+        @app.before_request
+        def metrics_endpoint():
+            timer = getattr(self._local, 'timer', None)
+            if timer is not None:
+                timer.endpoint = request.endpoint or 'unmatched'
+
+        def render_started(sender, template, context, **extra):
+            timer = getattr(self._local, 'timer', None)
+            if timer is not None:
+                timer.renders.append(time.perf_counter())
+
+        def render_finished(sender, template, context, **extra):
+            timer = getattr(self._local, 'timer', None)
+            if timer is not None and timer.renders:
+                timer.add('template_render', time.perf_counter() - timer.renders.pop())
+
+        before_render_template.connect(render_started, app, weak=False)
+        template_rendered.connect(render_finished, app, weak=False)
+        self.wrap(app.session_interface, 'save_session', 'session_save')
+
+    def _record(self, timer, seconds):
+        endpoint = timer.endpoint or 'unmatched'
+        with self._lock:
+            self.sampled += 1
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = EndpointStats()
+            stats.record(seconds, timer)
+
+    def _request_count(self):
+        # Requests seen so far; call with the lock held. Reading advances
+        # _requests too, which the matching advance of _reads cancels out
+        return next(self._requests) - next(self._reads)
+
+    def timed(self, phase):
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                timer = getattr(self._local, 'timer', None)
+                if timer is None:
+                    return fn(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    timer.add(phase, time.perf_counter() - started)
+            return wrapper
+        return decorator
+
+    def counted(self, name):
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                timer = getattr(self._local, 'timer', None)
+                if timer is not None:
+                    timer.calls[name] = timer.calls.get(name, 0) + 1
+                return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def wrap(self, obj, method, phase):
+        # Times obj.method under `phase` (replaces the bound method on obj)
+        setattr(obj, method, self.timed(phase)(getattr(obj, method)))
+
+    def gauge(self, name, fn):
+        self._gauges[name] = fn
+
+    def snapshot(self):
+        # Per endpoint: count, mean, p50/p95/p99 (bucket bounds), phases
+        # as (total seconds, calls) and counted calls per request
+        with self._lock:
+            endpoints = {}
+            for name, stats in sorted(self._endpoints.items()):
+                endpoints[name] = {
+                    'count': stats.count,
+                    'mean': stats.total / stats.count,
+                    'p50': stats.quantile(0.5),
+                    'p95': stats.quantile(0.95),
+                    'p99': stats.quantile(0.99),
+                    'phases': dict(stats.phases),
+                    'calls_per_request': {k: v / stats.count for k, v in stats.calls.items()}
+                }
+            summary = {
+                'sample_rate': self.sample_rate,
+                'requests': self._request_count(),
+                'sampled': self.sampled,
+                'uptime': time.time() - self.started,
+                'endpoints': endpoints
+            }
+        summary['gauges'] = {name: fn() for name, fn in sorted(self._gauges.items())}
+        return summary
+
+    def prometheus(self, prefix='koodak'):
+        # Prometheus text exposition format (version 0.0.4)
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        lines = [
+            '# HELP %s_request_duration_seconds Latency of sampled requests by endpoint' % prefix,
+            '# TYPE %s_request_duration_seconds histogram' % prefix,
+        ]
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            for name, stats in endpoints:
+                cumulative = 0
+                for bound, count in zip(BUCKETS + (float('inf'),), stats.buckets):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_request_duration_seconds_bucket{endpoint="%s",le="%s"} %d' % (prefix, label(name), le, cumulative))
+                lines.append('%s_request_duration_seconds_sum{endpoint="%s"} %r' % (prefix, label(name), stats.total))
+                lines.append('%s_request_duration_seconds_count{endpoint="%s"} %d' % (prefix, label(name), stats.count))
+            lines.append('# HELP %s_phase_seconds_total Time sampled requests spent per phase' % prefix)
+            lines.append('# TYPE %s_phase_seconds_total counter' % prefix)
+            for name, stats in endpoints:
+                for phase, (total, count) in sorted(stats.phases.items()):
+                    lines.append('%s_phase_seconds_total{endpoint="%s",phase="%s"} %r' % (prefix, label(name), phase, total))
+            lines.append('# HELP %s_phase_calls_total Calls per phase in sampled requests' % prefix)
+            lines.append('# TYPE %s_phase_calls_total counter' % prefix)
+            for name, stats in endpoints:
+                for phase, (total, count) in sorted(stats.phases.items()):
+                    lines.append('%s_phase_calls_total{endpoint="%s",phase="%s"} %d' % (prefix, label(name), phase, count))
+            lines.append('# HELP %s_function_calls_total Counted function calls in sampled requests' % prefix)
+            lines.append('# TYPE %s_function_calls_total counter' % prefix)
+            for name, stats in endpoints:
+                for function, count in sorted(stats.calls.items()):
+                    lines.append('%s_function_calls_total{endpoint="%s",function="%s"} %d' % (prefix, label(name), function, count))
+            lines.append('# TYPE %s_requests_total counter' % prefix)
+            lines.append('%s_requests_total %d' % (prefix, self._request_count()))
+            lines.append('# TYPE %s_sampled_requests_total counter' % prefix)
+            lines.append('%s_sampled_requests_total %d' % (prefix, self.sampled))
+        lines.append('# TYPE %s_metrics_sample_rate gauge' % prefix)
+        lines.append('%s_metrics_sample_rate %r' % (prefix, self.sample_rate))
+        for name, fn in sorted(self._gauges.items()):
+            lines.append('# TYPE %s_%s gauge' % (prefix, name))
+            lines.append('%s_%s %r' % (prefix, name, fn()))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,224 @@
+import json
+import os
+import threading
+import time
+
+from storage import locked_file
+
+# Order statuses. A pending order holds its stock until it is confirmed,
+# cancelled or its reservation expires.
+PENDING = 'pending'
+CONFIRMED = 'confirmed'
+CANCELLED = 'cancelled'
+EXPIRED = 'expired'
+
+# How long a pending order keeps its stock reserved
+RESERVATION_TTL = 15 * 60
+
+# What Checkout.place keeps from the customer's checkout form
+DETAIL_KEYS = ('name', 'phone', 'address')
+
+
+class OrderLog:
+    # Orders in an append-only JSON lines file (data/orders.log): a
+    # 'create' line per order and a 'status' line per status change, never
+    # rewritten. Every worker keeps the replayed orders in memory and reads
+    # only the lines appended since it last looked. Appends happen under an
+    # exclusive lock (fcntl.flock where available), which also makes order
+    # ids and status changes race-free between workers.
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._orders = {}
+        self._offset = 0
+
+    def _locked(self):
+        return locked_file(self.path + '.lock', self._lock)
+
+    def _catch_up(self):
+        # Applies lines appended since the last call; a torn trailing line
+        # from a crashed writer is left for the next append to cut off
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry['op'] == 'create':
+                self._orders[entry['order']['id']] = entry['order']
+            elif entry['op'] == 'status':
+                order = self._orders.get(entry['id'])
+                if order is not None:
+                    # Replace, not mutate: callers may hold the old dict
+                    self._orders[entry['id']] = dict(order, status=entry['status'], updated_at=entry['at'])
+        self._offset += end
+
+    def _append(self, entry):
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with open(self.path, 'ab') as f:
+            f.truncate(self._offset)
+            f.write(line.encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def get(self, order_id):
+        with self._lock:
+            self._catch_up()
+            return self._orders.get(order_id)
+
+    def all(self):
+        # Newest first
+        with self._lock:
+            self._catch_up()
+            return sorted(self._orders.values(), key=lambda o: o['id'], reverse=True)
+
+    def for_user(self, user_id):
+        return [o for o in self.all() if o.get('user_id') == user_id]
+
+    def expired(self, now=None):
+        # Pending orders whose reservation ran out
+        now = time.time() if now is None else now
+        with self._lock:
+            self._catch_up()
+            return [o for o in self._orders.values() if o['status'] == PENDING and o['expires_at'] <= now]
+
+    def create(self, order):
+        # Assigns the next order id and appends the order
+        with self._locked():
+            self._catch_up()
+            order = dict(order, id=max(self._orders, default=0) + 1)
+            self._append({'op': 'create', 'order': order})
+            self._catch_up()
+            return self._orders[order['id']]
+
+    def transition(self, order_id, from_status, to_status):
+        # Moves the order from `from_status` to `to_status`. Returns False,
+        # changing nothing, when it is in another status by now (e.g. the
+        # sweeper expired it while the customer was confirming).
+        with self._locked():
+            self._catch_up()
+            order = self._orders.get(order_id)
+            if order is None or order['status'] != from_status:
+                return False
+            self._append({'op': 'status', 'id': order_id, 'status': to_status, 'at': time.time()})
+            self._catch_up()
+            return True
+
+
+class Checkout:
+    # Turns a priced cart (pricing.CartQuote) into a pending order. Stock
+    # for every line is taken in one storage.adjust_stock call, which checks
+    # and writes under the storage's write lock, so concurrent checkouts of
+    # the same product in any number of workers can never oversell.
+    # `on_stock_change(transition, products)` is called after each stock
+    # write so the caller can update its cached catalog.
+
+    def __init__(self, storage, log, on_stock_change=None, ttl=RESERVATION_TTL):
+        self.storage = storage
+        self.log = log
+        self.on_stock_change = on_stock_change
+        self.ttl = ttl
+
+    def _adjust(self, deltas):
+        transition, products = self.storage.adjust_stock(deltas)
+        if self.on_stock_change is not None:
+            self.on_stock_change(transition, products)
+
+    def _reserved(self, order):
+        deltas = {}
+        for item in order['items']:
+            deltas[item['product_id']] = deltas.get(item['product_id'], 0) + item['quantity']
+        return deltas
+
+    def place(self, quote, details, user_id=None, created_at=None):
+        # Raises storage.OutOfStock when any line cannot be reserved. Only
+        # the DETAIL_KEYS of details are kept, so a caller cannot overwrite
+        # the status, items or total
+        items = [{
+            'product_id': line['id'],
+            'name': line['name'],
+            'size': line['selected_size'],
+            'color': line['selected_color'],
+            'quantity': line['quantity'],
+            'unit_price': line['final_price'],
+            'subtotal': line['subtotal']
+        } for line in quote.lines]
+        order = {
+            'user_id': user_id,
+            'items': items,
+            'total': quote.total,
+            'status': PENDING,
+            'expires_at': time.time() + self.ttl,
+            'created_at': created_at
+        }
+        order.update((key, details.get(key)) for key in DETAIL_KEYS)
+        reserved = self._reserved(order)
+        if any(item['quantity'] <= 0 for item in items):
+            # A negative line would add stock instead of reserving it
+            raise ValueError('order quantities must be positive')
+        self._adjust({product_id: -quantity for product_id, quantity in reserved.items()})
+        try:
+            return self.log.create(order)
+        except:
+            # No order to release it later, so give the stock back now
+            self._adjust(reserved)
+            raise
+
+    def confirm(self, order_id):
+        # False when the reservation ran out, even if the sweeper has not
+        # released it yet
+        order = self.log.get(order_id)
+        if order is not None and order['status'] == PENDING and order['expires_at'] <= time.time():
+            self._release(order_id, EXPIRED)
+            return False
+        return self.log.transition(order_id, PENDING, CONFIRMED)
+
+    def cancel(self, order_id):
+        return self._release(order_id, CANCELLED)
+
+    def _release(self, order_id, status):
+        # Whoever wins the status change gives the stock back, exactly once
+        if not self.log.transition(order_id, PENDING, status):
+            return False
+        self._adjust(self._reserved(self.log.get(order_id)))
+        return True
+
+    def release_expired(self, now=None):
+        return sum(1 for order in self.log.expired(now) if self._release(order['id'], EXPIRED))
+
+
+class ReservationSweeper:
+    # Daemon thread releasing expired reservations every `interval`
+    # seconds. Each worker may run one; OrderLog.transition makes sure a
+    # reservation is released only once.
+
+    def __init__(self, checkout, interval=60):
+        self.checkout = checkout
+        self.interval = interval
+        self.released = 0
+        self.errors = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # Again in a forked worker, where the parent's thread does not run
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='reservation-sweeper', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.released += self.checkout.release_expired()
+            except:
+                # Try again on the next round
+                self.errors += 1
@@ -0,0 +1,190 @@
+import gzip
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request
+from werkzeug.wrappers import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Smaller bodies are not worth compressing
+MIN_COMPRESS_SIZE = 500
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json')
+
+
+def accepted_encoding(content_type, size):
+    if size < MIN_COMPRESS_SIZE or not content_type.startswith(COMPRESSIBLE_TYPES):
+        return None
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def encode_body(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    return body
+
+
+def conditional_response(body, content_type, etag=None, last_modified=None, variants=None):
+    # Builds the response for `body`, compressed as the client accepts, and
+    # turns it into a 304 when the client's copy is current. `variants` holds
+    # already encoded bodies (see CachedResponse). Without `etag` the body is
+    # hashed for one.
+    encoding = accepted_encoding(content_type, len(body))
+    if variants is not None and encoding in variants:
+        data = variants[encoding]
+    else:
+        data = encode_body(body, encoding)
+    response = Response(data, content_type=content_type)
+    etag = etag or hashlib.md5(body).hexdigest()
+    if encoding:
+        # Each encoding is its own representation with its own strong ETag
+        response.headers['Content-Encoding'] = encoding
+        etag = '%s-%s' % (etag, encoding)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    # Browsers may keep the response but must ask before reusing it
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
+class CachedResponse:
+    # Rendered body plus what is needed to rebuild and revalidate it
+
+    def __init__(self, version, body, content_type, etag=None):
+        self.version = version
+        self.body = body
+        self.content_type = content_type
+        self.etag = etag or hashlib.md5(body).hexdigest()
+        self.last_modified = int(time.time())
+        # Compress once up front so hits only pick a variant
+        self.variants = {None: body}
+        if len(body) >= MIN_COMPRESS_SIZE and content_type.startswith(COMPRESSIBLE_TYPES):
+            for encoding in ('gzip', 'br') if brotli is not None else ('gzip',):
+                self.variants[encoding] = encode_body(body, encoding)
+        self.size = sum(len(data) for data in self.variants.values())
+
+    def response(self):
+        return conditional_response(self.body, self.content_type, self.etag, self.last_modified, self.variants)
+
+
+class ResponseCache:
+    # LRU cache of rendered GET responses, bounded by the total size of the
+    # cached bodies and their compressed variants. Entries carry the version
+    # they were rendered for (e.g. catalog revision and Jalali day); an entry
+    # from an older version is re-rendered on its next request and old ones
+    # age out through the LRU.
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        # Versions count from zero in every process, so ETags also carry
+        # this cache's own id: another worker's or an earlier run's tag for
+        # the same URL and version never matches
+        self._id = os.urandom(8).hex()
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.version != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, entry):
+        # A single body larger than an eighth of the budget is not worth
+        # evicting everything else for
+        if entry.size > self.max_bytes // 8:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            self._entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def etag(self, key, version):
+        # The body is fixed by what it was rendered for, so the tag comes
+        # from that instead of hashing the body
+        return hashlib.md5(repr((self._id, version, key)).encode('utf-8')).hexdigest()
+
+    def cached(self, version, bypass):
+        # View decorator. `version()` returns what cached pages depend on,
+        # `bypass()` is true for requests that must be rendered fresh
+        # (logged-in users, pending flash messages, ...).
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if request.method not in ('GET', 'HEAD') or bypass():
+                    with self._lock:
+                        self.bypasses += 1
+                    return view(*args, **kwargs)
+                key = (request.endpoint, request.path, tuple(sorted(request.args.items(multi=True))))
+                current = version()
+                entry = self.get(key, current)
+                if entry is None:
+                    response = view(*args, **kwargs)
+                    # Only rendered pages and plain 200 responses are cached
+                    if isinstance(response, str):
+                        body, content_type = response.encode('utf-8'), 'text/html; charset=utf-8'
+                    elif (isinstance(response, Response) and response.status_code == 200
+                          and not response.is_streamed and 'Content-Encoding' not in response.headers):
+                        body, content_type = response.get_data(), response.content_type
+                    else:
+                        return response
+                    # Not when the view itself flashed a message either
+                    if bypass():
+                        return response
+                    entry = CachedResponse(current, body, content_type, self.etag(key, current))
+                    self.set(key, entry)
+                return entry.response()
+            return wrapper
+        return decorator
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'bypasses': self.bypasses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
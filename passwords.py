@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# werkzeug method string; the numbers set the cost, e.g. 'scrypt:65536:8:1'
+# or 'pbkdf2:sha256:600000'. Stored hashes made with another method are
+# re-hashed on the user's next successful login.
+DEFAULT_METHOD = 'scrypt'
+
+
+class PasswordPoolBusy(Exception):
+    # Too many hashes queued, or one did not finish in time; the request
+    # should be answered with "try again later" instead of waiting
+    pass
+
+
+class PasswordHasher:
+    # Runs generate_password_hash/check_password_hash on a small dedicated
+    # pool so login storms cannot occupy every request thread. hashlib
+    # releases the GIL while running the KDF, so threads are enough;
+    # pool='process' moves it out of the process altogether. At most
+    # `max_pending` hashes may be queued or running; beyond that callers
+    # get PasswordPoolBusy right away (backpressure) rather than a queue
+    # that grows without bound.
+
+    def __init__(self, method=DEFAULT_METHOD, workers=2, max_pending=32, pool='thread', timeout=10):
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pool = pool
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._prefix = None
+        self.pending = 0
+        self.peak_pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+
+    def _pool(self):
+        # Created on first use and again after a fork, so a preloading
+        # server never hands a parent's pool to its workers
+        if self._executor is None or self._pid != os.getpid():
+            if self.pool == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password')
+            self._pid = os.getpid()
+        return self._executor
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+            self.completed += 1
+
+    def _run(self, fn, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise PasswordPoolBusy()
+            self.pending += 1
+            self.peak_pending = max(self.peak_pending, self.pending)
+            future = self._pool().submit(fn, *args)
+        future.add_done_callback(self._done)
+        started = time.perf_counter()
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            with self._lock:
+                self.timeouts += 1
+            raise PasswordPoolBusy()
+        finally:
+            with self._lock:
+                self.wait_seconds += time.perf_counter() - started
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        # True when the stored hash was made with another method or cost
+        if self._prefix is None:
+            self._prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return pwhash.split('$', 1)[0] != self._prefix
+
+    def stats(self):
+        with self._lock:
+            return {
+                'method': self.method,
+                'pool': self.pool,
+                'workers': self.workers,
+                'pending': self.pending,
+                'peak_pending': self.peak_pending,
+                'max_pending': self.max_pending,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'wait_seconds': self.wait_seconds
+            }
+
+
+class LoginThrottle:
+    # Fixed-window counters kept in memory (per process). Every login or
+    # registration attempt counts against the client IP and every failed
+    # login against the email, so a burst is turned away before it reaches
+    # the hashing pool. Counters older than `window` seconds are swept at
+    # most once a minute.
+
+    def __init__(self, ip_limit=60, email_limit=5, window=300, sweep_interval=60):
+        self.ip_limit = ip_limit
+        self.email_limit = email_limit
+        self.window = window
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._next_sweep = time.time() + sweep_interval
+        self.blocked = 0
+
+    def _count(self, key, now):
+        entry = self._counters.get(key)
+        if entry is None or entry[0] + self.window <= now:
+            return 0
+        return entry[1]
+
+    def _hit(self, key, now):
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.sweep_interval
+            for expired in [k for k, (started, count) in self._counters.items() if started + self.window <= now]:
+                del self._counters[expired]
+        entry = self._counters.get(key)
+        if entry is None or entry[0] + self.window <= now:
+            self._counters[key] = (now, 1)
+        else:
+            self._counters[key] = (entry[0], entry[1] + 1)
+
+    def attempt(self, ip, email=None):
+        # Counts an attempt from `ip`; False if it or `email` is over its limit
+        now = time.time()
+        with self._lock:
+            allowed = (self._count(('ip', ip), now) < self.ip_limit
+                       and (email is None or self._count(('email', email), now) < self.email_limit))
+            self._hit(('ip', ip), now)
+            if not allowed:
+                self.blocked += 1
+            return allowed
+
+    def failed(self, email):
+        with self._lock:
+            self._hit(('email', email), time.time())
+
+    def succeeded(self, email):
+        with self._lock:
+            self._counters.pop(('email', email), None)
@@ -0,0 +1,77 @@
+# Problems a priced cart line can report
+OUT_OF_STOCK = 'out_of_stock'
+INSUFFICIENT_STOCK = 'insufficient_stock'
+INVALID_SIZE = 'invalid_size'
+INVALID_COLOR = 'invalid_color'
+INVALID_QUANTITY = 'invalid_quantity'
+
+
+class CartQuote:
+    # Result of pricing a cart: `lines` are the product dicts the cart
+    # template always got (product fields plus quantity, selected_size,
+    # selected_color, final_price, subtotal) with a `problems` list added
+
+    def __init__(self, lines, total, missing):
+        self.lines = lines
+        self.total = total
+        self.missing = missing
+        self.problems = [(line['id'], problem) for line in lines for problem in line['problems']]
+        self.ok = not self.problems and not missing
+
+    def __len__(self):
+        return len(self.lines)
+
+
+def line_problems(product, wanted, size, color, quantity=1):
+    # `wanted` is the quantity of this product over all of the cart's lines,
+    # `quantity` that of this line
+    problems = []
+    stock = product.get('stock') or 0
+    if quantity <= 0:
+        problems.append(INVALID_QUANTITY)
+    if stock <= 0:
+        problems.append(OUT_OF_STOCK)
+    elif wanted > stock:
+        problems.append(INSUFFICIENT_STOCK)
+    if size and product.get('sizes') and size not in product['sizes']:
+        problems.append(INVALID_SIZE)
+    if color and product.get('colors') and color not in product['colors']:
+        problems.append(INVALID_COLOR)
+    return problems
+
+
+def price_cart(items, products, active_prices):
+    # Prices cart items ({'product_id', 'quantity', 'size', 'color'}) in one
+    # pass: ids are resolved once against the ProductRepository and unit
+    # prices come from `active_prices` ({id: discounted price} for today,
+    # see DiscountSchedule.active_prices), falling back to the list price.
+    # Items whose product no longer exists are left out and listed in
+    # `missing`, as the cart page always did.
+    wanted = {}
+    for item in items:
+        wanted[item['product_id']] = wanted.get(item['product_id'], 0) + item['quantity']
+    found = {product_id: products.get(product_id) for product_id in wanted}
+    lines = []
+    missing = []
+    total = 0
+    for item in items:
+        product = found[item['product_id']]
+        if product is None:
+            missing.append(item['product_id'])
+            continue
+        quantity = item['quantity']
+        size = item.get('size', '')
+        color = item.get('color', '')
+        price = active_prices.get(product['id']) or product['price']
+        line = {
+            **product,
+            'quantity': quantity,
+            'selected_size': size,
+            'selected_color': color,
+            'final_price': price,
+            'subtotal': price * quantity,
+            'problems': line_problems(product, wanted[product['id']], size, color, quantity)
+        }
+        lines.append(line)
+        total += line['subtotal']
+    return CartQuote(lines, total, missing)
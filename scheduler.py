@@ -0,0 +1,104 @@
+import threading
+import time
+
+from discounts import next_midnight
+
+
+class SystemClock:
+    def now(self):
+        return time.time()
+
+    def wait(self, event, seconds):
+        # True if `event` was set meanwhile
+        return event.wait(seconds)
+
+
+class ManualClock:
+    # Clock for offline tests: time only moves through advance(), and a
+    # wait() moves it forward by the time waited instead of sleeping
+
+    def __init__(self, start):
+        self.time = start
+
+    def now(self):
+        return self.time
+
+    def advance(self, seconds):
+        self.time += seconds
+
+    def wait(self, event, seconds):
+        self.time += seconds
+        return event.is_set()
+
+
+class DayScheduler:
+    # Runs `tasks` (callables taking the clock's timestamp) once right after every
+    # local midnight, `delay` seconds into the new day. Discount windows are
+    # whole Jalali days, so midnight is also when discounts start and end;
+    # the tasks do the day's recomputation and page rendering before the
+    # first visitors would. Each worker runs its own, since what they warm
+    # is per process. The server's local time zone should be Tehran's.
+    #
+    # run_due() does the work synchronously when it is time, so the
+    # scheduler can be driven step by step with a ManualClock.
+
+    def __init__(self, tasks, clock=None, delay=1, max_sleep=300):
+        self.tasks = tasks
+        self.clock = clock or SystemClock()
+        self.delay = delay
+        # Wake up at least this often, in case the system clock jumps
+        self.max_sleep = max_sleep
+        self.next_run = next_midnight(self.clock.now()) + delay
+        self.runs = 0
+        self.errors = 0
+        self.last_run = None
+        self.last_duration = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def set_clock(self, clock):
+        self.clock = clock
+        self.next_run = next_midnight(clock.now()) + self.delay
+
+    def run_due(self):
+        # Runs the tasks if the next midnight has passed; True if it did
+        now = self.clock.now()
+        if now < self.next_run:
+            return False
+        started = time.perf_counter()
+        for task in self.tasks:
+            try:
+                task(now)
+            except:
+                # The remaining tasks still run; the day's values are
+                # computed lazily as before if warming failed
+                self.errors += 1
+        self.runs += 1
+        self.last_run = now
+        self.last_duration = time.perf_counter() - started
+        self.next_run = next_midnight(now) + self.delay
+        return True
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='day-scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.run_due()
+            wait = min(max(self.next_run - self.clock.now(), 0), self.max_sleep)
+            if self.clock.wait(self._stop, wait):
+                break
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'errors': self.errors,
+            'last_run': self.last_run,
+            'last_duration': self.last_duration,
+            'next_run': self.next_run
+        }
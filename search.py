@@ -0,0 +1,192 @@
+import bisect
+import heapq
+import math
+import re
+import threading
+
+# Fields searched and how much a match in each counts towards the score
+FIELDS = {
+    'name': 3.0,
+    'colors': 2.0,
+    'age_group': 2.0,
+    'sizes': 1.0,
+    'description': 1.0,
+}
+
+ZWNJ = '\u200c'
+
+# Arabic letters commonly typed instead of their Persian forms, plus
+# Arabic-Indic and Persian digits
+_CHAR_MAP = str.maketrans({
+    '\u064a': '\u06cc',  # ي -> ی
+    '\u0649': '\u06cc',  # ى -> ی
+    '\u0643': '\u06a9',  # ك -> ک
+    '\u0629': '\u0647',  # ة -> ه
+    '\u0623': '\u0627',  # أ -> ا
+    '\u0625': '\u0627',  # إ -> ا
+    '\u0622': '\u0627',  # آ -> ا
+    '\u0624': '\u0648',  # ؤ -> و
+    **{chr(0x0660 + d): str(d) for d in range(10)},
+    **{chr(0x06f0 + d): str(d) for d in range(10)},
+})
+
+# Harakat, superscript alef and tatweel
+_DIACRITICS = re.compile('[\u064b-\u065f\u0670\u0640]')
+_SEPARATORS = re.compile('[^\\w\u200c]+')
+
+# Limit on vocabulary words a trailing prefix may expand to
+MAX_PREFIX_EXPANSIONS = 50
+
+
+def normalize(text):
+    text = _DIACRITICS.sub('', str(text).translate(_CHAR_MAP)).lower()
+    # Zero-width joiners carry no meaning for matching
+    return text.replace('\u200d', '')
+
+
+def tokenize(text):
+    # Words joined with a ZWNJ ("ماجراجویی‌های") are indexed both joined
+    # ("ماجراجوییهای") and as their parts, so spelled with a space, a ZWNJ
+    # or nothing at all they still match.
+    tokens = []
+    for word in _SEPARATORS.split(normalize(text)):
+        if not word:
+            continue
+        if ZWNJ in word:
+            tokens.extend(part for part in word.split(ZWNJ) if part)
+            word = word.replace(ZWNJ, '')
+        if word:
+            tokens.append(word)
+    return tokens
+
+
+def query_tokens(text):
+    # Queries join ZWNJ-separated parts, matching the joined indexed form
+    return [t for t in _SEPARATORS.split(normalize(text).replace(ZWNJ, '')) if t]
+
+
+class SearchIndex:
+    # In-memory inverted index over the product fields in FIELDS, kept as a
+    # catalog index (see ProductRepository). Postings map a token to
+    # {product id: field weight}; queries AND all tokens, treat the last one
+    # as a prefix, and rank by weight times inverse document frequency.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = {}
+        self._documents = {}
+        self._vocabulary = None
+
+    def _weights(self, product):
+        weights = {}
+        for field, weight in FIELDS.items():
+            value = product.get(field)
+            if not value:
+                continue
+            values = value if isinstance(value, (list, tuple)) else [value]
+            for item in values:
+                for token in tokenize(item):
+                    weights[token] = weights.get(token, 0) + weight
+        return weights
+
+    def add(self, product):
+        weights = self._weights(product)
+        with self._lock:
+            self._documents[product['id']] = weights
+            for token, weight in weights.items():
+                postings = self._postings.get(token)
+                if postings is None:
+                    postings = self._postings[token] = {}
+                    self._vocabulary = None
+                postings[product['id']] = weight
+
+    def remove(self, product):
+        with self._lock:
+            weights = self._documents.pop(product['id'], None)
+            for token in weights or ():
+                postings = self._postings[token]
+                postings.pop(product['id'], None)
+                if not postings:
+                    del self._postings[token]
+                    self._vocabulary = None
+
+    def _expand(self, prefix):
+        # Vocabulary words starting with `prefix`, from a sorted word list
+        # rebuilt only after words were added or dropped
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self._postings)
+        vocabulary = self._vocabulary
+        i = bisect.bisect_left(vocabulary, prefix)
+        words = []
+        while i < len(vocabulary) and vocabulary[i].startswith(prefix) and len(words) < MAX_PREFIX_EXPANSIONS:
+            words.append(vocabulary[i])
+            i += 1
+        return words
+
+    def _idf(self, postings):
+        return math.log(1 + len(self._documents) / len(postings))
+
+    def _token_postings(self, token, prefix):
+        # [(postings, factor)] for the words a query token matches; factor is
+        # the word's idf, halved for prefix completions so an exact match
+        # outranks them
+        matches = []
+        if token in self._postings:
+            postings = self._postings[token]
+            matches.append((postings, self._idf(postings)))
+        if prefix:
+            for word in self._expand(token):
+                if word != token:
+                    postings = self._postings[word]
+                    matches.append((postings, self._idf(postings) * 0.5))
+        return matches
+
+    def search(self, text, limit=20):
+        # Returns [(product id, score)], best first
+        tokens = query_tokens(text)
+        if not tokens:
+            return []
+        with self._lock:
+            # The last token also matches as a prefix (search as you type)
+            per_token = [self._token_postings(t, n == len(tokens) - 1) for n, t in enumerate(tokens)]
+            if not all(per_token):
+                return []
+            if len(per_token) == 1 and len(per_token[0]) == 1:
+                # One word: its weights already rank the products
+                postings, factor = per_token[0][0]
+                top = heapq.nlargest(limit, postings, key=postings.get)
+                return [(i, postings[i] * factor) for i in top]
+            # Intersect the id sets, rarest token first, then score only the
+            # products every token matched
+            matched = []
+            for matches in per_token:
+                ids = matches[0][0].keys()
+                if len(matches) > 1:
+                    ids = set(ids).union(*(postings.keys() for postings, factor in matches[1:]))
+                matched.append(ids)
+            matched.sort(key=len)
+            candidates = set(matched[0])
+            for ids in matched[1:]:
+                candidates &= ids
+                if not candidates:
+                    return []
+            ranked = dict.fromkeys(candidates, 0.0)
+            for matches in per_token:
+                if len(matches) == 1:
+                    postings, factor = matches[0]
+                    for i in candidates:
+                        ranked[i] += postings[i] * factor
+                    continue
+                best = {}
+                for postings, factor in matches:
+                    for i in candidates.intersection(postings.keys()):
+                        score = postings[i] * factor
+                        if score > best.get(i, 0):
+                            best[i] = score
+                for i, score in best.items():
+                    ranked[i] += score
+        top = heapq.nlargest(limit, ranked, key=ranked.get)
+        return [(i, ranked[i]) for i in top]
+
+    def __len__(self):
+        return len(self._documents)
@@ -0,0 +1,705 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: writes are still serialized between threads, not processes
+    fcntl = None
+
+# Record kinds every backend stores; each record is a dict with an int 'id'
+KINDS = ('products', 'users')
+
+# SQLite keeps the ids changed by this many recent writes per kind for
+# changes(); a reader further behind loads everything again
+CHANGES_KEPT = 1000
+
+
+class OutOfStock(Exception):
+    # Raised by adjust_stock when some products lack the stock to take a
+    # reservation; nothing was changed
+
+    def __init__(self, product_ids):
+        super().__init__('Not enough stock for products %s' % ', '.join(map(str, product_ids)))
+        self.product_ids = product_ids
+
+
+class Duplicate(Exception):
+    # Raised by insert/update when another record already holds one of the
+    # record's unique keys; `fields` names them. Nothing was written.
+
+    def __init__(self, fields):
+        super().__init__('Duplicate %s' % ', '.join(fields))
+        self.fields = fields
+
+
+class UniqueIndex:
+    # (field, normalized value) -> record id for the keys `keys_of(record)`
+    # returns, so a uniqueness check is a few dict lookups
+
+    def __init__(self, keys_of, records=()):
+        self.keys_of = keys_of
+        self._ids = {}
+        self._keys = {}
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        keys = self.keys_of(record)
+        self._keys[record['id']] = keys
+        for key in keys:
+            self._ids[key] = record['id']
+
+    def remove(self, record_id):
+        for key in self._keys.pop(record_id, ()):
+            if self._ids.get(key) == record_id:
+                del self._ids[key]
+
+    def find(self, key):
+        return self._ids.get(key)
+
+    def check(self, record):
+        # An insert has no id yet, so every existing key conflicts with it
+        fields = [key[0] for key in self.keys_of(record) if self._ids.get(key, record.get('id')) != record.get('id')]
+        if fields:
+            raise Duplicate(fields)
+
+
+def apply_entries(by_id, entries, changed=None):
+    # Applies insert/update/delete entries (journal format) to `by_id`;
+    # ids of the records touched are added to `changed` if given
+    for change in entries:
+        if change['op'] == 'insert':
+            by_id[change['record']['id']] = change['record']
+        elif change['op'] == 'update':
+            if change['record']['id'] in by_id:
+                by_id[change['record']['id']] = change['record']
+        elif change['op'] == 'delete':
+            by_id.pop(change['id'], None)
+        if changed is not None:
+            changed.add(change['id'] if change['op'] == 'delete' else change['record']['id'])
+
+
+def assign_ids(entries, max_id):
+    # Numbers the inserts without an id from max_id + 1 on; returns the
+    # highest id in use afterwards
+    for change in entries:
+        if change['op'] == 'insert':
+            if change['record'].get('id') is None:
+                change['record']['id'] = max_id + 1
+            max_id = max(max_id, change['record']['id'])
+    return max_id
+
+
+def adjusted_stock(get, deltas):
+    # Copies of the products in `deltas` ({id: change in stock}) with their
+    # stock changed. Raises OutOfStock when a negative change would take a
+    # product below zero or the product is gone; positive changes to gone
+    # products (releasing a reservation) are skipped.
+    updated = []
+    short = []
+    for product_id, delta in sorted(deltas.items()):
+        record = get(product_id)
+        if record is None:
+            if delta < 0:
+                short.append(product_id)
+            continue
+        stock = (record.get('stock') or 0) + delta
+        if stock < 0:
+            short.append(product_id)
+            continue
+        record = dict(record)
+        record['stock'] = stock
+        updated.append(record)
+    if short:
+        raise OutOfStock(short)
+    return updated
+
+
+@contextmanager
+def locked_file(path, thread_lock):
+    # Exclusive fcntl.flock on the lock file `path`, taken by one thread at
+    # a time (`thread_lock`), so writers in other workers wait too. Shared
+    # by the JSON storage, the order log and anything else appending to
+    # files in the data directory.
+    with thread_lock:
+        if fcntl is None:
+            yield
+            return
+        with open(path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def thread_connection(local, path):
+    # The calling thread's connection to the SQLite database `path`, kept
+    # on the threading.local `local`. sqlite3 connections must not be
+    # shared between threads, nor with workers forked after the parent
+    # opened one, so a new one is made per thread and per process.
+    conn = getattr(local, 'conn', None)
+    if conn is None or local.pid != os.getpid():
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        local.conn = conn
+        local.pid = os.getpid()
+    return conn
+
+
+class JsonStorage:
+    # One JSON file per kind (data/products.json, data/users.json), the
+    # format the shop has always used, plus an append-only journal next to
+    # it (products.json.log) holding one JSON line per insert/update/delete.
+    #
+    # All writes happen under an exclusive lock (fcntl.flock on a .lock file
+    # where available, so parallel gunicorn workers serialize too). Single
+    # record writes only append a journal line; once the journal grows past
+    # `journal_limit` entries it is folded back into the snapshot. Snapshots
+    # are written to a temp file and os.replace'd, so a crash never leaves a
+    # half-written products.json behind.
+
+    def __init__(self, data_dir, compact=False, journal_limit=1000):
+        self.data_dir = data_dir
+        self.compact = compact
+        self.journal_limit = journal_limit
+        self.files = {kind: os.path.join(data_dir, kind + '.json') for kind in KINDS}
+        self._thread_locks = {kind: threading.Lock() for kind in KINDS}
+        # Per kind: (snapshot signature, journal offset, entries, max id) as
+        # of our last write, so the next write only reads the journal tail
+        self._tail = {}
+        # Per kind: (snapshot signature, journal offset, records by id,
+        # UniqueIndex or None) for writes that must check the current
+        # records under the lock
+        self._records = {}
+
+    def _journal(self, kind):
+        return self.files[kind] + '.log'
+
+    def _locked(self, kind):
+        return locked_file(self.files[kind] + '.lock', self._thread_locks[kind])
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def signature(self, kind):
+        snapshot = self._stat(self.files[kind])
+        if snapshot is None:
+            return None
+        return (snapshot, self._stat(self._journal(kind)))
+
+    def initialized(self, kind):
+        return os.path.exists(self.files[kind])
+
+    def load(self, kind):
+        return self.load_tracked(kind)[0]
+
+    def load_tracked(self, kind):
+        # The records plus a cursor for changes(): the snapshot they came
+        # from and how far the journal was replayed. A missing file is an
+        # empty store; an unreadable one is an error, never an empty list
+        # that the next save would write back.
+        snapshot = self._stat(self.files[kind])
+        try:
+            with open(self.files[kind], 'r', encoding='utf-8') as f:
+                records = json.load(f)
+        except FileNotFoundError:
+            return [], (None, 0)
+        by_id = {r['id']: r for r in records}
+        offset, entries = self._replay(kind, 0, by_id)
+        return list(by_id.values()), (snapshot, offset)
+
+    def changes(self, kind, cursor):
+        # What was written since `cursor` (from load_tracked or the last
+        # call), read from the journal tail only: (batch entries, new
+        # cursor), to be applied like apply_entries does. None once the
+        # snapshot was replaced (a save, or the journal folded into it);
+        # then only a load will do.
+        snapshot, offset = cursor
+        if snapshot is None or self._stat(self.files[kind]) != snapshot:
+            return None
+        offset, lines = self._read_journal(kind, offset)
+        # A fold between the check and the read removes the journal we
+        # meant to read; a new one then belongs to the new snapshot
+        if self._stat(self.files[kind]) != snapshot:
+            return None
+        entries = []
+        for entry in lines:
+            entries.extend(entry['entries'] if entry['op'] == 'batch' else (entry,))
+        return entries, (snapshot, offset)
+
+    def _read_journal(self, kind, offset):
+        # Journal lines from `offset` on, parsed, and the offset after the
+        # last complete line; a torn trailing line from a crashed writer is
+        # left out
+        try:
+            with open(self._journal(kind), 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return offset, []
+        end = data.rfind(b'\n') + 1
+        return offset + end, [json.loads(line) for line in data[:end].splitlines() if line.strip()]
+
+    def _replay(self, kind, offset, by_id, changed=None):
+        # Applies journal entries from `offset` on. Entries are idempotent
+        # (put/remove by id), so replaying ones already folded into the
+        # snapshot is harmless. Returns the offset after the last complete
+        # line and the number of entries read. Ids of the records touched
+        # are added to `changed` if given.
+        offset, lines = self._read_journal(kind, offset)
+        for entry in lines:
+            # A batch is one line, so its changes land all or nothing
+            apply_entries(by_id, entry['entries'] if entry['op'] == 'batch' else (entry,), changed)
+        return offset, len(lines)
+
+    def _dump(self, records, f):
+        if self.compact:
+            json.dump(records, f, ensure_ascii=False, separators=(',', ':'))
+        else:
+            json.dump(records, f, ensure_ascii=False, indent=4)
+
+    def _write_snapshot(self, kind, records):
+        fd, tmp_path = tempfile.mkstemp(dir=self.data_dir, prefix='.' + kind + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                self._dump(records, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.files[kind])
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        # The snapshot now holds everything, so the journal can go
+        if os.path.exists(self._journal(kind)):
+            os.remove(self._journal(kind))
+        self._tail.pop(kind, None)
+
+    def save(self, kind, records):
+        with self._locked(kind):
+            before = self.signature(kind)
+            self._write_snapshot(kind, list(records))
+            return (before, self.signature(kind))
+
+    def _sync_tail(self, kind):
+        # Catch up with journal lines other workers appended since our last
+        # write; fall back to a full load when the snapshot was replaced
+        snapshot = self._stat(self.files[kind])
+        tail = self._tail.get(kind)
+        if tail is not None and tail[0] == snapshot:
+            by_id = {}
+            offset, entries = self._replay(kind, tail[1], by_id)
+            max_id = max([tail[3]] + list(by_id))
+            entries += tail[2]
+        else:
+            records = self.load(kind)
+            max_id = max([r['id'] for r in records], default=0)
+            offset, entries = self._replay(kind, 0, {})
+        self._tail[kind] = (snapshot, offset, entries, max_id)
+        return self._tail[kind]
+
+    def _current(self, kind, unique=None):
+        # Current records by id, caught up with the journal tail, and with
+        # `unique` a UniqueIndex over them, updated only for the records
+        # changed since the last call. Callers hold the lock and must not
+        # modify the returned records.
+        snapshot = self._stat(self.files[kind])
+        cached = self._records.get(kind)
+        if cached is not None and cached[0] == snapshot:
+            by_id, index = cached[2], cached[3]
+            changed = set()
+            offset, entries = self._replay(kind, cached[1], by_id, changed)
+            for record_id in changed if index is not None else ():
+                index.remove(record_id)
+                if record_id in by_id:
+                    index.add(by_id[record_id])
+        else:
+            index = None
+            try:
+                with open(self.files[kind], 'r', encoding='utf-8') as f:
+                    by_id = {r['id']: r for r in json.load(f)}
+            except FileNotFoundError:
+                by_id = {}
+            offset, entries = self._replay(kind, 0, by_id)
+        if unique is not None and (index is None or index.keys_of is not unique):
+            index = UniqueIndex(unique, by_id.values())
+        self._records[kind] = (snapshot, offset, by_id, index)
+        return by_id, index
+
+    def _write_entry(self, kind, entry):
+        # Appends one journal line; the caller holds the lock
+        snapshot, offset, entries, max_id = self._sync_tail(kind)
+        max_id = assign_ids(entry['entries'] if entry['op'] == 'batch' else (entry,), max_id)
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with open(self._journal(kind), 'ab') as f:
+            # Drop a torn line left by a crashed writer before appending
+            f.truncate(offset)
+            f.write(line.encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        if entries + 1 >= self.journal_limit:
+            self._write_snapshot(kind, self.load(kind))
+        else:
+            self._tail[kind] = (snapshot, offset + len(line.encode('utf-8')), entries + 1, max_id)
+
+    def _append(self, kind, entry, unique=None):
+        with self._locked(kind):
+            before = self.signature(kind)
+            if unique is not None:
+                self._current(kind, unique)[1].check(entry['record'])
+            self._write_entry(kind, entry)
+            return (before, self.signature(kind))
+
+    # `unique(record)` returns the record's unique keys as (field, value)
+    # pairs; with it the write raises Duplicate instead of storing a record
+    # whose key another record already has. Checked under the write lock,
+    # so concurrent registrations cannot both succeed.
+
+    def insert(self, kind, record, unique=None):
+        return self._append(kind, {'op': 'insert', 'record': record}, unique)
+
+    def update(self, kind, record, unique=None):
+        return self._append(kind, {'op': 'update', 'record': record}, unique)
+
+    def delete(self, kind, record_id):
+        return self._append(kind, {'op': 'delete', 'id': record_id})
+
+    def batch(self, kind, entries):
+        # Several inserts, updates and deletes ({'op': 'insert', 'record':
+        # ...}, {'op': 'update', 'record': ...}, {'op': 'delete', 'id': ...})
+        # in one write: a single journal line, or for batches as long as the
+        # journal limit a new snapshot straight away. Inserts without an id
+        # get consecutive ones.
+        entries = list(entries)
+        with self._locked(kind):
+            before = self.signature(kind)
+            self._write_batch(kind, entries)
+            return (before, self.signature(kind))
+
+    def modify(self, kind, plan):
+        # Read-modify-write as one batch: `plan(records)` gets the current
+        # records ({id: record}, not to be modified) under the write lock
+        # and returns the batch entries to write, so nothing another worker
+        # writes meanwhile is lost. Returns the transition and the entries.
+        with self._locked(kind):
+            before = self.signature(kind)
+            entries = list(plan(self._current(kind)[0]))
+            if entries:
+                self._write_batch(kind, entries)
+            return (before, self.signature(kind)), entries
+
+    def _write_batch(self, kind, entries):
+        if len(entries) < self.journal_limit:
+            self._write_entry(kind, {'op': 'batch', 'entries': entries})
+        else:
+            by_id = dict(self._current(kind)[0])
+            assign_ids(entries, max([self._sync_tail(kind)[3]] + list(by_id)))
+            apply_entries(by_id, entries)
+            self._write_snapshot(kind, list(by_id.values()))
+
+    def adjust_stock(self, deltas):
+        # Changes the stock of several products at once ({id: delta}), all
+        # or nothing: the check and the write happen under the products
+        # lock, so concurrent checkouts in any worker cannot oversell.
+        # Returns the write's transition and the updated products.
+        with self._locked('products'):
+            before = self.signature('products')
+            updated = adjusted_stock(self._current('products')[0].get, deltas)
+            if updated:
+                self._write_entry('products', {'op': 'batch', 'entries': [
+                    {'op': 'update', 'record': record} for record in updated]})
+            return (before, self.signature('products')), updated
+
+
+class SqliteStorage:
+    # One row per record in a WAL-mode SQLite database. The full record is
+    # kept as JSON in `data`; the columns we look records up by are copied
+    # next to it and indexed. A per-kind revision counter in `meta` is bumped
+    # in the same transaction as every write and serves as the signature
+    # CatalogStore compares, so other workers' writes are noticed cheaply.
+    # Unique keys (see JsonStorage.insert) live in `unique_keys`, which is
+    # rebuilt when a write that did not maintain it changed the kind since.
+    # `changes` records the ids every write touched, under its revision, so
+    # other workers can fetch just those rows (see changes()).
+
+    COLUMNS = {
+        'products': ('category', 'created_at'),
+        'users': ('email', 'username'),
+    }
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY,
+            category TEXT,
+            created_at TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS products_category ON products (category);
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            email TEXT,
+            username TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS users_email ON users (email);
+        CREATE INDEX IF NOT EXISTS users_username ON users (username);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS unique_keys (
+            kind TEXT NOT NULL,
+            field TEXT NOT NULL,
+            value TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            PRIMARY KEY (kind, field, value)
+        );
+        CREATE INDEX IF NOT EXISTS unique_keys_id ON unique_keys (kind, id);
+        CREATE TABLE IF NOT EXISTS changes (
+            kind TEXT NOT NULL,
+            revision INTEGER NOT NULL,
+            id INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS changes_revision ON changes (kind, revision);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.connection().executescript(self.SCHEMA)
+
+    def connection(self):
+        return thread_connection(self._local, self.path)
+
+    def signature(self, kind):
+        row = self.connection().execute('SELECT value FROM meta WHERE key = ?', (kind,)).fetchone()
+        return row[0] if row else None
+
+    def initialized(self, kind):
+        return self.signature(kind) is not None
+
+    def load(self, kind):
+        rows = self.connection().execute('SELECT data FROM %s ORDER BY id' % kind)
+        return [json.loads(data) for (data,) in rows]
+
+    def load_tracked(self, kind):
+        # See JsonStorage.load_tracked; the cursor is the revision, read in
+        # the same transaction as the rows
+        conn = self.connection()
+        conn.execute('BEGIN')
+        try:
+            revision = self.signature(kind)
+            records = [json.loads(data) for (data,) in conn.execute('SELECT data FROM %s ORDER BY id' % kind)]
+        finally:
+            conn.execute('COMMIT')
+        return records, revision
+
+    def changes(self, kind, cursor):
+        # See JsonStorage.changes: the current row of every record changed
+        # since, as an insert (apply_entries puts it), or a delete if it is
+        # gone. None if the cursor is older than the last save or than the
+        # changes still kept.
+        conn = self.connection()
+        conn.execute('BEGIN')
+        try:
+            revision = self.signature(kind)
+            row = conn.execute('SELECT value FROM meta WHERE key = ?', (kind + ':reset',)).fetchone()
+            if cursor is None or revision is None or cursor < (row[0] if row else 0):
+                return None
+            ids = [i for (i,) in conn.execute('SELECT DISTINCT id FROM changes WHERE kind = ? AND revision > ?',
+                                              (kind, cursor))]
+            records = {}
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                rows = conn.execute('SELECT id, data FROM %s WHERE id IN (%s)' % (kind, ', '.join('?' * len(chunk))),
+                                    chunk)
+                for record_id, data in rows:
+                    records[record_id] = json.loads(data)
+        finally:
+            conn.execute('COMMIT')
+        return [{'op': 'insert', 'record': records[i]} if i in records else {'op': 'delete', 'id': i}
+                for i in ids], revision
+
+    def _row(self, kind, record):
+        data = json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+        return (record['id'],) + tuple(record.get(c) for c in self.COLUMNS[kind]) + (data,)
+
+    def _keys_revision(self, conn, kind):
+        row = conn.execute('SELECT value FROM meta WHERE key = ?', (kind + ':unique',)).fetchone()
+        return row[0] if row else None
+
+    def _write(self, kind, work, keeps_keys=False):
+        # `work(conn)` returns the ids it changed, or None if it rewrote the
+        # whole kind. `keeps_keys`: work updated unique_keys for the records
+        # it changed.
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            before = self.signature(kind)
+            ids = work(conn)
+            after = (before or 0) + 1
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (kind, after))
+            if ids is None:
+                self._reset_changes(conn, kind, after)
+            else:
+                conn.executemany('INSERT INTO changes (kind, revision, id) VALUES (?, ?, ?)',
+                                 [(kind, after, record_id) for record_id in set(ids)])
+                if after % CHANGES_KEPT == 0:
+                    self._reset_changes(conn, kind, after - CHANGES_KEPT)
+            if keeps_keys and self._keys_revision(conn, kind) == (before or 0):
+                conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (kind + ':unique', after))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        return (before, after)
+
+    def _reset_changes(self, conn, kind, revision):
+        # Forgets the changes up to `revision`; cursors older than it get
+        # None from changes()
+        conn.execute('DELETE FROM changes WHERE kind = ? AND revision <= ?', (kind, revision))
+        conn.execute('INSERT INTO meta (key, value) VALUES (?, ?) '
+                     'ON CONFLICT (key) DO UPDATE SET value = MAX(value, excluded.value)', (kind + ':reset', revision))
+
+    def _upsert_sql(self, kind):
+        columns = ('id',) + self.COLUMNS[kind] + ('data',)
+        return 'INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (kind, ', '.join(columns), ', '.join('?' * len(columns)))
+
+    def save(self, kind, records):
+        def work(conn):
+            conn.execute('DELETE FROM %s' % kind)
+            conn.executemany(self._upsert_sql(kind), [self._row(kind, r) for r in records])
+            return None  # everything changed
+        return self._write(kind, work)
+
+    def _check_unique(self, conn, kind, record, unique):
+        # Inside the write transaction: brings unique_keys up to date, then
+        # raises Duplicate if another record holds one of record's keys
+        revision = self.signature(kind) or 0
+        if self._keys_revision(conn, kind) != revision:
+            conn.execute('DELETE FROM unique_keys WHERE kind = ?', (kind,))
+            records = [json.loads(data) for (data,) in conn.execute('SELECT data FROM %s' % kind)]
+            conn.executemany('INSERT OR REPLACE INTO unique_keys (kind, field, value, id) VALUES (?, ?, ?, ?)',
+                             [(kind, field, value, r['id']) for r in records for field, value in unique(r)])
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (kind + ':unique', revision))
+        fields = []
+        for field, value in unique(record):
+            row = conn.execute('SELECT id FROM unique_keys WHERE kind = ? AND field = ? AND value = ?',
+                               (kind, field, value)).fetchone()
+            if row is not None and row[0] != record.get('id'):
+                fields.append(field)
+        if fields:
+            raise Duplicate(fields)
+
+    def _put_keys(self, conn, kind, record, unique):
+        conn.execute('DELETE FROM unique_keys WHERE kind = ? AND id = ?', (kind, record['id']))
+        conn.executemany('INSERT OR REPLACE INTO unique_keys (kind, field, value, id) VALUES (?, ?, ?, ?)',
+                         [(kind, field, value, record['id']) for field, value in unique(record)])
+
+    def insert(self, kind, record, unique=None):
+        def work(conn):
+            if unique is not None:
+                self._check_unique(conn, kind, record, unique)
+            if record.get('id') is None:
+                record['id'] = conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM %s' % kind).fetchone()[0]
+            conn.execute(self._upsert_sql(kind), self._row(kind, record))
+            if unique is not None:
+                self._put_keys(conn, kind, record, unique)
+            return (record['id'],)
+        return self._write(kind, work, keeps_keys=unique is not None)
+
+    def update(self, kind, record, unique=None):
+        columns = self.COLUMNS[kind] + ('data',)
+        sql = 'UPDATE %s SET %s WHERE id = ?' % (kind, ', '.join(c + ' = ?' for c in columns))
+        def work(conn):
+            if unique is not None:
+                self._check_unique(conn, kind, record, unique)
+            row = self._row(kind, record)
+            updated = conn.execute(sql, row[1:] + row[:1]).rowcount
+            if unique is not None and updated:
+                self._put_keys(conn, kind, record, unique)
+            return (record['id'],)
+        return self._write(kind, work, keeps_keys=unique is not None)
+
+    def delete(self, kind, record_id):
+        def work(conn):
+            conn.execute('DELETE FROM %s WHERE id = ?' % kind, (record_id,))
+            conn.execute('DELETE FROM unique_keys WHERE kind = ? AND id = ?', (kind, record_id))
+            return (record_id,)
+        return self._write(kind, work, keeps_keys=True)
+
+    def _apply_batch(self, conn, kind, entries):
+        columns = self.COLUMNS[kind] + ('data',)
+        update_sql = 'UPDATE %s SET %s WHERE id = ?' % (kind, ', '.join(c + ' = ?' for c in columns))
+        assign_ids(entries, conn.execute('SELECT COALESCE(MAX(id), 0) FROM %s' % kind).fetchone()[0])
+        for change in entries:
+            if change['op'] == 'insert':
+                conn.execute(self._upsert_sql(kind), self._row(kind, change['record']))
+            elif change['op'] == 'update':
+                row = self._row(kind, change['record'])
+                conn.execute(update_sql, row[1:] + row[:1])
+            elif change['op'] == 'delete':
+                conn.execute('DELETE FROM %s WHERE id = ?' % kind, (change['id'],))
+        return [change['id'] if change['op'] == 'delete' else change['record']['id'] for change in entries]
+
+    def batch(self, kind, entries):
+        # See JsonStorage.batch; one transaction
+        entries = list(entries)
+        return self._write(kind, lambda conn: self._apply_batch(conn, kind, entries))
+
+    def modify(self, kind, plan):
+        # See JsonStorage.modify; the records are read inside the write
+        # transaction
+        entries = []
+        def work(conn):
+            records = {r['id']: r for r in (json.loads(data) for (data,) in conn.execute('SELECT data FROM %s' % kind))}
+            entries.extend(plan(records))
+            return self._apply_batch(conn, kind, entries)
+        return self._write(kind, work), entries
+
+    def adjust_stock(self, deltas):
+        # See JsonStorage.adjust_stock; BEGIN IMMEDIATE holds the write lock
+        # from the stock check to the commit
+        updated = []
+        def work(conn):
+            ids = list(deltas)
+            if not ids:
+                return ()
+            rows = conn.execute('SELECT data FROM products WHERE id IN (%s)' % ', '.join('?' * len(ids)), ids)
+            current = {r['id']: r for r in (json.loads(data) for (data,) in rows)}
+            updated.extend(adjusted_stock(current.get, deltas))
+            conn.executemany('UPDATE products SET data = ? WHERE id = ?', [
+                (json.dumps(r, ensure_ascii=False, separators=(',', ':')), r['id']) for r in updated])
+            return [r['id'] for r in updated]
+        return self._write('products', work), updated
+
+
+def create_storage(backend, data_dir, compact=False):
+    if backend == 'json':
+        return JsonStorage(data_dir, compact=compact)
+    if backend == 'sqlite':
+        return SqliteStorage(os.path.join(data_dir, 'koodak_ziba.db'))
+    raise ValueError('Unknown storage backend: %s' % backend)
+
+
+def import_json(source, target):
+    # One-shot migration: copy every kind from a JsonStorage into another
+    # backend, replacing what the target holds. Returns counts per kind.
+    counts = {}
+    for kind in KINDS:
+        if source.initialized(kind):
+            records = source.load(kind)
+            target.save(kind, records)
+            counts[kind] = len(records)
+    return counts
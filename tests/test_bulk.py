@@ -0,0 +1,44 @@
+import io
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bulk import InvalidField, export_products, guess_format, import_products, read_rows
+
+TODAY = '1403/10/01'
+
+
+def run_import(data, fmt):
+    written = []
+    report = import_products(read_rows(io.BytesIO(data.encode('utf-8')), fmt), {}.get, written.extend, TODAY)
+    return report, [entry['record'] for entry in written]
+
+
+def test_json_array_round_trip():
+    products = [{'id': 1, 'name': 'پیراهن', 'price': 100000, 'category': 'girls', 'stock': 3},
+                {'id': 2, 'name': 'شلوار', 'price': 200000, 'category': 'boys', 'stock': 0}]
+    assert guess_format('products.JSON') == 'json'
+    assert guess_format('products.jsonl') == 'jsonl'
+    exported = ''.join(export_products(products, 'json', chunk_rows=1))
+    assert [p['name'] for p in json.loads(exported)] == ['پیراهن', 'شلوار']
+    assert json.loads(''.join(export_products([], 'json'))) == []
+
+    report, records = run_import(exported, 'json')
+    assert (report.inserted, report.failed) == (2, 0)
+    assert [(p['name'], p['price'], p['stock']) for p in records] == [('پیراهن', 100000, 3), ('شلوار', 200000, 0)]
+
+
+def test_json_rows_that_are_not_objects_are_reported():
+    report, records = run_import('[{"name": "کلاه", "price": 5000, "category": "girls"}, 7]', 'json')
+    assert (report.inserted, report.failed) == (1, 1)
+    assert report.errors[0][0] == 2
+
+
+@pytest.mark.parametrize('data', ['{"name": "کلاه"}\n{"name": "شال"}\n', '{"name": "کلاه"}', '[{"name": '])
+def test_json_that_is_not_an_array_is_rejected(data):
+    with pytest.raises(InvalidField):
+        run_import(data, 'json')
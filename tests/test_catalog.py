@@ -0,0 +1,91 @@
+import os
+import sys
+
+import jdatetime
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import CatalogStore, ProductRepository, stock_only
+from discounts import DiscountSchedule
+from facets import FacetIndex
+from storage import create_storage
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def backend(request, tmp_path):
+    create_storage(request.param, str(tmp_path)).save('products', [
+        {'id': i, 'name': 'محصول %d' % i, 'price': 100000, 'stock': 2, 'category': 'girls', 'sizes': [], 'colors': []}
+        for i in range(1, 51)
+    ])
+    return request.param
+
+
+def worker(backend, tmp_path):
+    # What each gunicorn worker has: its own storage object and catalog
+    storage = create_storage(backend, str(tmp_path))
+    catalog = CatalogStore(lambda: storage.load_tracked('products'), lambda: storage.signature('products'),
+                           indexes={'discounts': DiscountSchedule, 'facets': FacetIndex}, changes=lambda cursor: storage.changes('products', cursor),
+                           quiet=stock_only)
+    catalog.get()
+    return storage, catalog
+
+
+def in_stock(catalog):
+    return catalog.get().indexes['facets'].count({'in_stock': True})
+
+
+def test_other_workers_apply_stock_changes_without_reloading(backend, tmp_path):
+    storage, mine = worker(backend, tmp_path)
+    _, other = worker(backend, tmp_path)
+    version = other.version
+
+    transition, products = storage.adjust_stock({1: -1})
+    mine.commit(transition, None)
+    assert other.get().get(1)['stock'] == 1
+    assert mine.get().get(1)['stock'] == 1
+    # A stock count changed, nothing a cached page depends on
+    assert other.version == version
+    assert other.stats()['reloads'] == 0 and other.stats()['updates'] == 1
+
+    storage.adjust_stock({1: -1})
+    assert other.get().get(1)['stock'] == 0
+    assert in_stock(other) == 49
+    assert other.version == version + 1
+
+    product = dict(other.get().get(2), price=90000)
+    storage.update('products', product)
+    assert other.get().get(2)['price'] == 90000
+    assert other.version == version + 2
+    storage.delete('products', 3)
+    assert 3 not in other.get()
+    assert other.stats()['reloads'] == 0
+
+
+def test_full_save_reloads(backend, tmp_path):
+    storage, _ = worker(backend, tmp_path)
+    _, other = worker(backend, tmp_path)
+    storage.save('products', [{'id': 7, 'name': 'تنها', 'price': 1, 'stock': 1, 'sizes': [], 'colors': []}])
+    assert [p['id'] for p in other.get()] == [7]
+    assert other.stats()['reloads'] == 1
+
+
+def test_stock_only():
+    product = {'id': 1, 'price': 100, 'stock': 3}
+    assert stock_only(product, dict(product, stock=1))
+    assert not stock_only(product, dict(product, stock=0))
+    assert not stock_only(product, dict(product, price=90))
+    assert not stock_only(product, None)
+
+
+def test_facets_share_the_discount_schedule():
+    today = jdatetime.date.today()
+    product = {'id': 1, 'name': 'پیراهن', 'price': 100000, 'stock': 2, 'sizes': [], 'colors': []}
+    products = ProductRepository([product], {'discounts': DiscountSchedule, 'facets': FacetIndex})
+    facets = products.indexes['facets']
+    assert facets.count({'on_sale': True}) == 0
+    products.update(dict(product, has_discount=True, discount_percent=20,
+                         discount_start=today.strftime('%Y/%m/%d'),
+                         discount_end=(today + jdatetime.timedelta(days=3)).strftime('%Y/%m/%d')))
+    assert facets.count({'on_sale': True}) == 1
+    assert products.indexes['discounts'].active_on() == [1]
@@ -0,0 +1,100 @@
+import io
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import images
+from bulk import InvalidField, product_from_row
+from images import ImageStore, ImageUnavailable, InvalidImage, image_source
+
+PNG = b'\x89PNG\r\n\x1a\n'
+
+
+class Fetcher:
+    # The fetch= hook: serves `files` by URL and counts the calls
+    def __init__(self, files):
+        self.files = files
+        self.calls = []
+
+    def __call__(self, url):
+        self.calls.append(url)
+        return self.files[url]
+
+
+def store(tmp_path, fetch, **options):
+    return ImageStore(str(tmp_path / 'cache'), str(tmp_path / 'uploads'), fetch=fetch, **options)
+
+
+def test_fetched_image_is_converted_once_and_shared(tmp_path):
+    Image = pytest.importorskip('PIL.Image')
+    out = io.BytesIO()
+    Image.new('RGB', (1000, 600), 'pink').save(out, 'PNG')
+    url = 'https://example.com/dress.png'
+    fetch = Fetcher({url: out.getvalue()})
+    first = store(tmp_path, fetch)
+
+    path, mimetype = first.variant(('url', url), 'card', webp=True)
+    assert mimetype == 'image/webp'
+    with Image.open(path) as image:
+        assert max(image.size) == images.SIZES['card']
+    path, mimetype = first.variant(('url', url), 'thumb')
+    assert mimetype == 'image/jpeg'
+    with Image.open(path) as image:
+        assert max(image.size) == images.SIZES['thumb']
+    assert fetch.calls == [url]
+    assert first.stats()['conversions'] == 1
+
+    # Another worker finds the original and its variants on disk
+    second = store(tmp_path, Fetcher({}))
+    assert second.variant(('url', url), 'large', webp=True)[1] == 'image/webp'
+    assert second.stats()['fetches'] == 0 and second.stats()['conversions'] == 0
+
+
+def test_cache_evicts_least_recently_used_past_the_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(images, 'Image', None)  # originals only, so sizes are exact
+    files = {'https://example.com/%d.png' % i: PNG + bytes([i]) * 1000 for i in range(3)}
+    fetch = Fetcher(files)
+    cache = store(tmp_path, fetch, max_bytes=2500)
+    now = time.time()
+    for i, url in enumerate(files):
+        path, mimetype = cache.variant(('url', url), 'card')
+        assert mimetype == 'image/png'
+        os.utime(path, (now - 100 + i, now - 100 + i))
+
+    # The third original took the cache past 2500 bytes; the oldest went
+    originals = os.listdir(str(tmp_path / 'cache' / 'originals'))
+    assert len(originals) == 2
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['cached_bytes'] <= 2500
+    cache.variant(('url', 'https://example.com/0.png'), 'card')
+    assert fetch.calls == list(files) + ['https://example.com/0.png']
+
+
+def test_image_file_must_be_an_uploaded_digest(tmp_path):
+    fetch = Fetcher({})
+    cache = store(tmp_path, fetch)
+    digest = cache.save_upload(PNG + b'\0' * 100)
+    with pytest.raises(InvalidImage):
+        cache.save_upload(b'<html>')
+    (tmp_path / 'secret.png').write_bytes(PNG + b'\1' * 100)
+
+    for name in ('../secret.png', '../uploads/' + digest, '/' + digest, digest[:-1], digest + '/'):
+        assert not cache.has_upload(name)
+        assert image_source({'image_file': name}) is None
+        assert image_source({'image_file': name, 'image': 'https://example.com/a.png'})[0] == 'url'
+        with pytest.raises(ImageUnavailable):
+            cache.variant(('upload', name), 'card')
+        with pytest.raises(InvalidField):
+            product_from_row({'name': 'پیراهن', 'price': '1000', 'category': 'girls', 'image_file': name},
+                             {}.get, '1403/10/01', cache.has_upload)
+    assert fetch.calls == []
+
+    assert cache.has_upload(digest)
+    assert image_source({'image_file': digest}) == ('upload', digest)
+    product = product_from_row({'name': 'پیراهن', 'price': '1000', 'category': 'girls', 'image_file': digest},
+                               {}.get, '1403/10/01', cache.has_upload)
+    assert product['image_file'] == digest
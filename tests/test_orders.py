@@ -0,0 +1,146 @@
+import json
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from orders import CANCELLED, CONFIRMED, EXPIRED, PENDING, Checkout, OrderLog
+from pricing import INVALID_QUANTITY, price_cart
+from storage import OutOfStock, create_storage
+
+STOCK = 10
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def storage(request, tmp_path):
+    storage = create_storage(request.param, str(tmp_path))
+    storage.save('products', [
+        {'id': 1, 'name': 'پیراهن', 'price': 100000, 'stock': STOCK, 'sizes': [], 'colors': []},
+        {'id': 2, 'name': 'شلوار', 'price': 200000, 'stock': STOCK, 'sizes': [], 'colors': []},
+    ])
+    return storage
+
+
+def products(storage):
+    return {p['id']: p for p in storage.load('products')}
+
+
+def stock(storage, product_id=1):
+    return products(storage)[product_id]['stock']
+
+
+def quote(storage, *lines):
+    items = [{'product_id': product_id, 'quantity': quantity, 'size': '', 'color': ''}
+             for product_id, quantity in lines]
+    return price_cart(items, products(storage), {})
+
+
+def run_together(*targets):
+    # Starts every target at the same moment and waits for all of them
+    barrier = threading.Barrier(len(targets))
+    errors = []
+
+    def run(target):
+        barrier.wait()
+        try:
+            target()
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(t,)) for t in targets]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors, errors
+
+
+def test_concurrent_checkouts_never_oversell(storage, tmp_path):
+    checkout = Checkout(storage, OrderLog(str(tmp_path / 'orders.log')))
+    cart = quote(storage, (1, 1), (2, 2))
+    placed = []
+    rejected = []
+
+    def place():
+        try:
+            placed.append(checkout.place(cart, {}))
+        except OutOfStock:
+            rejected.append(1)
+    run_together(*[place] * 3 * STOCK)
+
+    assert len(placed) == STOCK // 2
+    assert len(rejected) == 3 * STOCK - STOCK // 2
+    assert stock(storage, 1) == STOCK - STOCK // 2
+    assert stock(storage, 2) == 0
+    assert len({order['id'] for order in placed}) == len(placed)
+
+
+def test_confirm_cancel_and_sweeper_release_once(storage, tmp_path):
+    log = OrderLog(str(tmp_path / 'orders.log'))
+    for ttl in (3600, -1):
+        checkout = Checkout(storage, log, ttl=ttl)
+        for _ in range(5):
+            order = checkout.place(quote(storage, (1, 3)), {})
+            results = {}
+            run_together(lambda: results.update(confirm=checkout.confirm(order['id'])),
+                         lambda: results.update(cancel=checkout.cancel(order['id'])),
+                         lambda: results.update(swept=checkout.release_expired()))
+            status = log.get(order['id'])['status']
+            # Exactly one of them moved the order out of pending
+            assert results['confirm'] == (status == CONFIRMED)
+            assert results['cancel'] == (status == CANCELLED)
+            if ttl > 0:
+                assert status in (CONFIRMED, CANCELLED) and not results['swept']
+            else:
+                assert status in (EXPIRED, CANCELLED)
+            if status == CONFIRMED:
+                storage.adjust_stock({1: 3})  # the next round starts from full stock again
+            # Released stock came back once, not once per caller
+            assert stock(storage) == STOCK
+
+
+def test_torn_trailing_line_is_skipped_and_cut_off(tmp_path):
+    path = str(tmp_path / 'orders.log')
+    log = OrderLog(path)
+    first = log.create({'status': PENDING, 'items': [], 'expires_at': 0})
+    with open(path, 'ab') as f:
+        f.write(b'{"op":"create","order":{"id":2,"sta')
+
+    reader = OrderLog(path)
+    assert [o['id'] for o in reader.all()] == [first['id']]
+
+    second = reader.create({'status': PENDING, 'items': [], 'expires_at': 0})
+    assert second['id'] == 2
+    with open(path, 'rb') as f:
+        lines = f.read().splitlines()
+    assert [json.loads(line)['order']['id'] for line in lines] == [1, 2]
+    assert [o['id'] for o in OrderLog(path).all()] == [2, 1]
+    assert [o['id'] for o in log.all()] == [2, 1]
+
+
+def test_non_positive_quantities_are_rejected(storage, tmp_path):
+    checkout = Checkout(storage, OrderLog(str(tmp_path / 'orders.log')))
+    for quantity in (0, -5):
+        cart = quote(storage, (1, 2), (2, quantity))
+        assert not cart.ok
+        assert (2, INVALID_QUANTITY) in cart.problems
+        with pytest.raises(ValueError):
+            checkout.place(cart, {})
+    assert stock(storage, 1) == STOCK
+    assert stock(storage, 2) == STOCK
+    assert checkout.log.all() == []
+
+
+def test_only_checkout_details_are_stored(storage, tmp_path):
+    path = str(tmp_path / 'orders.log')
+    checkout = Checkout(storage, OrderLog(path))
+    order = checkout.place(quote(storage, (1, 2)), {
+        'name': 'مریم', 'phone': '0912', 'address': 'تهران',
+        'status': CONFIRMED, 'total': 0, 'items': [], 'cart_id': 'abc'})
+    assert order['status'] == PENDING
+    assert order['total'] == 200000
+    assert len(order['items']) == 1
+    assert (order['name'], order['phone'], order['address']) == ('مریم', '0912', 'تهران')
+    assert 'cart_id' not in OrderLog(path).get(order['id'])
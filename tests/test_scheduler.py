@@ -0,0 +1,76 @@
+import importlib
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import jdatetime
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from discounts import next_midnight
+from scheduler import ManualClock, SystemClock
+from storage import create_storage
+
+
+def jalali(day):
+    return jdatetime.date.fromgregorian(date=day).strftime('%Y/%m/%d')
+
+
+@pytest.fixture
+def shop(tmp_path, monkeypatch):
+    # app.py with its data in tmp_path and a clock 30 seconds before midnight
+    start = next_midnight(time.time()) - 30
+    today = datetime.fromtimestamp(start).date()
+    tomorrow = today + timedelta(days=1)
+    product = {'price': 100000, 'stock': 5, 'sizes': [], 'colors': [], 'category': 'girls',
+               'has_discount': True, 'discount_percent': 20}
+    create_storage('json', str(tmp_path)).save('products', [
+        dict(product, id=1, name='starts tomorrow', discount_start=jalali(tomorrow),
+             discount_end=jalali(tomorrow + timedelta(days=5))),
+        dict(product, id=2, name='ends today', discount_start=jalali(today - timedelta(days=5)),
+             discount_end=jalali(today)),
+    ])
+    monkeypatch.setenv('KOODAK_DATA_DIR', str(tmp_path))
+    monkeypatch.setenv('KOODAK_STORAGE', 'json')
+    monkeypatch.setenv('KOODAK_DAY_SCHEDULER', '0')
+    monkeypatch.chdir(tmp_path)
+    sys.modules.pop('app', None)
+    app = importlib.import_module('app')
+    clock = ManualClock(start)
+    app.use_clock(clock)
+    app.create_app()
+    yield app, clock
+    app.reservation_sweeper.stop()
+    app.use_clock(SystemClock())  # jalali_today is shared with the discounts module
+    sys.modules.pop('app', None)
+
+
+def discounts(client):
+    products = client.get('/api/products?fields=id,discount_active,final_price').get_json()['products']
+    return {p['id']: (p['discount_active'], p['final_price']) for p in products}
+
+
+def test_discounts_start_and_end_at_midnight(shop):
+    app, clock = shop
+    client = app.app.test_client()
+    before = {1: (False, 100000), 2: (True, 80000)}
+    assert discounts(client) == before
+    assert client.get('/api/products/1').get_json()['discount_active'] is False
+
+    # Nothing is due before midnight
+    clock.advance(20)
+    assert not app.day_scheduler.run_due()
+    assert discounts(client) == before
+
+    clock.advance(20)
+    assert app.day_scheduler.run_due()
+    assert app.day_scheduler.stats()['runs'] == 1
+    assert app.day_scheduler.stats()['errors'] == 0
+    assert app.jalali_today.text() == jalali(datetime.fromtimestamp(clock.now()).date())
+    assert discounts(client) == {1: (True, 80000), 2: (False, 100000)}
+    assert client.get('/api/products/1').get_json()['discount_active'] is True
+    assert client.get('/api/products/2').get_json()['final_price'] == 100000
+    # The next run is a day later
+    assert not app.day_scheduler.run_due()
@@ -0,0 +1,29 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search import SearchIndex, normalize, query_tokens, tokenize
+
+
+def test_arabic_letters_and_digits_are_folded():
+    assert normalize('كيك') == normalize('کیک') == 'کیک'
+    assert normalize('۱۲۳') == normalize('١٢٣') == '123'
+    assert normalize('کُلاه') == 'کلاه'
+
+
+def test_zwnj_words_match_joined_split_or_spaced():
+    assert tokenize('تی‌شرت') == ['تی', 'شرت', 'تیشرت']
+    assert query_tokens('تي‌شرت') == ['تیشرت']
+    assert query_tokens('تی شرت') == ['تی', 'شرت']
+
+
+def test_search_finds_products_however_the_query_is_typed():
+    index = SearchIndex()
+    index.add({'id': 1, 'name': 'تی‌شرت صورتی', 'sizes': ['۳-۴ سال']})
+    index.add({'id': 2, 'name': 'کلاه بافتنی', 'sizes': ['5-6 سال']})
+    for query in ('تیشرت', 'تي‌شرت', 'تی شرت', 'تی‌ش'):
+        assert [i for i, score in index.search(query)] == [1], query
+    assert [i for i, score in index.search('كلاه')] == [2]
+    assert [i for i, score in index.search('4 سال')] == [1]
+    assert [i for i, score in index.search('۶')] == [2]
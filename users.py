@@ -0,0 +1,113 @@
+import re
+import threading
+
+from search import normalize
+from storage import UniqueIndex
+
+_NON_DIGITS = re.compile(r'[^0-9]')
+
+
+def normalize_email(email):
+    return (email or '').strip().lower()
+
+
+def normalize_username(username):
+    # Case and Arabic/Persian letter variants (ي/ی, ك/ک) do not make a new name
+    username = (username or '').strip()
+    if username.isascii():
+        return username.lower()
+    return normalize(username)
+
+
+def normalize_phone(phone):
+    # '+98 912 000 0000', '00989120000000' and Persian digits -> '09120000000'
+    phone = phone or ''
+    if phone.isascii() and phone.isdigit() and phone.startswith('0') and not phone.startswith('00'):
+        return phone
+    digits = _NON_DIGITS.sub('', normalize(phone))
+    if digits.startswith('0098'):
+        digits = '0' + digits[4:]
+    elif digits.startswith('98') and len(digits) == 12:
+        digits = '0' + digits[2:]
+    return digits
+
+
+KEY_FIELDS = (
+    ('email', normalize_email),
+    ('username', normalize_username),
+    ('phone', normalize_phone),
+)
+
+
+def user_keys(user):
+    # The user's unique keys as (field, normalized value); pass as
+    # `unique=` to storage.insert/update to have them enforced
+    keys = []
+    for field, normalizer in KEY_FIELDS:
+        value = normalizer(user.get(field))
+        if value:
+            keys.append((field, value))
+    return keys
+
+
+class UserRepository:
+    # What load_users() hands out: the users in file order plus lookups by
+    # id and by normalized email, username and phone, so login and the
+    # duplicate checks are dict lookups instead of scans over every user.
+    # Built and kept current by a CatalogStore, like ProductRepository; the
+    # id dict is replaced, not mutated, so readers can iterate unlocked.
+
+    def __init__(self, users=(), indexes=None):
+        self._lock = threading.Lock()
+        self._by_id = {user['id']: user for user in users}
+        self._keys = UniqueIndex(user_keys, self._by_id.values())
+
+    def __iter__(self):
+        return iter(self._by_id.values())
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def get(self, user_id):
+        return self._by_id.get(user_id)
+
+    def find(self, field, value):
+        normalizer = dict(KEY_FIELDS)[field]
+        return self._by_id.get(self._keys.find((field, normalizer(value))))
+
+    def by_email(self, email):
+        return self.find('email', email)
+
+    def by_username(self, username):
+        return self.find('username', username)
+
+    def by_phone(self, phone):
+        return self.find('phone', phone)
+
+    def add(self, user):
+        with self._lock:
+            by_id = dict(self._by_id)
+            by_id[user['id']] = user
+            self._by_id = by_id
+            self._keys.add(user)
+
+    def update(self, user):
+        with self._lock:
+            old = self._by_id.get(user['id'])
+            if old is None:
+                return None
+            by_id = dict(self._by_id)
+            by_id[user['id']] = user
+            self._by_id = by_id
+            self._keys.remove(user['id'])
+            self._keys.add(user)
+            return old
+
+    def delete(self, user_id):
+        with self._lock:
+            if user_id not in self._by_id:
+                return
+            by_id = dict(self._by_id)
+            del by_id[user_id]
+            self._by_id = by_id
+            self._keys.remove(user_id)
@@ -0,0 +1,8 @@
+# WSGI entry point: gunicorn -c gunicorn.conf.py wsgi:app
+#
+# With preload_app (the default in gunicorn.conf.py) this runs once in the
+# gunicorn master, and the workers forked from it share the catalog built
+# here; without it, each worker runs it for itself.
+from app import create_app
+
+app = create_app(preload=True)